@@ -0,0 +1,81 @@
+####################################
+###### BindCraft batched prediction check
+####################################
+### Import dependencies
+import os, sys, argparse
+import numpy as np
+
+bindcraft_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, bindcraft_folder)
+from functions import *
+
+######################################
+### parse check options
+parser = argparse.ArgumentParser(description='Check that batched AF2 validation gives the same confidence metrics as predicting one sequence at a time.')
+
+parser.add_argument('--advanced', '-a', type=str, default=os.path.join(bindcraft_folder, 'settings_advanced', 'default_4stage_multimer.json'),
+                    help='Advanced settings with the validation options to check.')
+parser.add_argument('--target', type=str, default=os.path.join(bindcraft_folder, 'example', 'PDL1.pdb'),
+                    help='Target structure used without a trajectory template.')
+parser.add_argument('--chains', type=str, default='A',
+                    help='Target chains.')
+parser.add_argument('--trajectory', type=str, default=None,
+                    help='Complex of target chain A and binder chain B, e.g. a trajectory PDB, to also check the initial guess and bigbang templates.')
+parser.add_argument('--length', type=int, default=60,
+                    help='Binder length without a trajectory.')
+parser.add_argument('--batch_size', type=int, default=4,
+                    help='Batch size the single sequence is padded to.')
+parser.add_argument('--tolerance', type=float, default=0.01,
+                    help='Largest accepted difference of pLDDT, pTM and i_pTM between the two paths.')
+
+args = parser.parse_args()
+
+with open(args.advanced, 'r') as f:
+    advanced_settings = perform_advanced_settings_check(json.load(f), bindcraft_folder)
+advanced_settings["validation_model_memory_gb"] = 0
+_, prediction_models, multimer_validation = load_af2_models(advanced_settings["use_multimer_design"])
+num_recycles = advanced_settings["num_recycles_validation"]
+
+# binder sequence of the trajectory, or a random one
+if args.trajectory is not None:
+    binder_atoms = read_pdb_atoms(args.trajectory)
+    binder_atoms = binder_atoms[(binder_atoms['chain'] == 'B') & (binder_atoms['name'] == 'CA')]
+    binder_sequence = ''.join(three_to_one_map[resname] for resname in binder_atoms['resname'])
+else:
+    binder_sequence = ''.join(np.random.default_rng(0).choice(list('ACDEFGHIKLMNPQRSTVWY'), args.length))
+length = len(binder_sequence)
+
+# confidence metrics of each model from predict() and from predict_batch() with the sequence in the first batch position
+def compare(prediction_model, label, metrics):
+    failed = False
+    loss, aux = predict_batch(prediction_model, pad_batch([binder_sequence], args.batch_size), prediction_models, num_recycles)
+    for model_index, model_num in enumerate(prediction_models):
+        prediction_model.predict(seq=binder_sequence, models=[model_num], num_recycles=num_recycles, verbose=False)
+        single = prediction_model.aux["log"]
+        batched = unbatch_aux(loss, aux, model_index, 0)["log"]
+        differences = {metric: abs(float(single[metric]) - batched[metric]) for metric in metrics}
+        status = 'ok' if max(differences.values()) <= args.tolerance else 'MISMATCH'
+        failed |= status != 'ok'
+        print(f"{label:<24} model {model_num+1}  " + '  '.join(f"{metric} {float(single[metric]):.3f}/{batched[metric]:.3f}" for metric in metrics) + f"  {status}")
+    return failed
+
+# complex prediction with each template mode the trajectory allows, and binder alone
+template_modes = [(False, False)]
+if args.trajectory is not None:
+    template_modes += [(True, False), (False, True)]
+
+failed = False
+for initial_guess, bigbang in template_modes:
+    advanced_settings["predict_initial_guess"], advanced_settings["predict_bigbang"] = initial_guess, bigbang
+    target_settings = {"starting_pdb": args.target, "chains": args.chains}
+    complex_model = get_complex_prediction_model(args.trajectory, length, multimer_validation, advanced_settings, target_settings)
+    label = 'complex' + (' initial_guess' if initial_guess else '') + (' bigbang' if bigbang else '')
+    failed |= compare(complex_model, label, ['plddt', 'ptm', 'i_ptm'])
+
+binder_model = get_binder_prediction_model(length, multimer_validation, advanced_settings)
+failed |= compare(binder_model, 'binder', ['plddt', 'ptm'])
+
+if failed:
+    print(f"Batched and single sequence predictions differ by more than {args.tolerance}")
+    sys.exit(1)
+print("Batched and single sequence predictions agree")
@@ -0,0 +1,292 @@
+####################################
+############ BindCraft CPU benchmarks
+####################################
+### Import dependencies
+import os, io, sys, json, time, shutil, platform, subprocess, tempfile, argparse
+from contextlib import redirect_stdout
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+bindcraft_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, bindcraft_folder)
+from functions import *
+
+######################################
+### parse benchmark options
+parser = argparse.ArgumentParser(description='Time the CPU analysis functions of BindCraft on the example target with synthetic binders.')
+
+parser.add_argument('--lengths', type=int, nargs='+', default=[65, 100, 150, 200, 250],
+                    help='Binder lengths of the synthetic complexes.')
+parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 5000],
+                    help='Numbers of designs for the statistics, filter and ranking benchmarks.')
+parser.add_argument('--repeats', type=int, default=5,
+                    help='Number of timed runs of each benchmark, the median is reported.')
+parser.add_argument('--output', type=str, default=os.path.join(bindcraft_folder, 'benchmarks', 'results', 'benchmark_' + time.strftime('%Y%m%d_%H%M%S') + '.json'),
+                    help='JSON file to write the results to.')
+parser.add_argument('--baseline', type=str, default=None,
+                    help='JSON results of an earlier run to compare against, slower benchmarks are reported as regressions.')
+parser.add_argument('--tolerance', type=float, default=0.25,
+                    help='Fraction by which a benchmark may be slower than the baseline before it counts as a regression.')
+
+args = parser.parse_args()
+
+starting_pdb = os.path.join(bindcraft_folder, 'example', 'PDL1.pdb')
+hotspot_residue = 56
+
+# ideal backbone geometry, bond lengths in A and angles in degrees
+bond_lengths = {'N_CA': 1.458, 'CA_C': 1.525, 'C_N': 1.329, 'C_O': 1.231, 'CA_CB': 1.53}
+bond_angles = {'N_CA_C': 111.2, 'CA_C_N': 116.2, 'C_N_CA': 121.7, 'CA_C_O': 120.5, 'N_CA_CB': 110.5}
+residue_names = ['ALA', 'GLU', 'LEU', 'LYS', 'ARG', 'SER', 'ILE', 'VAL', 'ASP', 'GLN', 'THR', 'TYR', 'PHE', 'ASN']
+
+# place atom d bonded to c from the positions of a, b and c, the bond length, angle b-c-d and torsion a-b-c-d (NeRF)
+def place_atom(a, b, c, bond, angle, torsion):
+    angle, torsion = np.radians(angle), np.radians(torsion)
+    bc = (c - b) / np.linalg.norm(c - b)
+    n = np.cross(b - a, bc)
+    n /= np.linalg.norm(n)
+    d = np.array([-bond * np.cos(angle), bond * np.sin(angle) * np.cos(torsion), bond * np.sin(angle) * np.sin(torsion)])
+    return c + d[0] * bc + d[1] * np.cross(n, bc) + d[2] * n
+
+# backbone and C beta coordinates of a binder of helices joined by short loops, as {atom name: [L, 3]}
+def build_binder_backbone(length, rng):
+    phi, psi = np.full(length, -57.0), np.full(length, -47.0)
+    position = int(rng.integers(12, 18))
+    while position < length - 4:
+        phi[position:position+4] = [-70, -90, 80, -80]
+        psi[position:position+4] = [150, 0, 20, 140]
+        position += 4 + int(rng.integers(14, 20))
+
+    coords = {name: np.zeros((length, 3)) for name in ['N', 'CA', 'C', 'O', 'CB']}
+    coords['N'][0] = [0, 0, 0]
+    coords['CA'][0] = [bond_lengths['N_CA'], 0, 0]
+    coords['C'][0] = coords['CA'][0] + bond_lengths['CA_C'] * np.array([-np.cos(np.radians(bond_angles['N_CA_C'])), np.sin(np.radians(bond_angles['N_CA_C'])), 0])
+    for i in range(1, length):
+        coords['N'][i] = place_atom(coords['N'][i-1], coords['CA'][i-1], coords['C'][i-1], bond_lengths['C_N'], bond_angles['CA_C_N'], psi[i-1])
+        coords['CA'][i] = place_atom(coords['CA'][i-1], coords['C'][i-1], coords['N'][i], bond_lengths['N_CA'], bond_angles['C_N_CA'], 180.0)
+        coords['C'][i] = place_atom(coords['C'][i-1], coords['N'][i], coords['CA'][i], bond_lengths['CA_C'], bond_angles['N_CA_C'], phi[i])
+    for i in range(length):
+        coords['O'][i] = place_atom(coords['N'][i], coords['CA'][i], coords['C'][i], bond_lengths['C_O'], bond_angles['CA_C_O'], psi[i] + 180.0)
+        coords['CB'][i] = place_atom(coords['C'][i], coords['N'][i], coords['CA'][i], bond_lengths['CA_CB'], bond_angles['N_CA_CB'], -122.5)
+    return coords
+
+# complex of the example target and a synthetic binder placed against the hotspot, written as chains A and B
+def write_synthetic_complex(pdb_file, target_atoms, length, rng):
+    backbone = build_binder_backbone(length, rng)
+    binder_coords = np.concatenate([backbone[name] for name in ['N', 'CA', 'C', 'O', 'CB']])
+    binder_coords -= binder_coords.mean(axis=0)
+
+    # turn a random binder residue towards the hotspot and move the binder out until its closest atom is about 3 A from the target,
+    # keeping the placement with the most target atoms in contact
+    target_coords = target_atoms['coord'].astype(float)
+    hotspot = target_coords[(target_atoms['resseq'] == hotspot_residue) & (target_atoms['name'] == 'CA')][0]
+    direction = (hotspot - target_coords.mean(axis=0)) / np.linalg.norm(hotspot - target_coords.mean(axis=0))
+    tree = cKDTree(target_coords)
+    best_contacts, best_coords = -1, None
+    for _ in range(16):
+        anchor = backbone['CA'][rng.integers(length)] - binder_coords.mean(axis=0)
+        rotation = np.linalg.qr(rng.normal(size=(3, 3)))[0]
+        rotation *= np.sign(np.linalg.det(rotation))
+        # rotate the anchor onto -direction, the random rotation only sets the spin around it
+        u, v = rotation @ anchor / np.linalg.norm(anchor), -direction
+        axis, c = np.cross(u, v), np.dot(u, v)
+        skew = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+        align = np.eye(3) + skew + skew @ skew / (1 + c)
+        rotated = (binder_coords - binder_coords.mean(axis=0) - anchor) @ (align @ rotation).T
+
+        low, high = -20.0, 200.0
+        for _ in range(40):
+            offset = (low + high) / 2
+            if tree.query(rotated + hotspot + direction * offset)[0].min() < 3.0:
+                low = offset
+            else:
+                high = offset
+        placed = rotated + hotspot + direction * high
+        contacts = len(set().union(*tree.query_ball_point(placed, 4.0)))
+        if contacts > best_contacts:
+            best_contacts, best_coords = contacts, placed
+    binder_coords = best_coords
+
+    # target slightly perturbed as in a prediction, binder atoms ordered by residue
+    target = target_atoms.copy()
+    target['coord'] += rng.normal(0, 0.3, target['coord'].shape).astype('f4')
+    target['bfactor'] = np.round(rng.uniform(70, 95, len(target)), 2)
+
+    names = ['N', 'CA', 'C', 'O', 'CB']
+    binder = np.zeros(length * len(names), dtype=pdb_atom_dtype)
+    residue = np.repeat(np.arange(length), len(names))
+    atom = np.tile(np.arange(len(names)), length)
+    binder['record'] = 'ATOM'
+    binder['name'] = np.array(names)[atom]
+    binder['element'] = [name[0] for name in binder['name']]
+    binder['resname'] = np.array(residue_names)[rng.integers(0, len(residue_names), length)][residue]
+    binder['chain'] = 'B'
+    binder['resseq'] = residue + 1
+    binder['coord'] = binder_coords.reshape(len(names), length, 3).transpose(1, 0, 2).reshape(-1, 3)
+    binder['occupancy'] = 1.0
+    binder['bfactor'] = np.round(rng.uniform(70, 95, length), 2)[residue]
+
+    atoms = np.concatenate([target, binder])
+    atoms['serial'] = np.arange(1, len(atoms) + 1)
+    write_pdb_atoms(atoms, pdb_file)
+
+# statistics of a design as produced by analyse_mpnn_design, for five models
+def synthetic_design_statistics(rng):
+    core_labels = generate_dataframe_labels()[1]
+    metrics = sorted({label.split('_', 1)[1] for label in core_labels if label.startswith('Average_')} - {'InterfaceAAs'})
+    statistics = {}
+    for model in range(1, 6):
+        statistics[model] = {metric: round(float(rng.uniform(0, 1)), 2) for metric in metrics}
+        statistics[model]['InterfaceAAs'] = {aa: int(rng.integers(0, 4)) for aa in 'ACDEFGHIKLMNPQRSTVWY'}
+    return statistics
+
+# rows of the MPNN design statistics, in the layout of mpnn_design_stats.csv
+def synthetic_design_rows(n_rows, design_labels, rng):
+    rows = []
+    for n in range(n_rows):
+        statistics = synthetic_design_statistics(rng)
+        averages = calculate_averages(statistics, handle_aa=True)
+        row = {'Design': f"PDL1_l100_s{n}_mpnn1", 'Protocol': 'Default', 'Length': 100, 'Seed': n, 'Helicity': 0, 'Target_Hotspot': str(hotspot_residue),
+            'Sequence': ''.join(rng.choice(list('ACDEFGHIKLMNPQRSTVWY'), 100)), 'InterfaceResidues': 'B1,B2', 'MPNN_score': 1.0, 'MPNN_seq_recovery': 0.5}
+        for label in design_labels[10:-5]:
+            prefix, metric = label.split('_', 1)
+            row[label] = averages.get(metric) if prefix == 'Average' else statistics[int(prefix)].get(metric)
+        row.update({'DesignTime': '0 hours, 1 minutes, 0 seconds', 'Notes': '', 'TargetSettings': 'PDL1', 'Filters': 'default_filters', 'AdvancedSettings': 'default_4stage_multimer'})
+        rows.append([row.get(label) for label in design_labels])
+    return rows
+
+# time fn over the repeats, setup runs before every repeat and is not timed
+def time_benchmark(name, size, fn, setup=None, repeats=args.repeats):
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        # output of the timed functions, e.g. the ranking messages, is discarded
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+    result = {'name': name, 'size': size, 'median_s': float(np.median(timings)), 'min_s': float(np.min(timings)), 'repeats': repeats}
+    print(f"{name:<32} {size:>8} {result['median_s'] * 1000:>12.3f} ms")
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=bindcraft_folder, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+####################################
+### run benchmarks
+rng = np.random.default_rng(0)
+results = []
+work_folder = tempfile.mkdtemp(prefix='bindcraft_benchmark_')
+
+with open(os.path.join(bindcraft_folder, 'settings_advanced', 'default_4stage_multimer.json')) as f:
+    advanced_settings = {**advanced_settings_defaults, **json.load(f)}
+advanced_settings.update({'use_dssp_binary': False, 'zip_animations': False, 'zip_plots': False})
+with open(os.path.join(bindcraft_folder, 'settings_filters', 'default_filters.json')) as f:
+    filters = json.load(f)
+
+try:
+    print(f"{'benchmark':<32} {'size':>8} {'median':>15}")
+
+    ### analyses of single structures, by binder length
+    target_atoms = read_pdb_atoms(starting_pdb)
+    for length in args.lengths:
+        complex_pdb = os.path.join(work_folder, f"complex_l{length}.pdb")
+        write_synthetic_complex(complex_pdb, target_atoms, length, rng)
+
+        results.append(time_benchmark('calculate_clash_score', length, lambda: calculate_clash_score(complex_pdb)))
+        results.append(time_benchmark('hotspot_residues', length, lambda: hotspot_residues(complex_pdb)))
+        results.append(time_benchmark('calc_ss_percentage', length, lambda: calc_ss_percentage(complex_pdb, advanced_settings)))
+        results.append(time_benchmark('target_pdb_rmsd', length, lambda: target_pdb_rmsd(complex_pdb, starting_pdb, "A")))
+
+    ### statistics, filters and results files, by number of designs
+    trajectory_labels, design_labels, final_labels = generate_dataframe_labels()
+    for n_rows in args.rows:
+        statistics = [synthetic_design_statistics(rng) for _ in range(n_rows)]
+        rows = synthetic_design_rows(n_rows, design_labels, rng)
+        row_folder = os.path.join(work_folder, f"rows_{n_rows}")
+        os.makedirs(row_folder)
+
+        results.append(time_benchmark('calculate_averages', n_rows, lambda: [calculate_averages(s, handle_aa=True) for s in statistics]))
+        results.append(time_benchmark('check_filters', n_rows, lambda: [check_filters(row, design_labels, filters) for row in rows]))
+        design_df = pd.DataFrame(rows, columns=design_labels).astype({label: str for label in design_labels if label.endswith('InterfaceAAs')})
+        results.append(time_benchmark('filter_failures', n_rows, lambda: filter_failures(design_df, filters)))
+
+        # appending statistics to the CSV, and to the results store
+        mpnn_csv = os.path.join(row_folder, 'mpnn_design_stats.csv')
+        def reset_csv():
+            if os.path.exists(mpnn_csv):
+                os.remove(mpnn_csv)
+            create_dataframe(mpnn_csv, design_labels)
+        results.append(time_benchmark('insert_data', n_rows, lambda: [insert_data(mpnn_csv, row) for row in rows], setup=reset_csv, repeats=1))
+
+        store_folder = os.path.join(row_folder, 'store')
+        def reset_store():
+            shutil.rmtree(store_folder, ignore_errors=True)
+            os.makedirs(store_folder)
+        def insert_store():
+            results_store = ResultsStore(store_folder)
+            results_store.create_table(os.path.join(store_folder, 'mpnn_design_stats.csv'), design_labels)
+            for row in rows:
+                insert_data(os.path.join(store_folder, 'mpnn_design_stats.csv'), row, results_store)
+            results_store.close()
+        results.append(time_benchmark('insert_data_results_store', n_rows, insert_store, setup=reset_store, repeats=1))
+
+        # failure counts flushed after every update, as without failure_flush_interval
+        failure_csv = os.path.join(row_folder, 'failure_csv.csv')
+        generate_filter_pass_csv(failure_csv, os.path.join(bindcraft_folder, 'settings_filters', 'default_filters.json'))
+        results.append(time_benchmark('update_failures', n_rows, lambda: [update_failures(failure_csv, 'Trajectory_Clashes') for _ in range(n_rows)], repeats=1))
+        failure_counters.clear()
+
+        # ranking of the accepted designs, from the Accepted folder and from the design index
+        design_paths = generate_directories(os.path.join(row_folder, 'design'))
+        pd.DataFrame(rows, columns=design_labels).to_csv(mpnn_csv, index=False)
+        n_accepted = min(n_rows, 100)
+        accepted_pdb = os.path.join(work_folder, f"complex_l{args.lengths[0]}.pdb")
+        for row in rows[:n_accepted]:
+            shutil.copyfile(accepted_pdb, os.path.join(design_paths["Accepted"], f"{row[0]}_model1.pdb"))
+        target_settings = {'number_of_final_designs': n_accepted, 'binder_name': 'PDL1'}
+        final_csv = os.path.join(row_folder, 'final_design_stats.csv')
+
+        results.append(time_benchmark('check_accepted_designs', n_rows, lambda: check_accepted_designs(design_paths, mpnn_csv, final_labels, final_csv, advanced_settings,
+                                                                                                        target_settings, design_labels)))
+        design_index = DesignIndex(os.path.join(row_folder, 'design'), design_paths)
+        results.append(time_benchmark('check_accepted_designs_index', n_rows, lambda: check_accepted_designs(design_paths, mpnn_csv, final_labels, final_csv, advanced_settings,
+                                                                                                        target_settings, design_labels, design_index=design_index)))
+
+finally:
+    shutil.rmtree(work_folder, ignore_errors=True)
+
+### save results
+output = {
+    'metadata': {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'git_commit': git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+                'pandas': pd.__version__, 'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count()},
+    'benchmarks': results
+}
+os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+with open(args.output, 'w') as f:
+    json.dump(output, f, indent=2)
+print(f"Results written to {args.output}")
+
+### compare with a baseline run
+if args.baseline:
+    with open(args.baseline) as f:
+        baseline = {(result['name'], result['size']): result for result in json.load(f)['benchmarks']}
+
+    regressions = []
+    for result in results:
+        reference = baseline.get((result['name'], result['size']))
+        if reference is None or reference['median_s'] <= 0:
+            continue
+        ratio = result['median_s'] / reference['median_s']
+        if ratio > 1 + args.tolerance:
+            regressions.append((result['name'], result['size'], ratio))
+
+    for name, size, ratio in regressions:
+        print(f"Regression: {name} ({size}) is {ratio:.2f}x slower than the baseline")
+    if regressions:
+        exit(1)
+    print(f"No regressions compared to {args.baseline}")
@@ -4,9 +4,6 @@
 ### Import dependencies
 from functions import *
 
-# Check if JAX-capable GPU is available, otherwise exit
-check_jax_gpu()
-
 ######################################
 ### parse input paths
 parser = argparse.ArgumentParser(description='Script to run BindCraft binder design.')
@@ -37,9 +34,42 @@ design_models, prediction_models, multimer_validation = load_af2_models(advanced
 bindcraft_folder = os.path.dirname(os.path.realpath(__file__))
 advanced_settings = perform_advanced_settings_check(advanced_settings, bindcraft_folder)
 
+### start CPU workers for relaxation and scoring, these have to be forked before JAX initialises the GPU
+cpu_stage = CPUStage(advanced_settings["pipeline_cpu_workers"], advanced_settings["pipeline_max_pending"], advanced_settings["dalphaball_path"])
+relax_pool = start_relax_pool(advanced_settings["relax_workers"], advanced_settings["dalphaball_path"])
+
+# Check if JAX-capable GPU is available, otherwise exit
+check_jax_gpu()
+
 ### generate directories, design path names can be found within the function
 design_paths = generate_directories(target_settings["design_path"])
 
+### shared run state, lets several workers design into the same design path
+run_state = None
+if advanced_settings["shared_run_state"]:
+    run_state = RunState(target_settings["design_path"])
+    run_state.register_existing(design_paths)
+    print(f"Sharing design path with other workers as {run_state.worker_id}")
+
+### results store for trajectory and MPNN statistics, CSV files are appended to directly otherwise
+results_store = None
+if advanced_settings["results_store"] == "sqlite":
+    results_store = ResultsStore(target_settings["design_path"])
+
+### index of relaxed trajectories and accepted designs, replaces listing the design folders in every iteration
+design_index = DesignIndex(target_settings["design_path"], design_paths)
+
+### adaptive sampling of binder lengths and helicity towards the most accepted designs per GPU second
+sampler = None
+if advanced_settings["adaptive_sampling"]:
+    sampler = AdaptiveSampler(target_settings["design_path"], target_settings, advanced_settings)
+
+### trace of the design stages, shared by all workers designing into the design path
+trace_file = None
+if advanced_settings["trace"]:
+    trace_file = os.path.join(target_settings["design_path"], 'trace.jsonl')
+    start_tracer(trace_file)
+
 ### generate dataframes
 trajectory_labels, design_labels, final_labels = generate_dataframe_labels()
 
@@ -48,419 +78,605 @@ mpnn_csv = os.path.join(target_settings["design_path"], 'mpnn_design_stats.csv')
 final_csv = os.path.join(target_settings["design_path"], 'final_design_stats.csv')
 failure_csv = os.path.join(target_settings["design_path"], 'failure_csv.csv')
 
-create_dataframe(trajectory_csv, trajectory_labels)
-create_dataframe(mpnn_csv, design_labels)
+create_dataframe(trajectory_csv, trajectory_labels, results_store)
+create_dataframe(mpnn_csv, design_labels, results_store)
 create_dataframe(final_csv, final_labels)
 generate_filter_pass_csv(failure_csv, args.filters)
+sequence_index = SequenceIndex(target_settings["design_path"], mpnn_csv, results_store)
+failure_counter = get_failure_counter(failure_csv, advanced_settings["failure_flush_interval"])
+
+### checkpoints of the trajectories in progress, a run stopped by SIGTERM flushes its state and a later run resumes from them
+checkpoints = None
+if advanced_settings["checkpoints"]:
+    checkpoints = CheckpointStore(target_settings["design_path"], run_state.worker_id if run_state is not None else "local")
+install_sigterm_handler()
+
+### live metrics of the run in the Prometheus text format, served by a background thread if a metrics port is set
+metrics = RunMetrics({'target': target_settings["binder_name"], 'worker': run_state.worker_id if run_state is not None else 'local'})
+if advanced_settings["metrics_port"] and metrics.start_server(advanced_settings["metrics_address"], advanced_settings["metrics_port"]):
+    tracer.add_listener(metrics.observe_span)
+    metrics.add_gauge('cpu_stage_pending_jobs', 'Jobs queued or running in the CPU stage', cpu_stage.pending)
 
 ####################################
 ####################################
 ####################################
 ### initialise PyRosetta
-pr.init(f'-ignore_unrecognized_res -ignore_zero_occupancy -mute all -holes:dalphaball {advanced_settings["dalphaball_path"]} -corrections::beta_nov16 true -relax:default_repeats 1')
+init_pyrosetta(advanced_settings["dalphaball_path"])
 print(f"Running binder design for target {settings_file}")
 print(f"Design settings used: {advanced_file}")
 print(f"Filtering designs based on {filters_file}")
 
-####################################
-# initialise counters
-script_start_time = time.time()
-trajectory_n = 1
-accepted_designs = 0
-
-### start design loop
-while True:
-    ### check if we have the target number of binders
-    final_designs_reached = check_accepted_designs(design_paths, mpnn_csv, final_labels, final_csv, advanced_settings, target_settings, design_labels)
-
-    if final_designs_reached:
-        # stop design loop execution
-        break
+# define binder chain, placeholder in case multi-chain parsing in ColabDesign gets changed
+binder_chain = "B"
 
-    ### check if we reached maximum allowed trajectories
-    max_trajectories_reached = check_n_trajectories(design_paths, advanced_settings)
+# lazy filters check designs after each analysis stage, binder alone predictions and their statistics are then skipped unless a binder filter is set
+lazy_filters = advanced_settings["lazy_filters"]
+binder_filters = bool(stage_filters(filters, 'binder'))
 
-    if max_trajectories_reached:
-        break
-
-    ### Initialise design
-    # measure time to generate design
-    trajectory_start_time = time.time()
-
-    # generate random seed to vary designs
-    seed = int(np.random.randint(0, high=999999, size=1, dtype=int)[0])
-
-    # sample binder design length randomly from defined distribution
-    samples = np.arange(min(target_settings["lengths"]), max(target_settings["lengths"]) + 1)
-    length = np.random.choice(samples)
+####################################
+### handle results of the CPU stage
+def handle_cpu_results(results):
+    global accepted_designs
+
+    for kind, context, result in results:
+        # spans of the statistics, filters and file copies of a design carry its name and length
+        with trace_context(design=context.get("mpnn_design_name", context["design_name"]), length=context["length"]):
+            if kind == "trajectory":
+                design_name = context["design_name"]
+                trajectory_metrics = context["trajectory_metrics"]
+                trajectory_alpha, trajectory_beta, trajectory_loops, trajectory_alpha_interface, trajectory_beta_interface, trajectory_loops_interface, trajectory_i_plddt, trajectory_ss_plddt = result['ss_percentages']
+                trajectory_interface_scores = result['interface_scores']
+
+                # save trajectory statistics into CSV
+                trajectory_data = [design_name, advanced_settings["design_algorithm"], context["length"], context["seed"], context["helicity_value"], target_settings["target_hotspot_residues"], context["sequence"], result['InterfaceResidues'],
+                                    trajectory_metrics['plddt'], trajectory_metrics['ptm'], trajectory_metrics['i_ptm'], trajectory_metrics['pae'], trajectory_metrics['i_pae'],
+                                    trajectory_i_plddt, trajectory_ss_plddt, result['Unrelaxed_Clashes'], result['Relaxed_Clashes'], trajectory_interface_scores['binder_score'],
+                                    trajectory_interface_scores['surface_hydrophobicity'], trajectory_interface_scores['interface_sc'], trajectory_interface_scores['interface_packstat'],
+                                    trajectory_interface_scores['interface_dG'], trajectory_interface_scores['interface_dSASA'], trajectory_interface_scores['interface_dG_SASA_ratio'],
+                                    trajectory_interface_scores['interface_fraction'], trajectory_interface_scores['interface_hydrophobicity'], trajectory_interface_scores['interface_nres'], trajectory_interface_scores['interface_interface_hbonds'],
+                                    trajectory_interface_scores['interface_hbond_percentage'], trajectory_interface_scores['interface_delta_unsat_hbonds'], trajectory_interface_scores['interface_delta_unsat_hbonds_percentage'],
+                                    trajectory_alpha_interface, trajectory_beta_interface, trajectory_loops_interface, trajectory_alpha, trajectory_beta, trajectory_loops, result['InterfaceAAs'], result['Target_RMSD'],
+                                    context["trajectory_time_text"], result['Notes'], settings_file, filters_file, advanced_file]
+                insert_data(trajectory_csv, trajectory_data, results_store)
+
+                design_index.add_trajectory(design_name)
+                if run_state is not None:
+                    run_state.finish_trajectory(design_name)
+
+                if not result['InterfaceResidues']:
+                    print("No interface residues found for "+str(design_name)+", skipping MPNN optimization")
+                    if checkpoints is not None:
+                        checkpoints.remove(design_name)
+                    continue
+
+                # queue trajectory for MPNN redesign on the GPU
+                if advanced_settings["enable_mpnn"]:
+                    ready_trajectory = {**context, 'beta': trajectory_beta, 'interface_residues': result['InterfaceResidues']}
+                    ready_trajectories.append(ready_trajectory)
+                    if checkpoints is not None:
+                        checkpoints.save(design_name, stage='mpnn', trajectory=ready_trajectory)
+                elif checkpoints is not None:
+                    checkpoints.remove(design_name)
+
+            elif kind == "mpnn":
+                mpnn_design_name = context["mpnn_design_name"]
+                design_name = context["design_name"]
+                mpnn_complex_statistics, binder_statistics, mpnn_interface_residues = result
+                pending_per_trajectory[design_name] -= 1
+
+                # calculate complex averages
+                mpnn_complex_averages = calculate_averages(mpnn_complex_statistics, handle_aa=True)
+
+                # calculate binder averages
+                binder_averages = calculate_averages(binder_statistics)
+
+                # analyze sequence to make sure there are no cysteins and it contains residues that absorb UV for detection
+                seq_notes = validate_design_sequence(context["seq"], mpnn_complex_averages.get('Relaxed_Clashes', None), advanced_settings)
+
+                # measure time to generate design
+                mpnn_end_time = time.time() - context["mpnn_time"]
+                elapsed_mpnn_text = f"{'%d hours, %d minutes, %d seconds' % (int(mpnn_end_time // 3600), int((mpnn_end_time % 3600) // 60), int(mpnn_end_time % 60))}"
+
+                # Insert statistics about MPNN design into CSV, will return None if corresponding model does note exist
+                model_numbers = range(1, 6)
+                statistics_labels = ['pLDDT', 'pTM', 'i_pTM', 'pAE', 'i_pAE', 'i_pLDDT', 'ss_pLDDT', 'Unrelaxed_Clashes', 'Relaxed_Clashes', 'Binder_Energy_Score', 'Surface_Hydrophobicity',
+                                    'ShapeComplementarity', 'PackStat', 'dG', 'dSASA', 'dG/dSASA', 'Interface_SASA_%', 'Interface_Hydrophobicity', 'n_InterfaceResidues', 'n_InterfaceHbonds', 'InterfaceHbondsPercentage',
+                                    'n_InterfaceUnsatHbonds', 'InterfaceUnsatHbondsPercentage', 'Interface_Helix%', 'Interface_BetaSheet%', 'Interface_Loop%', 'Binder_Helix%',
+                                    'Binder_BetaSheet%', 'Binder_Loop%', 'InterfaceAAs', 'Hotspot_RMSD', 'Target_RMSD']
+
+                # Initialize mpnn_data with the non-statistical data
+                mpnn_data = [mpnn_design_name, advanced_settings["design_algorithm"], context["length"], context["seed"], context["helicity_value"], target_settings["target_hotspot_residues"], context["seq"], mpnn_interface_residues, context["score"], context["seqid"]]
+
+                # Add the statistical data for mpnn_complex
+                for label in statistics_labels:
+                    mpnn_data.append(mpnn_complex_averages.get(label, None))
+                    for model in model_numbers:
+                        mpnn_data.append(mpnn_complex_statistics.get(model, {}).get(label, None))
+
+                # Add the statistical data for binder
+                for label in ['pLDDT', 'pTM', 'pAE', 'Binder_RMSD']:  # These are the labels for binder alone
+                    mpnn_data.append(binder_averages.get(label, None))
+                    for model in model_numbers:
+                        mpnn_data.append(binder_statistics.get(model, {}).get(label, None))
+
+                # Add the remaining non-statistical data
+                mpnn_data.extend([elapsed_mpnn_text, seq_notes, settings_file, filters_file, advanced_file])
+
+                # insert data into csv
+                insert_data(mpnn_csv, mpnn_data, results_store)
+                sequence_index.add(context["seq"])
+
+                # find best model number by pLDDT
+                plddt_values = {i: mpnn_data[i] for i in range(11, 15) if mpnn_data[i] is not None}
+
+                # Find the key with the highest value
+                highest_plddt_key = int(max(plddt_values, key=plddt_values.get))
+
+                # Output the number part of the key
+                best_model_number = highest_plddt_key - 10
+                best_model_pdb = os.path.join(design_paths["MPNN/Relaxed"], f"{mpnn_design_name}_model{best_model_number}.pdb")
+
+                # designs rejected by the lazy filters before relaxation only have unrelaxed models
+                if not os.path.exists(best_model_pdb):
+                    best_model_pdb = os.path.join(design_paths["MPNN"], f"{mpnn_design_name}_model{best_model_number}.pdb")
+
+                # run design data against filter thresholds
+                filter_conditions = check_filters(mpnn_data, design_labels, filters)
+                if filter_conditions == True:
+                    print(mpnn_design_name+" passed all filters")
+                    metrics.inc('designs_accepted')
+                    accepted_per_trajectory[design_name] = accepted_per_trajectory.get(design_name, 0) + 1
+                    accepted_designs += 1
+
+                    # copy designs to accepted folder
+                    with trace_span("copy"):
+                        shutil.copy(best_model_pdb, design_paths["Accepted"])
+                    design_index.add_accepted(mpnn_design_name, os.path.basename(best_model_pdb), mpnn_data[design_labels.index('Average_i_pTM')],
+                                            dict(zip(design_labels, mpnn_data)))
+
+                    if run_state is not None:
+                        run_state.record_accepted(mpnn_design_name, design_name)
+
+                    if sampler is not None:
+                        sampler.record(context["length"], context["helicity_value"], accepted=1)
+
+                    # insert data into final csv
+                    final_data = [''] + mpnn_data
+                    insert_data(final_csv, final_data)
+
+                    # copy animation from accepted trajectory
+                    if advanced_settings["save_design_animations"]:
+                        accepted_animation = os.path.join(design_paths["Accepted/Animation"], f"{design_name}.html")
+                        if not os.path.exists(accepted_animation):
+                            with trace_span("copy"):
+                                shutil.copy(os.path.join(design_paths["Trajectory/Animation"], f"{design_name}.html"), accepted_animation)
+
+                    # copy plots of accepted trajectory
+                    with trace_span("copy"):
+                        plot_files = os.listdir(design_paths["Trajectory/Plots"])
+                        plots_to_copy = [f for f in plot_files if f.startswith(design_name) and f.endswith('.png')]
+                        for accepted_plot in plots_to_copy:
+                            source_plot = os.path.join(design_paths["Trajectory/Plots"], accepted_plot)
+                            target_plot = os.path.join(design_paths["Accepted/Plots"], accepted_plot)
+                            if not os.path.exists(target_plot):
+                                shutil.copy(source_plot, target_plot)
 
-    # load desired helicity value to sample different secondary structure contents
-    helicity_value = load_helicity(advanced_settings)
+                else:
+                    print(f"Unmet filter conditions for {mpnn_design_name}")
+                    metrics.inc('designs_rejected')
+                    failure_counter.add_filter_failures(filter_conditions)
+                    if os.path.exists(best_model_pdb):
+                        with trace_span("copy"):
+                            shutil.copy(best_model_pdb, design_paths["Rejected"])
 
-    # generate design name and check if same trajectory was already run
-    design_name = target_settings["binder_name"] + "_l" + str(length) + "_s"+ str(seed)
-    trajectory_dirs = ["Trajectory", "Trajectory/Relaxed", "Trajectory/LowConfidence", "Trajectory/Clashing"]
-    trajectory_exists = any(os.path.exists(os.path.join(design_paths[trajectory_dir], design_name + ".pdb")) for trajectory_dir in trajectory_dirs)
+                if checkpoints is not None:
+                    checkpoints.finish_mpnn_design(design_name, mpnn_design_name, filter_conditions == True)
+                release_trajectory(design_name)
 
-    if not trajectory_exists:
-        print("Starting trajectory: "+design_name)
+        # stop after a fully recorded result if the job was asked to terminate
+        check_interrupted()
 
-        ### Begin binder hallucination
-        trajectory = binder_hallucination(design_name, target_settings["starting_pdb"], target_settings["chains"],
-                                            target_settings["target_hotspot_residues"], length, seed, helicity_value,
-                                            design_models, advanced_settings, design_paths, failure_csv)
-        trajectory_metrics = copy_dict(trajectory._tmp["best"]["aux"]["log"]) # contains plddt, ptm, i_ptm, pae, i_pae
+### save space by removing unrelaxed design trajectory PDB once its MPNN stage and all of its analyses have finished
+def release_trajectory(design_name):
+    if pending_per_trajectory.get(design_name) == 0:
+        del pending_per_trajectory[design_name]
+        if checkpoints is not None:
+            checkpoints.remove(design_name)
         trajectory_pdb = os.path.join(design_paths["Trajectory"], design_name + ".pdb")
+        if advanced_settings["remove_unrelaxed_trajectory"] and os.path.exists(trajectory_pdb):
+            os.remove(trajectory_pdb)
+
+### context of an MPNN design passed on to handle_cpu_results
+def mpnn_design_context(trajectory, mpnn_design_name, mpnn_sequence, mpnn_time):
+    mpnn_score = round(mpnn_sequence['score'],2)
+    mpnn_seqid = round(mpnn_sequence['seqid'],2)
+    return {**trajectory, 'mpnn_design_name': mpnn_design_name, 'seq': mpnn_sequence['seq'], 'score': mpnn_score, 'seqid': mpnn_seqid, 'mpnn_time': mpnn_time}
+
+### record a design rejected by the lazy filters, with the statistics computed up to the stage it failed
+def reject_lazy_design(trajectory, mpnn_design_name, mpnn_sequence, mpnn_time, mpnn_complex_statistics, binder_statistics, stage):
+    print(f"{stage} filters not passed for {mpnn_design_name}, skipping interface scoring")
+    pending_per_trajectory[trajectory["design_name"]] += 1
+    handle_cpu_results([("mpnn", mpnn_design_context(trajectory, mpnn_design_name, mpnn_sequence, mpnn_time), (mpnn_complex_statistics, binder_statistics, ''))])
+
+    # save space by removing unrelaxed predicted mpnn complex pdb?
+    if advanced_settings["remove_unrelaxed_complex"]:
+        for _, mpnn_design_pdb in mpnn_model_pdbs(mpnn_design_name, prediction_models, design_paths["MPNN"]):
+            os.remove(mpnn_design_pdb)
+
+### MPNN redesign and AF2 validation of an analysed trajectory
+def run_mpnn_stage(trajectory):
+    with trace_context(design=trajectory["design_name"], length=trajectory["length"]), trace_span("mpnn_stage"):
+        mpnn_redesign(trajectory)
+
+def mpnn_redesign(trajectory):
+    design_name = trajectory["design_name"]
+    length = trajectory["length"]
+    trajectory_pdb = trajectory["trajectory_pdb"]
+
+    # initialise MPNN counters
+    pending_per_trajectory[design_name] = 1 # held by the MPNN stage until it finishes
+    design_start_time = time.time()
+
+    # sequences sampled and designs finished before the run was interrupted
+    checkpoint = checkpoints.get(design_name) if checkpoints is not None else None
+    resumed = checkpoint is not None and 'mpnn_sequences' in checkpoint
+    mpnn_done = checkpoint.get('mpnn_done', {}) if checkpoint is not None else {}
+    accepted_per_trajectory[design_name] = sum(mpnn_done.values())
+
+    if resumed:
+        mpnn_sequences = checkpoint['mpnn_sequences']
+    else:
+        ### MPNN redesign of starting binder
+        mpnn_trajectories = mpnn_gen_sequence(trajectory_pdb, binder_chain, trajectory["interface_residues"], advanced_settings)
+
+        # create set of MPNN sequences with allowed amino acid composition
+        restricted_AAs = set(aa.strip().upper() for aa in advanced_settings["omit_AAs"].split(',')) if advanced_settings["force_reject_AA"] else set()
+
+        mpnn_sequences = sorted({
+            mpnn_trajectories['seq'][n][-length:]: {
+                'seq': mpnn_trajectories['seq'][n][-length:],
+                'score': mpnn_trajectories['score'][n],
+                'seqid': mpnn_trajectories['seqid'][n]
+            } for n in range(advanced_settings["num_seqs"])
+            if (not restricted_AAs or not any(aa in mpnn_trajectories['seq'][n][-length:].upper() for aa in restricted_AAs))
+        }.values(), key=lambda x: x['score'])
+
+        # drop sequences that already have statistics from this or earlier trajectories, and near duplicates if an identity threshold is set
+        novel_sequences = sequence_index.novel([x['seq'] for x in mpnn_sequences], advanced_settings["mpnn_max_identity"])
+        mpnn_sequences = [x for x, novel in zip(mpnn_sequences, novel_sequences) if novel]
+
+        if checkpoints is not None:
+            checkpoints.save(design_name, mpnn_sequences=mpnn_sequences)
+
+    # generate mpnn design name numbering, designs whose statistics were already written are skipped when resuming
+    mpnn_designs = [(design_name + "_mpnn" + str(n + 1), x) for n, x in enumerate(mpnn_sequences)]
+    if resumed:
+        novel_sequences = sequence_index.novel([x['seq'] for _, x in mpnn_designs])
+        mpnn_designs = [(name, x) for (name, x), novel in zip(mpnn_designs, novel_sequences) if novel and name not in mpnn_done]
+
+        # models of designs that were in flight when the run stopped have no statistics, remove them so that they are predicted again
+        for mpnn_design_name, _ in mpnn_designs:
+            for folder in ["MPNN", "MPNN/Binder", "MPNN/Relaxed"]:
+                for _, model_pdb in mpnn_model_pdbs(mpnn_design_name, prediction_models, design_paths[folder]):
+                    os.remove(model_pdb)
+
+    # check whether any sequences are left after amino acid rejection and duplication check, and if yes proceed with prediction
+    if mpnn_designs:
+        # add optimisation for increasing recycles if trajectory is beta sheeted
+        if advanced_settings["optimise_beta"] and float(trajectory["beta"]) > 15:
+            advanced_settings["num_recycles_validation"] = advanced_settings["optimise_beta_recycles_valid"]
+
+        ### Compile prediction models once for faster prediction of MPNN sequences, or reuse compiled models from the pool
+        clear_gpu_memory(advanced_settings)
+        complex_prediction_model = get_complex_prediction_model(trajectory_pdb, length, multimer_validation, advanced_settings, target_settings)
+        binder_prediction_model = get_binder_prediction_model(length, multimer_validation, advanced_settings)
+
+        # iterate over designed sequences, in batches that are predicted together
+        batch_size = max(1, advanced_settings["validation_batch_size"])
+        for batch_start in range(0, len(mpnn_designs), batch_size):
+            check_interrupted()
+
+            # if enough mpnn sequences of the same trajectory pass filters then stop
+            if accepted_per_trajectory[design_name] >= advanced_settings["max_mpnn_sequences"]:
+                break
+
+            mpnn_design_names = [name for name, _ in mpnn_designs[batch_start:batch_start+batch_size]]
+            mpnn_batch = [x for _, x in mpnn_designs[batch_start:batch_start+batch_size]]
+            mpnn_time = time.time()
+
+            # save fasta sequences
+            if advanced_settings["save_mpnn_fasta"] is True:
+                for mpnn_design_name, mpnn_sequence in zip(mpnn_design_names, mpnn_batch):
+                    save_fasta(mpnn_design_name, mpnn_sequence['seq'], design_paths)
+
+            ### Predict mpnn redesigned binder complexes using masked templates, relaxation happens in the CPU stage
+            complex_results = predict_binder_complex_batch(complex_prediction_model, [x['seq'] for x in mpnn_batch], mpnn_design_names,
+                                                        target_settings["starting_pdb"], target_settings["chains"],
+                                                        length, trajectory_pdb, prediction_models, advanced_settings,
+                                                        filters, design_paths, failure_csv, relax_models=False)
+            metrics.inc('mpnn_sequences_validated', len(mpnn_batch))
+
+            # if AF2 filters are not passed then skip the scoring
+            passed = []
+            for mpnn_design_name, mpnn_sequence, (mpnn_complex_statistics, pass_af2_filters) in zip(mpnn_design_names, mpnn_batch, complex_results):
+                if pass_af2_filters:
+                    passed.append((mpnn_design_name, mpnn_sequence, mpnn_complex_statistics))
+                else:
+                    print(f"Base AF2 filters not passed for {mpnn_design_name}, skipping interface scoring")
+                    metrics.inc('af2_filter_failures')
+                    if checkpoints is not None:
+                        checkpoints.finish_mpnn_design(design_name, mpnn_design_name, False)
+
+            # with lazy filters, the cheap geometry of the unrelaxed models is analysed and filtered before any binder prediction or relaxation
+            if lazy_filters:
+                geometry_passed = []
+                for mpnn_design_name, mpnn_sequence, mpnn_complex_statistics in passed:
+                    analyse_mpnn_geometry(mpnn_design_name, trajectory_pdb, mpnn_complex_statistics, prediction_models, advanced_settings, target_settings, design_paths, binder_chain)
+                    if unmet_stage_filters(design_filter_values(mpnn_complex_statistics, {}), filters, ['af2', 'geometry']):
+                        reject_lazy_design(trajectory, mpnn_design_name, mpnn_sequence, mpnn_time, mpnn_complex_statistics, {}, "Geometry")
+                    else:
+                        geometry_passed.append((mpnn_design_name, mpnn_sequence, mpnn_complex_statistics))
+                passed = geometry_passed
 
-        # round the metrics to two decimal places
-        trajectory_metrics = {k: round(v, 2) if isinstance(v, float) else v for k, v in trajectory_metrics.items()}
+            if not passed:
+                continue
 
-        # time trajectory
-        trajectory_time = time.time() - trajectory_start_time
-        trajectory_time_text = f"{'%d hours, %d minutes, %d seconds' % (int(trajectory_time // 3600), int((trajectory_time % 3600) // 60), int(trajectory_time % 60))}"
-        print("Starting trajectory took: "+trajectory_time_text)
+            ### Predict binders alone in single sequence mode, with lazy filters only if any binder filter is set
+            if lazy_filters and not binder_filters:
+                binder_results = [{} for _ in passed]
+            else:
+                binder_results = predict_binder_alone_batch(binder_prediction_model, [x[1]['seq'] for x in passed], [x[0] for x in passed], length,
+                                                        trajectory_pdb, binder_chain, prediction_models, advanced_settings, design_paths)
+
+            # relax, score and filter the designs in the CPU stage
+            for (mpnn_design_name, mpnn_sequence, mpnn_complex_statistics), binder_statistics in zip(passed, binder_results):
+                if lazy_filters:
+                    # binder alone filters are checked before relaxation
+                    if binder_filters:
+                        analyse_binder_alone(mpnn_design_name, trajectory_pdb, binder_statistics, prediction_models, advanced_settings, design_paths, binder_chain)
+                        if unmet_stage_filters(design_filter_values(mpnn_complex_statistics, binder_statistics), filters, ['binder']):
+                            reject_lazy_design(trajectory, mpnn_design_name, mpnn_sequence, mpnn_time, mpnn_complex_statistics, binder_statistics, "Binder")
+                            continue
+                    analysis_stages = ("interface",)
+                else:
+                    analysis_stages = ("geometry", "interface", "binder")
+
+                pending_per_trajectory[design_name] += 1
+                cpu_stage.submit("mpnn", mpnn_design_context(trajectory, mpnn_design_name, mpnn_sequence, mpnn_time), analyse_mpnn_design, mpnn_design_name, trajectory_pdb,
+                                mpnn_complex_statistics, binder_statistics, prediction_models, advanced_settings, target_settings, design_paths, binder_chain, analysis_stages)
+                handle_cpu_results(cpu_stage.collect())
+
+        # report accepted designs, only known at this point when running serially
+        if cpu_stage.n_workers == 0:
+            accepted_mpnn = accepted_per_trajectory[design_name]
+            if accepted_mpnn >= 1:
+                print("Found "+str(accepted_mpnn)+" MPNN designs passing filters")
+                print("")
+            else:
+                print("No accepted MPNN designs found for this trajectory.")
+                print("")
+
+    else:
+        print('Duplicate MPNN designs sampled with different trajectory, skipping current trajectory optimisation')
         print("")
 
-        # Proceed if there is no trajectory termination signal
-        if trajectory.aux["log"]["terminate"] == "":
-            # Relax binder to calculate statistics
-            trajectory_relaxed = os.path.join(design_paths["Trajectory/Relaxed"], design_name + ".pdb")
-            pr_relax(trajectory_pdb, trajectory_relaxed)
-
-            # define binder chain, placeholder in case multi-chain parsing in ColabDesign gets changed
-            binder_chain = "B"
-
-            # Calculate clashes before and after relaxation
-            num_clashes_trajectory = calculate_clash_score(trajectory_pdb)
-            num_clashes_relaxed = calculate_clash_score(trajectory_relaxed)
+    # release the trajectory PDB, it is removed once the analyses still running in the CPU stage are done with it
+    pending_per_trajectory[design_name] -= 1
+    release_trajectory(design_name)
 
-            # secondary structure content of starting trajectory binder and interface
-            trajectory_alpha, trajectory_beta, trajectory_loops, trajectory_alpha_interface, trajectory_beta_interface, trajectory_loops_interface, trajectory_i_plddt, trajectory_ss_plddt = calc_ss_percentage(trajectory_pdb, advanced_settings, binder_chain)
+    # measure time it took to generate designs for one trajectory
+    design_time = time.time() - design_start_time
+    design_time_text = f"{'%d hours, %d minutes, %d seconds' % (int(design_time // 3600), int((design_time % 3600) // 60), int(design_time % 60))}"
+    print("Design and validation of trajectory "+design_name+" took: "+design_time_text)
 
-            # analyze interface scores for relaxed af2 trajectory
-            trajectory_interface_scores, trajectory_interface_AA, trajectory_interface_residues = score_interface(trajectory_relaxed, binder_chain)
+    if sampler is not None:
+        sampler.record(length, trajectory["helicity_value"], seconds=design_time)
 
-            # starting binder sequence
-            trajectory_sequence = trajectory.get_seq(get_best=True)[0]
-
-            # analyze sequence
-            traj_seq_notes = validate_design_sequence(trajectory_sequence, num_clashes_relaxed, advanced_settings)
-
-            # target structure RMSD compared to input PDB
-            trajectory_target_rmsd = target_pdb_rmsd(trajectory_pdb, target_settings["starting_pdb"], target_settings["chains"])
-
-            # save trajectory statistics into CSV
-            trajectory_data = [design_name, advanced_settings["design_algorithm"], length, seed, helicity_value, target_settings["target_hotspot_residues"], trajectory_sequence, trajectory_interface_residues, 
-                                trajectory_metrics['plddt'], trajectory_metrics['ptm'], trajectory_metrics['i_ptm'], trajectory_metrics['pae'], trajectory_metrics['i_pae'],
-                                trajectory_i_plddt, trajectory_ss_plddt, num_clashes_trajectory, num_clashes_relaxed, trajectory_interface_scores['binder_score'],
-                                trajectory_interface_scores['surface_hydrophobicity'], trajectory_interface_scores['interface_sc'], trajectory_interface_scores['interface_packstat'],
-                                trajectory_interface_scores['interface_dG'], trajectory_interface_scores['interface_dSASA'], trajectory_interface_scores['interface_dG_SASA_ratio'],
-                                trajectory_interface_scores['interface_fraction'], trajectory_interface_scores['interface_hydrophobicity'], trajectory_interface_scores['interface_nres'], trajectory_interface_scores['interface_interface_hbonds'],
-                                trajectory_interface_scores['interface_hbond_percentage'], trajectory_interface_scores['interface_delta_unsat_hbonds'], trajectory_interface_scores['interface_delta_unsat_hbonds_percentage'],
-                                trajectory_alpha_interface, trajectory_beta_interface, trajectory_loops_interface, trajectory_alpha, trajectory_beta, trajectory_loops, trajectory_interface_AA, trajectory_target_rmsd, 
-                                trajectory_time_text, traj_seq_notes, settings_file, filters_file, advanced_file]
-            insert_data(trajectory_csv, trajectory_data)
-
-            if not trajectory_interface_residues:
-                print("No interface residues found for "+str(design_name)+", skipping MPNN optimization")
-                continue
-            
-            if advanced_settings["enable_mpnn"]:
-                # initialise MPNN counters
-                mpnn_n = 1
-                accepted_mpnn = 0
-                mpnn_dict = {}
-                design_start_time = time.time()
-
-                ### MPNN redesign of starting binder
-                mpnn_trajectories = mpnn_gen_sequence(trajectory_pdb, binder_chain, trajectory_interface_residues, advanced_settings)
-                existing_mpnn_sequences = set(pd.read_csv(mpnn_csv, usecols=['Sequence'])['Sequence'].values)
-
-                # create set of MPNN sequences with allowed amino acid composition
-                restricted_AAs = set(aa.strip().upper() for aa in advanced_settings["omit_AAs"].split(',')) if advanced_settings["force_reject_AA"] else set()
-
-                mpnn_sequences = sorted({
-                    mpnn_trajectories['seq'][n][-length:]: {
-                        'seq': mpnn_trajectories['seq'][n][-length:],
-                        'score': mpnn_trajectories['score'][n],
-                        'seqid': mpnn_trajectories['seqid'][n]
-                    } for n in range(advanced_settings["num_seqs"])
-                    if (not restricted_AAs or not any(aa in mpnn_trajectories['seq'][n][-length:].upper() for aa in restricted_AAs))
-                    and mpnn_trajectories['seq'][n][-length:] not in existing_mpnn_sequences
-                }.values(), key=lambda x: x['score'])
-
-                del existing_mpnn_sequences
-  
-                # check whether any sequences are left after amino acid rejection and duplication check, and if yes proceed with prediction
-                if mpnn_sequences:
-                    # add optimisation for increasing recycles if trajectory is beta sheeted
-                    if advanced_settings["optimise_beta"] and float(trajectory_beta) > 15:
-                        advanced_settings["num_recycles_validation"] = advanced_settings["optimise_beta_recycles_valid"]
-
-                    ### Compile prediction models once for faster prediction of MPNN sequences
-                    clear_mem()
-                    # compile complex prediction model
-                    complex_prediction_model = mk_afdesign_model(protocol="binder", num_recycles=advanced_settings["num_recycles_validation"], data_dir=advanced_settings["af_params_dir"], 
-                                                                use_multimer=multimer_validation, use_initial_guess=advanced_settings["predict_initial_guess"], use_initial_atom_pos=advanced_settings["predict_bigbang"])
-                    if advanced_settings["predict_initial_guess"] or advanced_settings["predict_bigbang"]:
-                        complex_prediction_model.prep_inputs(pdb_filename=trajectory_pdb, chain='A', binder_chain='B', binder_len=length, use_binder_template=True, rm_target_seq=advanced_settings["rm_template_seq_predict"],
-                                                            rm_target_sc=advanced_settings["rm_template_sc_predict"], rm_template_ic=True)
-                    else:
-                        complex_prediction_model.prep_inputs(pdb_filename=target_settings["starting_pdb"], chain=target_settings["chains"], binder_len=length, rm_target_seq=advanced_settings["rm_template_seq_predict"],
-                                                            rm_target_sc=advanced_settings["rm_template_sc_predict"])
-
-                    # compile binder monomer prediction model
-                    binder_prediction_model = mk_afdesign_model(protocol="hallucination", use_templates=False, initial_guess=False, 
-                                                                use_initial_atom_pos=False, num_recycles=advanced_settings["num_recycles_validation"], 
-                                                                data_dir=advanced_settings["af_params_dir"], use_multimer=multimer_validation)
-                    binder_prediction_model.prep_inputs(length=length)
-
-                    # iterate over designed sequences        
-                    for mpnn_sequence in mpnn_sequences:
-                        mpnn_time = time.time()
-
-                        # generate mpnn design name numbering
-                        mpnn_design_name = design_name + "_mpnn" + str(mpnn_n)
-                        mpnn_score = round(mpnn_sequence['score'],2)
-                        mpnn_seqid = round(mpnn_sequence['seqid'],2)
-
-                        # add design to dictionary
-                        mpnn_dict[mpnn_design_name] = {'seq': mpnn_sequence['seq'], 'score': mpnn_score, 'seqid': mpnn_seqid}
-
-                        # save fasta sequence
-                        if advanced_settings["save_mpnn_fasta"] is True:
-                            save_fasta(mpnn_design_name, mpnn_sequence['seq'], design_paths)
-                        
-                        ### Predict mpnn redesigned binder complex using masked templates
-                        mpnn_complex_statistics, pass_af2_filters = predict_binder_complex(complex_prediction_model,
-                                                                                        mpnn_sequence['seq'], mpnn_design_name,
-                                                                                        target_settings["starting_pdb"], target_settings["chains"],
-                                                                                        length, trajectory_pdb, prediction_models, advanced_settings,
-                                                                                        filters, design_paths, failure_csv)
-
-                        # if AF2 filters are not passed then skip the scoring
-                        if not pass_af2_filters:
-                            print(f"Base AF2 filters not passed for {mpnn_design_name}, skipping interface scoring")
-                            mpnn_n += 1
-                            continue
-
-                        # calculate statistics for each model individually
-                        for model_num in prediction_models:
-                            mpnn_design_pdb = os.path.join(design_paths["MPNN"], f"{mpnn_design_name}_model{model_num+1}.pdb")
-                            mpnn_design_relaxed = os.path.join(design_paths["MPNN/Relaxed"], f"{mpnn_design_name}_model{model_num+1}.pdb")
-
-                            if os.path.exists(mpnn_design_pdb):
-                                # Calculate clashes before and after relaxation
-                                num_clashes_mpnn = calculate_clash_score(mpnn_design_pdb)
-                                num_clashes_mpnn_relaxed = calculate_clash_score(mpnn_design_relaxed)
-
-                                # analyze interface scores for relaxed af2 trajectory
-                                mpnn_interface_scores, mpnn_interface_AA, mpnn_interface_residues = score_interface(mpnn_design_relaxed, binder_chain)
-
-                                # secondary structure content of starting trajectory binder
-                                mpnn_alpha, mpnn_beta, mpnn_loops, mpnn_alpha_interface, mpnn_beta_interface, mpnn_loops_interface, mpnn_i_plddt, mpnn_ss_plddt = calc_ss_percentage(mpnn_design_pdb, advanced_settings, binder_chain)
-                                
-                                # unaligned RMSD calculate to determine if binder is in the designed binding site
-                                rmsd_site = unaligned_rmsd(trajectory_pdb, mpnn_design_pdb, binder_chain, binder_chain)
-
-                                # calculate RMSD of target compared to input PDB
-                                target_rmsd = target_pdb_rmsd(mpnn_design_pdb, target_settings["starting_pdb"], target_settings["chains"])
-
-                                # add the additional statistics to the mpnn_complex_statistics dictionary
-                                mpnn_complex_statistics[model_num+1].update({
-                                    'i_pLDDT': mpnn_i_plddt,
-                                    'ss_pLDDT': mpnn_ss_plddt,
-                                    'Unrelaxed_Clashes': num_clashes_mpnn,
-                                    'Relaxed_Clashes': num_clashes_mpnn_relaxed,
-                                    'Binder_Energy_Score': mpnn_interface_scores['binder_score'],
-                                    'Surface_Hydrophobicity': mpnn_interface_scores['surface_hydrophobicity'],
-                                    'ShapeComplementarity': mpnn_interface_scores['interface_sc'],
-                                    'PackStat': mpnn_interface_scores['interface_packstat'],
-                                    'dG': mpnn_interface_scores['interface_dG'],
-                                    'dSASA': mpnn_interface_scores['interface_dSASA'], 
-                                    'dG/dSASA': mpnn_interface_scores['interface_dG_SASA_ratio'],
-                                    'Interface_SASA_%': mpnn_interface_scores['interface_fraction'],
-                                    'Interface_Hydrophobicity': mpnn_interface_scores['interface_hydrophobicity'],
-                                    'n_InterfaceResidues': mpnn_interface_scores['interface_nres'],
-                                    'n_InterfaceHbonds': mpnn_interface_scores['interface_interface_hbonds'],
-                                    'InterfaceHbondsPercentage': mpnn_interface_scores['interface_hbond_percentage'],
-                                    'n_InterfaceUnsatHbonds': mpnn_interface_scores['interface_delta_unsat_hbonds'],
-                                    'InterfaceUnsatHbondsPercentage': mpnn_interface_scores['interface_delta_unsat_hbonds_percentage'],
-                                    'InterfaceAAs': mpnn_interface_AA,
-                                    'Interface_Helix%': mpnn_alpha_interface,
-                                    'Interface_BetaSheet%': mpnn_beta_interface,
-                                    'Interface_Loop%': mpnn_loops_interface,
-                                    'Binder_Helix%': mpnn_alpha,
-                                    'Binder_BetaSheet%': mpnn_beta,
-                                    'Binder_Loop%': mpnn_loops,
-                                    'Hotspot_RMSD': rmsd_site,
-                                    'Target_RMSD': target_rmsd
-                                })
-
-                                # save space by removing unrelaxed predicted mpnn complex pdb?
-                                if advanced_settings["remove_unrelaxed_complex"]:
-                                    os.remove(mpnn_design_pdb)
-
-                        # calculate complex averages
-                        mpnn_complex_averages = calculate_averages(mpnn_complex_statistics, handle_aa=True)
-                        
-                        ### Predict binder alone in single sequence mode
-                        binder_statistics = predict_binder_alone(binder_prediction_model, mpnn_sequence['seq'], mpnn_design_name, length,
-                                                                trajectory_pdb, binder_chain, prediction_models, advanced_settings, design_paths)
-
-                        # extract RMSDs of binder to the original trajectory
-                        for model_num in prediction_models:
-                            mpnn_binder_pdb = os.path.join(design_paths["MPNN/Binder"], f"{mpnn_design_name}_model{model_num+1}.pdb")
-
-                            if os.path.exists(mpnn_binder_pdb):
-                                rmsd_binder = unaligned_rmsd(trajectory_pdb, mpnn_binder_pdb, binder_chain, "A")
-
-                            # append to statistics
-                            binder_statistics[model_num+1].update({
-                                    'Binder_RMSD': rmsd_binder
-                                })
-
-                            # save space by removing binder monomer models?
-                            if advanced_settings["remove_binder_monomer"]:
-                                os.remove(mpnn_binder_pdb)
-
-                        # calculate binder averages
-                        binder_averages = calculate_averages(binder_statistics)
-
-                        # analyze sequence to make sure there are no cysteins and it contains residues that absorb UV for detection
-                        seq_notes = validate_design_sequence(mpnn_sequence['seq'], mpnn_complex_averages.get('Relaxed_Clashes', None), advanced_settings)
-
-                        # measure time to generate design
-                        mpnn_end_time = time.time() - mpnn_time
-                        elapsed_mpnn_text = f"{'%d hours, %d minutes, %d seconds' % (int(mpnn_end_time // 3600), int((mpnn_end_time % 3600) // 60), int(mpnn_end_time % 60))}"
-
-
-                        # Insert statistics about MPNN design into CSV, will return None if corresponding model does note exist
-                        model_numbers = range(1, 6)
-                        statistics_labels = ['pLDDT', 'pTM', 'i_pTM', 'pAE', 'i_pAE', 'i_pLDDT', 'ss_pLDDT', 'Unrelaxed_Clashes', 'Relaxed_Clashes', 'Binder_Energy_Score', 'Surface_Hydrophobicity',
-                                            'ShapeComplementarity', 'PackStat', 'dG', 'dSASA', 'dG/dSASA', 'Interface_SASA_%', 'Interface_Hydrophobicity', 'n_InterfaceResidues', 'n_InterfaceHbonds', 'InterfaceHbondsPercentage',
-                                            'n_InterfaceUnsatHbonds', 'InterfaceUnsatHbondsPercentage', 'Interface_Helix%', 'Interface_BetaSheet%', 'Interface_Loop%', 'Binder_Helix%',
-                                            'Binder_BetaSheet%', 'Binder_Loop%', 'InterfaceAAs', 'Hotspot_RMSD', 'Target_RMSD']
-
-                        # Initialize mpnn_data with the non-statistical data
-                        mpnn_data = [mpnn_design_name, advanced_settings["design_algorithm"], length, seed, helicity_value, target_settings["target_hotspot_residues"], mpnn_sequence['seq'], mpnn_interface_residues, mpnn_score, mpnn_seqid]
-
-                        # Add the statistical data for mpnn_complex
-                        for label in statistics_labels:
-                            mpnn_data.append(mpnn_complex_averages.get(label, None))
-                            for model in model_numbers:
-                                mpnn_data.append(mpnn_complex_statistics.get(model, {}).get(label, None))
-
-                        # Add the statistical data for binder
-                        for label in ['pLDDT', 'pTM', 'pAE', 'Binder_RMSD']:  # These are the labels for binder alone
-                            mpnn_data.append(binder_averages.get(label, None))
-                            for model in model_numbers:
-                                mpnn_data.append(binder_statistics.get(model, {}).get(label, None))
-
-                        # Add the remaining non-statistical data
-                        mpnn_data.extend([elapsed_mpnn_text, seq_notes, settings_file, filters_file, advanced_file])
-
-                        # insert data into csv
-                        insert_data(mpnn_csv, mpnn_data)
-
-                        # find best model number by pLDDT
-                        plddt_values = {i: mpnn_data[i] for i in range(11, 15) if mpnn_data[i] is not None}
-
-                        # Find the key with the highest value
-                        highest_plddt_key = int(max(plddt_values, key=plddt_values.get))
-
-                        # Output the number part of the key
-                        best_model_number = highest_plddt_key - 10
-                        best_model_pdb = os.path.join(design_paths["MPNN/Relaxed"], f"{mpnn_design_name}_model{best_model_number}.pdb")
-
-                        # run design data against filter thresholds
-                        filter_conditions = check_filters(mpnn_data, design_labels, filters)
-                        if filter_conditions == True:
-                            print(mpnn_design_name+" passed all filters")
-                            accepted_mpnn += 1
-                            accepted_designs += 1
-                            
-                            # copy designs to accepted folder
-                            shutil.copy(best_model_pdb, design_paths["Accepted"])
-
-                            # insert data into final csv
-                            final_data = [''] + mpnn_data
-                            insert_data(final_csv, final_data)
-
-                            # copy animation from accepted trajectory
-                            if advanced_settings["save_design_animations"]:
-                                accepted_animation = os.path.join(design_paths["Accepted/Animation"], f"{design_name}.html")
-                                if not os.path.exists(accepted_animation):
-                                    shutil.copy(os.path.join(design_paths["Trajectory/Animation"], f"{design_name}.html"), accepted_animation)
-
-                            # copy plots of accepted trajectory
-                            plot_files = os.listdir(design_paths["Trajectory/Plots"])
-                            plots_to_copy = [f for f in plot_files if f.startswith(design_name) and f.endswith('.png')]
-                            for accepted_plot in plots_to_copy:
-                                source_plot = os.path.join(design_paths["Trajectory/Plots"], accepted_plot)
-                                target_plot = os.path.join(design_paths["Accepted/Plots"], accepted_plot)
-                                if not os.path.exists(target_plot):
-                                    shutil.copy(source_plot, target_plot)
-
-                        else:
-                            print(f"Unmet filter conditions for {mpnn_design_name}")
-                            failure_df = pd.read_csv(failure_csv)
-                            special_prefixes = ('Average_', '1_', '2_', '3_', '4_', '5_')
-                            incremented_columns = set()
-
-                            for column in filter_conditions:
-                                base_column = column
-                                for prefix in special_prefixes:
-                                    if column.startswith(prefix):
-                                        base_column = column.split('_', 1)[1]
-
-                                if base_column not in incremented_columns:
-                                    failure_df[base_column] = failure_df[base_column] + 1
-                                    incremented_columns.add(base_column)
-
-                            failure_df.to_csv(failure_csv, index=False)
-                            shutil.copy(best_model_pdb, design_paths["Rejected"])
-                        
-                        # increase MPNN design number
-                        mpnn_n += 1
-
-                        # if enough mpnn sequences of the same trajectory pass filters then stop
-                        if accepted_mpnn >= advanced_settings["max_mpnn_sequences"]:
-                            break
-
-                    if accepted_mpnn >= 1:
-                        print("Found "+str(accepted_mpnn)+" MPNN designs passing filters")
-                        print("")
-                    else:
-                        print("No accepted MPNN designs found for this trajectory.")
-                        print("")
+### wait for all queued CPU work, optionally running MPNN for trajectories that are still waiting
+def flush_pipeline(run_mpnn):
+    while cpu_stage.pending() or (run_mpnn and ready_trajectories):
+        handle_cpu_results(cpu_stage.drain())
+        while run_mpnn and ready_trajectories:
+            run_mpnn_stage(ready_trajectories.popleft())
 
+####################################
+# initialise counters
+script_start_time = time.time()
+trajectory_n = 1
+accepted_designs = 0
+accepted_per_trajectory = {}
+pending_per_trajectory = {}
+ready_trajectories = deque()
+
+### resume trajectories from checkpoints of an interrupted run, at the stage they reached
+resume_trajectories = deque()
+if checkpoints is not None:
+    for checkpoint in checkpoints.claim(include_running=run_state is None):
+        print("Resuming trajectory "+checkpoint['design_name']+" from checkpoint")
+        if checkpoint['stage'] == 'hallucination':
+            resume_trajectories.append(checkpoint)
+        elif checkpoint['stage'] == 'analysis':
+            context = checkpoint['context']
+            cpu_stage.submit("trajectory", context, analyse_trajectory, context['design_name'], context['trajectory_pdb'], context['sequence'],
+                            advanced_settings, target_settings, design_paths, binder_chain)
+        else:
+            ready_trajectories.append(checkpoint['trajectory'])
+
+### start design loop, SIGTERM stops it after saving the checkpoints
+interrupted = False
+try:
+    # redesign resumed trajectories with MPNN before starting new ones
+    while ready_trajectories:
+        run_mpnn_stage(ready_trajectories.popleft())
+
+    while True:
+        ### stop between trajectories if the job was asked to terminate
+        check_interrupted()
+
+        ### check if we have the target number of binders
+        final_designs_reached = check_accepted_designs(design_paths, mpnn_csv, final_labels, final_csv, advanced_settings, target_settings, design_labels, run_state, results_store, design_index)
+
+        if final_designs_reached:
+            # finish designs still in the CPU stage and rerank if any of them were accepted
+            if cpu_stage.pending():
+                flush_pipeline(run_mpnn=False)
+                check_accepted_designs(design_paths, mpnn_csv, final_labels, final_csv, advanced_settings, target_settings, design_labels, run_state, results_store, design_index)
+            # stop design loop execution
+            break
+
+        ### check if another worker asked to stop
+        if run_state is not None and run_state.stop_requested():
+            print("Stop requested by worker "+run_state.stop_requested()+", stopping execution...")
+            flush_pipeline(run_mpnn=False)
+            break
+
+        ### check if we reached maximum allowed trajectories
+        max_trajectories_reached = check_n_trajectories(design_paths, advanced_settings, run_state, design_index)
+
+        if max_trajectories_reached:
+            flush_pipeline(run_mpnn=True)
+            break
+
+        ### Initialise design
+        # measure time to generate design
+        trajectory_start_time = time.time()
+
+        if resume_trajectories:
+            # continue the hallucination of an interrupted trajectory, it was already claimed by the interrupted run
+            checkpoint = resume_trajectories.popleft()
+            design_name, length, seed, helicity_value = checkpoint['design_name'], checkpoint['length'], checkpoint['seed'], checkpoint['helicity_value']
+            trajectory_exists = False
+        else:
+            # generate random seed to vary designs
+            seed = int(np.random.randint(0, high=999999, size=1, dtype=int)[0])
+
+            if sampler is not None:
+                # sample binder design length and helicity by their yield of accepted designs so far
+                length, helicity_value = sampler.sample()
+            else:
+                # sample binder design length randomly from defined distribution
+                length = sample_binder_length(target_settings, advanced_settings)
+
+                # load desired helicity value to sample different secondary structure contents
+                helicity_value = load_helicity(advanced_settings)
+
+            # generate design name and check if same trajectory was already run
+            design_name = target_settings["binder_name"] + "_l" + str(length) + "_s"+ str(seed)
+            trajectory_dirs = ["Trajectory", "Trajectory/Relaxed", "Trajectory/LowConfidence", "Trajectory/Clashing"]
+            trajectory_exists = any(os.path.exists(os.path.join(design_paths[trajectory_dir], design_name + ".pdb")) for trajectory_dir in trajectory_dirs)
+
+            # claim the trajectory so that no other worker runs the same length and seed
+            if run_state is not None and not trajectory_exists:
+                trajectory_exists = not run_state.claim_trajectory(design_name, length, seed, advanced_settings["max_trajectories"])
+
+        if not trajectory_exists:
+            print("Starting trajectory: "+design_name)
+            metrics.inc('trajectories_started')
+
+            # checkpoint the trajectory and the model state after each design stage
+            trajectory_checkpoint = None
+            if checkpoints is not None:
+                checkpoints.save(design_name, stage='hallucination', length=length, seed=seed, helicity_value=helicity_value)
+                trajectory_checkpoint = checkpoints.trajectory_checkpoint(design_name)
+
+            ### Begin binder hallucination
+            with trace_context(design=design_name, length=length), trace_span("hallucination"):
+                trajectory = binder_hallucination(design_name, target_settings["starting_pdb"], target_settings["chains"],
+                                                    target_settings["target_hotspot_residues"], length, seed, helicity_value,
+                                                    design_models, advanced_settings, design_paths, failure_csv, trajectory_checkpoint)
+            trajectory_metrics = copy_dict(trajectory._tmp["best"]["aux"]["log"]) # contains plddt, ptm, i_ptm, pae, i_pae
+            trajectory_pdb = os.path.join(design_paths["Trajectory"], design_name + ".pdb")
+
+            # round the metrics to two decimal places
+            trajectory_metrics = {k: round(v, 2) if isinstance(v, float) else v for k, v in trajectory_metrics.items()}
+
+            # time trajectory
+            trajectory_time = time.time() - trajectory_start_time
+            trajectory_time_text = f"{'%d hours, %d minutes, %d seconds' % (int(trajectory_time // 3600), int((trajectory_time % 3600) // 60), int(trajectory_time % 60))}"
+            print("Starting trajectory took: "+trajectory_time_text)
+            print("")
+
+            if sampler is not None:
+                sampler.record(length, helicity_value, seconds=trajectory_time)
+
+            if trajectory.aux["log"]["terminate"] != "":
+                metrics.inc('trajectories_terminated', reason=trajectory.aux["log"]["terminate"])
+                if run_state is not None:
+                    run_state.finish_trajectory(design_name, trajectory.aux["log"]["terminate"])
+
+            if checkpoints is not None:
+                trajectory_checkpoint.remove()
+                if trajectory.aux["log"]["terminate"] != "":
+                    checkpoints.remove(design_name)
+
+            # Proceed if there is no trajectory termination signal
+            if trajectory.aux["log"]["terminate"] == "":
+                # starting binder sequence
+                trajectory_sequence = trajectory.get_seq(get_best=True)[0]
+
+                # relax and score the trajectory in the CPU stage while the GPU moves on to the next trajectory
+                trajectory_context = {'design_name': design_name, 'length': length, 'seed': seed, 'helicity_value': helicity_value, 'sequence': trajectory_sequence,
+                                    'trajectory_pdb': trajectory_pdb, 'trajectory_metrics': trajectory_metrics, 'trajectory_time_text': trajectory_time_text}
+                if checkpoints is not None:
+                    checkpoints.save(design_name, stage='analysis', context=trajectory_context)
+                cpu_stage.submit("trajectory", trajectory_context, analyse_trajectory, design_name, trajectory_pdb, trajectory_sequence,
+                                advanced_settings, target_settings, design_paths, binder_chain)
+
+            # process finished CPU work and redesign analysed trajectories with MPNN
+            handle_cpu_results(cpu_stage.collect())
+            while ready_trajectories:
+                run_mpnn_stage(ready_trajectories.popleft())
+
+            # analyse the rejection rate of trajectories to see if we need to readjust the design weights, after trajectories that were not terminated
+            if trajectory.aux["log"]["terminate"] == "" and trajectory_n >= advanced_settings["start_monitoring"] and advanced_settings["enable_rejection_check"]:
+                if run_state is not None:
+                    # acceptance rate across all workers
+                    acceptance = run_state.n_accepted() / max(run_state.n_trajectories(), 1)
                 else:
-                    print('Duplicate MPNN designs sampled with different trajectory, skipping current trajectory optimisation')
-                    print("")
-
-                # save space by removing unrelaxed design trajectory PDB
-                if advanced_settings["remove_unrelaxed_trajectory"]:
-                    os.remove(trajectory_pdb)
-
-                # measure time it took to generate designs for one trajectory
-                design_time = time.time() - design_start_time
-                design_time_text = f"{'%d hours, %d minutes, %d seconds' % (int(design_time // 3600), int((design_time % 3600) // 60), int(design_time % 60))}"
-                print("Design and validation of trajectory "+design_name+" took: "+design_time_text)
-
-            # analyse the rejection rate of trajectories to see if we need to readjust the design weights
-            if trajectory_n >= advanced_settings["start_monitoring"] and advanced_settings["enable_rejection_check"]:
-                acceptance = accepted_designs / trajectory_n
+                    acceptance = accepted_designs / trajectory_n
                 if not acceptance >= advanced_settings["acceptance_rate"]:
                     print("The ratio of successful designs is lower than defined acceptance rate! Consider changing your design settings!")
                     print("Script execution stopping...")
+                    if run_state is not None:
+                        run_state.request_stop("acceptance rate too low")
+                    flush_pipeline(run_mpnn=False)
                     break
 
-        # increase trajectory number
-        trajectory_n += 1
-        gc.collect()
+            # increase trajectory number
+            trajectory_n += 1
+            gc.collect()
+
+except RunInterrupted:
+    print("Run interrupted, saving checkpoints and stopping execution...")
+    interrupted = True
+    if checkpoints is not None:
+        checkpoints.interrupt()
+
+finally:
+    # write remaining failure counts
+    failure_counter.flush()
+
+    # export statistics kept in the results store to the CSV files, also when the run stops on an error
+    export_results([trajectory_csv, mpnn_csv], results_store)
+    if results_store is not None:
+        results_store.close()
+
+cpu_stage.shutdown(cancel_pending=interrupted)
+relax_pool.shutdown()
+metrics.shutdown()
+if run_state is not None:
+    run_state.close()
+
+# export the trace of the design stages for chrome://tracing or Perfetto, with the time spent per stage
+if trace_file is not None:
+    tracer.close()
+    export_chrome_trace(trace_file, os.path.join(target_settings["design_path"], 'trace.json'))
+    summarise_trace(trace_file).to_csv(os.path.join(target_settings["design_path"], 'trace_summary.csv'))
 
 ### Script finished
 elapsed_time = time.time() - script_start_time
 elapsed_text = f"{'%d hours, %d minutes, %d seconds' % (int(elapsed_time // 3600), int((elapsed_time % 3600) // 60), int(elapsed_time % 60))}"
+if interrupted:
+    print("Run interrupted after "+elapsed_text+", rerun the same command to resume")
+    exit(interrupted_exit_code)
 print("Finished all designs. Script execution for "+str(trajectory_n)+" trajectories took: "+elapsed_text)
@@ -3,15 +3,27 @@ import argparse
 import pickle
 import warnings
 import zipfile
+from collections import deque
 import numpy as np
 import pandas as pd
 import math, random
 import matplotlib.pyplot as plt
 
+from .pdb_utils import *
+from .geometry_utils import *
+from .dssp_utils import *
+from .trace_utils import *
+from .checkpoint_utils import *
 from .pyrosetta_utils import *
 from .colabdesign_utils import *
 from .biopython_utils import *
 from .generic_utils import *
+from .filter_utils import *
+from .pipeline_utils import *
+from .runstate_utils import *
+from .results_utils import *
+from .sampler_utils import *
+from .metrics_utils import *
 
 # suppress warnings
 #os.environ["SLURM_STEP_NODELIST"] = os.environ["SLURM_NODELIST"]
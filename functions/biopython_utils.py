@@ -9,16 +9,21 @@ from collections import defaultdict
 from scipy.spatial import cKDTree
 from Bio import BiopythonWarning
 from Bio.PDB import PDBParser, DSSP, Selection, Polypeptide, PDBIO, Select, Chain, Superimposer
+from Bio.PDB.PDBExceptions import PDBException
 from Bio.SeqUtils.ProtParam import ProteinAnalysis
 from Bio.PDB.Selection import unfold_entities
 from Bio.PDB.Polypeptide import is_aa
+from .pdb_utils import read_pdb_atoms, write_pdb_atoms
+from .dssp_utils import assign_secondary_structure
+from .geometry_utils import count_clashes, contact_residues, batch_count_clashes, batch_contact_residues, kabsch_superimpose, batch_rmsd, batch_superimposed_rmsd
+from .trace_utils import trace_span
 
 # analyze sequence composition of design
 def validate_design_sequence(sequence, num_clashes, advanced_settings):
     note_array = []
 
     # Check if protein contains clashes after relaxation
-    if num_clashes > 0:
+    if num_clashes is not None and num_clashes > 0:
         note_array.append('Relaxed structure contains clashes.')
 
     # Check if the sequence contains disallowed amino acids
@@ -45,88 +50,6 @@ def validate_design_sequence(sequence, num_clashes, advanced_settings):
 
     return notes
 
-# temporary function, calculate RMSD of input PDB and trajectory target
-def target_pdb_rmsd(trajectory_pdb, starting_pdb, chain_ids_string):
-    # Parse the PDB files
-    parser = PDBParser(QUIET=True)
-    structure_trajectory = parser.get_structure('trajectory', trajectory_pdb)
-    structure_starting = parser.get_structure('starting', starting_pdb)
-    
-    # Extract chain A from trajectory_pdb
-    chain_trajectory = structure_trajectory[0]['A']
-    
-    # Extract the specified chains from starting_pdb
-    chain_ids = chain_ids_string.split(',')
-    residues_starting = []
-    for chain_id in chain_ids:
-        chain_id = chain_id.strip()
-        chain = structure_starting[0][chain_id]
-        for residue in chain:
-            if is_aa(residue, standard=True):
-                residues_starting.append(residue)
-    
-    # Extract residues from chain A in trajectory_pdb
-    residues_trajectory = [residue for residue in chain_trajectory if is_aa(residue, standard=True)]
-    
-    # Ensure that both structures have the same number of residues
-    min_length = min(len(residues_starting), len(residues_trajectory))
-    residues_starting = residues_starting[:min_length]
-    residues_trajectory = residues_trajectory[:min_length]
-    
-    # Collect CA atoms from the two sets of residues
-    atoms_starting = [residue['CA'] for residue in residues_starting if 'CA' in residue]
-    atoms_trajectory = [residue['CA'] for residue in residues_trajectory if 'CA' in residue]
-    
-    # Calculate RMSD using structural alignment
-    sup = Superimposer()
-    sup.set_atoms(atoms_starting, atoms_trajectory)
-    rmsd = sup.rms
-    
-    return round(rmsd, 2)
-
-# detect C alpha clashes for deformed trajectories
-def calculate_clash_score(pdb_file, threshold=2.4, only_ca=False):
-    parser = PDBParser(QUIET=True)
-    structure = parser.get_structure('protein', pdb_file)
-
-    atoms = []
-    atom_info = []  # Detailed atom info for debugging and processing
-
-    for model in structure:
-        for chain in model:
-            for residue in chain:
-                for atom in residue:
-                    if atom.element == 'H':  # Skip hydrogen atoms
-                        continue
-                    if only_ca and atom.get_name() != 'CA':
-                        continue
-                    atoms.append(atom.coord)
-                    atom_info.append((chain.id, residue.id[1], atom.get_name(), atom.coord))
-
-    tree = cKDTree(atoms)
-    pairs = tree.query_pairs(threshold)
-
-    valid_pairs = set()
-    for (i, j) in pairs:
-        chain_i, res_i, name_i, coord_i = atom_info[i]
-        chain_j, res_j, name_j, coord_j = atom_info[j]
-
-        # Exclude clashes within the same residue
-        if chain_i == chain_j and res_i == res_j:
-            continue
-
-        # Exclude directly sequential residues in the same chain for all atoms
-        if chain_i == chain_j and abs(res_i - res_j) == 1:
-            continue
-
-        # If calculating sidechain clashes, only consider clashes between different chains
-        if not only_ca and chain_i == chain_j:
-            continue
-
-        valid_pairs.add((i, j))
-
-    return len(valid_pairs)
-
 three_to_one_map = {
     'ALA': 'A', 'CYS': 'C', 'ASP': 'D', 'GLU': 'E', 'PHE': 'F',
     'GLY': 'G', 'HIS': 'H', 'ILE': 'I', 'LYS': 'K', 'LEU': 'L',
@@ -134,99 +57,360 @@ three_to_one_map = {
     'SER': 'S', 'THR': 'T', 'VAL': 'V', 'TRP': 'W', 'TYR': 'Y'
 }
 
-# identify interacting residues at the binder interface
-def hotspot_residues(trajectory_pdb, binder_chain="B", atom_distance_cutoff=4.0):
-    # Parse the PDB file
-    parser = PDBParser(QUIET=True)
-    structure = parser.get_structure("complex", trajectory_pdb)
-
-    # Get the specified chain
-    binder_atoms = Selection.unfold_entities(structure[0][binder_chain], 'A')
-    binder_coords = np.array([atom.coord for atom in binder_atoms])
-
-    # Get atoms and coords for the target chain
-    target_atoms = Selection.unfold_entities(structure[0]['A'], 'A')
-    target_coords = np.array([atom.coord for atom in target_atoms])
-
-    # Build KD trees for both chains
-    binder_tree = cKDTree(binder_coords)
-    target_tree = cKDTree(target_coords)
-
-    # Prepare to collect interacting residues
-    interacting_residues = {}
+# PDB parsed once into atom arrays, all structure analyses of a design are calculated from the same parse
+class StructureAnalysis:
+    def __init__(self, pdb_file, atoms=None):
+        self.pdb_file = pdb_file
+        self._structure = None
+
+        # per atom arrays over all models, residues are numbered by their sequence number as in Biopython residue.id[1],
+        # atom records that are already in memory, e.g. of a relaxed pose, can be passed instead of reading the file
+        if atoms is None:
+            atoms = read_pdb_atoms(pdb_file)
+        self.atoms = atoms
+        self.model_index = atoms['model']
+        self.chain_ids = atoms['chain']
+        self.res_ids = atoms['resseq']
+        self.res_names = atoms['resname']
+        self.icodes = atoms['icode']
+        self.atom_names = atoms['name']
+        self.elements = atoms['element']
+        self.coords = atoms['coord'].astype(float)
+        self.bfactors = atoms['bfactor'].astype(float)
+        self.chain_index = np.unique(self.chain_ids, return_inverse=True)[1]
+
+        self._hotspots = {}
+        self._residues = None
+
+    # atoms used for clash detection, heavy atoms or only C alpha atoms
+    def clash_atoms(self, only_ca=False):
+        selection = self.elements != 'H'
+        if only_ca:
+            selection &= self.atom_names == 'CA'
+        return np.flatnonzero(selection)
+
+    # number of clashing heavy atoms between chains, or of clashing C alpha atoms within and between chains
+    def clash_score(self, threshold=2.4, only_ca=False):
+        index = self.clash_atoms(only_ca)
+        return count_clashes(self.coords[index], self.chain_index[index], self.res_ids[index], threshold, inter_chain_only=not only_ca)
+
+    # binder residues with any atom within the cutoff of an atom of target chain A, as {residue number: one letter code}
+    def hotspot_residues(self, binder_chain="B", atom_distance_cutoff=4.0):
+        key = (binder_chain, atom_distance_cutoff)
+        if key not in self._hotspots:
+            binder_index, target_index = self.interface_atoms(binder_chain)
+            residues = contact_residues(self.coords[binder_index], self.res_ids[binder_index], self.coords[target_index], atom_distance_cutoff)
+            self._hotspots[key] = self.residue_letters(binder_index, residues)
+
+        return dict(self._hotspots[key])
+
+    # atoms of the binder chain and of target chain A in the first model
+    def interface_atoms(self, binder_chain="B"):
+        first_model = self.model_index == 0
+        binder_index = np.flatnonzero(first_model & (self.chain_ids == binder_chain))
+        target_index = np.flatnonzero(first_model & (self.chain_ids == 'A'))
+        return binder_index, target_index
+
+    # {residue number: one letter code} of the given residues of a chain, skipping non-standard residues
+    def residue_letters(self, chain_atoms, residues):
+        res_ids, first = np.unique(self.res_ids[chain_atoms], return_index=True)
+        res_names = dict(zip(res_ids, self.res_names[chain_atoms][first]))
+        return {int(res_id): three_to_one_map[res_names[res_id]] for res_id in residues if res_names[res_id] in three_to_one_map}
+
+    # Biopython structure, only parsed for analyses that need it
+    @property
+    def model(self):
+        if self._structure is None:
+            parser = PDBParser(QUIET=True)
+            self._structure = parser.get_structure('protein', self.pdb_file)
+        return self._structure[0]
+
+    # residues of the first model in file order: chain, residue number, residue name, mean B-factor and backbone coordinates
+    def residues(self):
+        if self._residues is None:
+            first = np.flatnonzero(self.model_index == 0)
+            chains, res_ids, icodes = self.chain_ids[first], self.res_ids[first], self.icodes[first]
+            new_residue = np.concatenate([[True], (chains[1:] != chains[:-1]) | (res_ids[1:] != res_ids[:-1]) | (icodes[1:] != icodes[:-1])])
+            residue_of_atom = np.cumsum(new_residue) - 1
+            starts = np.flatnonzero(new_residue)
+            n_residues = len(starts)
+
+            backbone = {}
+            for name in ['N', 'CA', 'C', 'O']:
+                coords = np.full((n_residues, 3), np.nan)
+                atoms = first[self.atom_names[first] == name]
+                # keep the first atom of each name in a residue
+                residue, index = np.unique(residue_of_atom[self.atom_names[first] == name], return_index=True)
+                coords[residue] = self.coords[atoms[index]]
+                backbone[name] = coords
+
+            self._residues = {
+                'chain': chains[starts],
+                'res_id': res_ids[starts],
+                'res_name': self.res_names[first][starts],
+                'plddt': np.bincount(residue_of_atom, weights=self.bfactors[first]) / np.bincount(residue_of_atom),
+                'backbone': backbone,
+            }
+
+        return self._residues
+
+    # DSSP secondary structure of the first model as {(chain, residue number): letter}, assigned in-process
+    # from the backbone or, if use_dssp_binary is set, by the DSSP executable
+    def secondary_structure(self, advanced_settings):
+        with trace_span("dssp"):
+            if advanced_settings["use_dssp_binary"]:
+                dssp = DSSP(self.model, self.pdb_file, dssp=advanced_settings["dssp_path"])
+                return {(key[0], key[1][1]): dssp[key][2] for key in dssp.keys()}
+
+            residues = self.residues()
+            backbone = residues['backbone']
+
+            # like DSSP, only residues with a complete backbone are assigned
+            complete = np.all([~np.isnan(backbone[name][:, 0]) for name in ['N', 'CA', 'C', 'O']], axis=0)
+            ss = assign_secondary_structure(*[backbone[name][complete] for name in ['N', 'CA', 'C', 'O']],
+                                            residues['chain'][complete], residues['res_name'][complete] == 'PRO')
+            return {(chain, int(res_id)): letter for chain, res_id, letter in zip(residues['chain'][complete], residues['res_id'][complete], ss)}
+
+    # secondary structure, interface secondary structure and pLDDT of the binder
+    def ss_percentage(self, advanced_settings, chain_id="B", atom_distance_cutoff=4.0):
+        # Calculate DSSP for the model
+        dssp = self.secondary_structure(advanced_settings)
+
+        # Prepare to count residues
+        ss_counts = defaultdict(int)
+        ss_interface_counts = defaultdict(int)
+        plddts_interface = []
+        plddts_ss = []
+
+        # Get chain and interacting residues once
+        residues = self.residues()
+        interacting_residues = set(self.hotspot_residues(chain_id, atom_distance_cutoff).keys())
+
+        for residue_id, avg_plddt_residue in zip(residues['res_id'][residues['chain'] == chain_id], residues['plddt'][residues['chain'] == chain_id]):
+            if (chain_id, residue_id) in dssp:
+                ss = dssp[(chain_id, residue_id)]  # Get the secondary structure
+                ss_type = 'loop'
+                if ss in ['H', 'G', 'I']:
+                    ss_type = 'helix'
+                elif ss == 'E':
+                    ss_type = 'sheet'
+
+                ss_counts[ss_type] += 1
+
+                if ss_type != 'loop':
+                    # calculate secondary structure normalised pLDDT
+                    plddts_ss.append(avg_plddt_residue)
+
+                if residue_id in interacting_residues:
+                    ss_interface_counts[ss_type] += 1
+
+                    # calculate interface pLDDT
+                    plddts_interface.append(avg_plddt_residue)
+
+        # Calculate percentages
+        total_residues = sum(ss_counts.values())
+        total_interface_residues = sum(ss_interface_counts.values())
+
+        percentages = calculate_percentages(total_residues, ss_counts['helix'], ss_counts['sheet'])
+        interface_percentages = calculate_percentages(total_interface_residues, ss_interface_counts['helix'], ss_interface_counts['sheet'])
+
+        i_plddt = round(sum(plddts_interface) / len(plddts_interface) / 100, 2) if plddts_interface else 0
+        ss_plddt = round(sum(plddts_ss) / len(plddts_ss) / 100, 2) if plddts_ss else 0
+
+        return (*percentages, *interface_percentages, i_plddt, ss_plddt)
+
+    # C alpha coordinates of the standard amino acid residues of the given chains, NaN for residues without C alpha
+    def standard_ca(self, chain_ids):
+        residues = self.residues()
+        standard = np.isin(residues['res_name'], list(three_to_one_map))
+        selected = np.concatenate([np.flatnonzero(standard & (residues['chain'] == chain_id)) for chain_id in chain_ids])
+        return residues['backbone']['CA'][selected]
+
+    # atom indices of a chain in the first model
+    def chain_atoms(self, chain_id):
+        return np.flatnonzero((self.model_index == 0) & (self.chain_ids == chain_id))
+
+    # C alpha coordinates of a chain in the first model
+    def chain_ca(self, chain_id):
+        index = self.chain_atoms(chain_id)
+        return self.coords[index[self.atom_names[index] == 'CA']]
+
+    # heavy atom coordinates of comma separated chains keyed by 'residue position:atom name', as matched by PyRosetta's RMSDMetric,
+    # PyRosetta builds a C-terminal OXT when loading a PDB without one, it is placed by mirroring the carbonyl oxygen across the CA-C axis
+    def chain_heavy_atoms(self, chain_ids):
+        keys, coords, n_residues = [], [], 0
+        for chain_id in chain_ids.split(','):
+            index = self.chain_atoms(chain_id.strip())
+            index = index[self.elements[index] != 'H']
+            if len(index) == 0:
+                continue
+
+            res_ids, icodes = self.res_ids[index], self.icodes[index]
+            position = n_residues + np.cumsum(np.concatenate([[True], (res_ids[1:] != res_ids[:-1]) | (icodes[1:] != icodes[:-1])])) - 1
+            names, chain_coords = self.atom_names[index], self.coords[index]
+            n_residues = position[-1] + 1
+
+            last = dict(zip(names[position == position[-1]], chain_coords[position == position[-1]]))
+            if 'OXT' not in last and all(name in last for name in ['CA', 'C', 'O']):
+                axis = (last['C'] - last['CA']) / np.linalg.norm(last['C'] - last['CA'])
+                carbonyl = last['O'] - last['C']
+                position = np.append(position, position[-1])
+                names = np.append(names, 'OXT')
+                chain_coords = np.vstack([chain_coords, last['C'] + 2 * np.dot(carbonyl, axis) * axis - carbonyl])
+
+            keys.append(np.char.add(np.char.add(position.astype(str), ':'), names.astype(str)))
+            coords.append(chain_coords)
+
+        if not keys:
+            return np.zeros(0, dtype=str), np.zeros((0, 3))
+        return np.concatenate(keys), np.concatenate(coords)
+
+    # superimposed C alpha RMSD of target chain A to the target chains of the starting structure
+    def target_rmsd(self, starting_structure, chain_ids_string):
+        return TargetReference(starting_structure, chain_ids_string).rmsd(self)
+
+# C alpha atoms of the target chains of the starting structure, parsed once per run and shared by all target RMSD calculations
+class TargetReference:
+    def __init__(self, starting_pdb, chain_ids_string):
+        self.chain_ids = [chain_id.strip() for chain_id in chain_ids_string.split(',')]
+        self.ca_coords = load_structure(starting_pdb).standard_ca(self.chain_ids)
+
+    # matched C alpha coordinates of the reference and of target chain A, residues are paired in order
+    def matched_atoms(self, structure):
+        ca_coords = structure.standard_ca(['A'])
+        min_length = min(len(self.ca_coords), len(ca_coords))
+        reference, ca_coords = self.ca_coords[:min_length], ca_coords[:min_length]
+        reference, ca_coords = reference[~np.isnan(reference[:, 0])], ca_coords[~np.isnan(ca_coords[:, 0])]
+        if len(reference) != len(ca_coords):
+            raise PDBException("Fixed and moving atom lists differ in size")
+        return reference, ca_coords
+
+    # superimposed C alpha RMSD of target chain A of the structure to the reference
+    def rmsd(self, structure):
+        return self.batch_rmsd([structure])[0]
+
+    # target RMSDs of several structures, superimposed in one batch if they are matched to the same reference atoms
+    def batch_rmsd(self, structures):
+        matched = [self.matched_atoms(load_structure(structure)) for structure in structures]
+        if not matched:
+            return []
+        if all(np.array_equal(reference, matched[0][0]) for reference, _ in matched):
+            rmsds = batch_superimposed_rmsd(matched[0][0], np.stack([ca_coords for _, ca_coords in matched]))
+        else:
+            rmsds = [batch_superimposed_rmsd(reference, ca_coords[None])[0] for reference, ca_coords in matched]
+        return [round(float(rmsd), 2) for rmsd in rmsds]
+
+target_references = {}
+
+def get_target_reference(starting_pdb, chain_ids_string):
+    key = (starting_pdb, chain_ids_string)
+    if key not in target_references:
+        target_references[key] = TargetReference(starting_pdb, chain_ids_string)
+    return target_references[key]
+
+# superimpose the given chain of align_pdb onto the reference chain by C alpha atoms and overwrite align_pdb with the moved structure
+def align_pdbs(reference_pdb, align_pdb, reference_chain_id, align_chain_id):
+    batch_align_pdbs(reference_pdb, [align_pdb], reference_chain_id, align_chain_id)
+
+# align several PDBs, e.g. all prediction models of a design, onto the same reference in one batch
+def batch_align_pdbs(reference_pdb, align_pdb_files, reference_chain_id, align_chain_id):
+    if not align_pdb_files:
+        return
+
+    # If the chain IDs contain commas, split them and only take the first value
+    reference_chain_id = reference_chain_id.split(',')[0]
+    align_chain_id = align_chain_id.split(',')[0]
+
+    reference_ca = load_structure(reference_pdb).chain_ca(reference_chain_id)
+    structures = [StructureAnalysis(align_pdb) for align_pdb in align_pdb_files]
+    align_ca = [structure.chain_ca(align_chain_id) for structure in structures]
+    if any(len(ca) != len(reference_ca) for ca in align_ca):
+        raise ValueError(f"Chain {align_chain_id} and reference chain {reference_chain_id} have different numbers of residues")
+
+    rot, tran = kabsch_superimpose(reference_ca, np.stack(align_ca))
+    for structure, align_pdb, structure_rot, structure_tran in zip(structures, align_pdb_files, rot, tran):
+        atoms = structure.atoms.copy()
+        atoms['coord'] = structure.coords @ structure_rot + structure_tran
+        write_pdb_atoms(atoms, align_pdb)
+
+# calculate the rmsd without alignment
+def unaligned_rmsd(reference_pdb, align_pdb, reference_chain_id, align_chain_id):
+    return batch_unaligned_rmsd(reference_pdb, [align_pdb], reference_chain_id, align_chain_id)[0]
+
+# heavy atom RMSDs of the chain of several PDBs to the reference chain without alignment, atoms are matched by residue position and name
+def batch_unaligned_rmsd(reference_pdb, align_pdb_files, reference_chain_id, align_chain_id):
+    with trace_span("unaligned_rmsd"):
+        reference_keys, reference_coords = load_structure(reference_pdb).chain_heavy_atoms(reference_chain_id)
+
+        matched = []
+        for align_pdb in align_pdb_files:
+            keys, coords = load_structure(align_pdb).chain_heavy_atoms(align_chain_id)
+            _, reference_index, index = np.intersect1d(reference_keys, keys, return_indices=True)
+            matched.append((reference_index, coords[index]))
+
+        if matched and all(np.array_equal(reference_index, matched[0][0]) for reference_index, _ in matched):
+            rmsds = batch_rmsd(reference_coords[matched[0][0]], np.stack([coords for _, coords in matched]))
+        else:
+            rmsds = [batch_rmsd(reference_coords[reference_index], coords[None])[0] for reference_index, coords in matched]
+        return [round(float(rmsd), 2) for rmsd in rmsds]
+
+# parse a PDB file, structures that are already parsed are passed through
+def load_structure(pdb_file):
+    if isinstance(pdb_file, StructureAnalysis):
+        return pdb_file
+    return StructureAnalysis(pdb_file)
+
+# whether structures have the same atoms in the same order, e.g. the models predicted for one sequence
+def same_atoms(structures):
+    first = structures[0]
+    return all(len(s.atom_names) == len(first.atom_names) and (s.chain_ids == first.chain_ids).all() and (s.res_ids == first.res_ids).all()
+            and (s.atom_names == first.atom_names).all() and (s.elements == first.elements).all() for s in structures[1:])
+
+# clash scores of several structures, computed in one batch if they have the same atoms
+def batch_clash_scores(structures, threshold=2.4, only_ca=False):
+    if not structures or not same_atoms(structures):
+        return [structure.clash_score(threshold, only_ca) for structure in structures]
+
+    index = structures[0].clash_atoms(only_ca)
+    coords_batch = np.stack([structure.coords[index] for structure in structures])
+    return [int(n) for n in batch_count_clashes(coords_batch, structures[0].chain_index[index], structures[0].res_ids[index], threshold, inter_chain_only=not only_ca)]
+
+# interface residues of several structures, computed in one batch if they have the same atoms
+def batch_hotspot_residues(structures, binder_chain="B", atom_distance_cutoff=4.0):
+    if not structures or not same_atoms(structures):
+        return [structure.hotspot_residues(binder_chain, atom_distance_cutoff) for structure in structures]
+
+    binder_index, target_index = structures[0].interface_atoms(binder_chain)
+    coords_batch = np.stack([structure.coords for structure in structures])
+    residues_batch = batch_contact_residues(coords_batch, binder_index, structures[0].res_ids[binder_index], target_index, atom_distance_cutoff)
+
+    results = []
+    for structure, residues in zip(structures, residues_batch):
+        structure._hotspots[(binder_chain, atom_distance_cutoff)] = structure.residue_letters(binder_index, residues)
+        results.append(dict(structure._hotspots[(binder_chain, atom_distance_cutoff)]))
+    return results
 
-    # Query the tree for pairs of atoms within the distance cutoff
-    pairs = binder_tree.query_ball_tree(target_tree, atom_distance_cutoff)
+# temporary function, calculate RMSD of input PDB and trajectory target
+def target_pdb_rmsd(trajectory_pdb, starting_pdb, chain_ids_string):
+    with trace_span("target_rmsd"):
+        return get_target_reference(starting_pdb, chain_ids_string).rmsd(load_structure(trajectory_pdb))
 
-    # Process each binder atom's interactions
-    for binder_idx, close_indices in enumerate(pairs):
-        binder_residue = binder_atoms[binder_idx].get_parent()
-        binder_resname = binder_residue.get_resname()
+# target RMSDs of several predicted models to the input PDB
+def batch_target_rmsd(structures, starting_pdb, chain_ids_string):
+    with trace_span("target_rmsd"):
+        return get_target_reference(starting_pdb, chain_ids_string).batch_rmsd(structures)
 
-        # Convert three-letter code to single-letter code using the manual dictionary
-        if binder_resname in three_to_one_map:
-            aa_single_letter = three_to_one_map[binder_resname]
-            for close_idx in close_indices:
-                target_residue = target_atoms[close_idx].get_parent()
-                interacting_residues[binder_residue.id[1]] = aa_single_letter
+# detect C alpha clashes for deformed trajectories
+def calculate_clash_score(pdb_file, threshold=2.4, only_ca=False):
+    return load_structure(pdb_file).clash_score(threshold, only_ca)
 
-    return interacting_residues
+# identify interacting residues at the binder interface
+def hotspot_residues(trajectory_pdb, binder_chain="B", atom_distance_cutoff=4.0):
+    return load_structure(trajectory_pdb).hotspot_residues(binder_chain, atom_distance_cutoff)
 
 # calculate secondary structure percentage of design
 def calc_ss_percentage(pdb_file, advanced_settings, chain_id="B", atom_distance_cutoff=4.0):
-    # Parse the structure
-    parser = PDBParser(QUIET=True)
-    structure = parser.get_structure('protein', pdb_file)
-    model = structure[0]  # Consider only the first model in the structure
-
-    # Calculate DSSP for the model
-    dssp = DSSP(model, pdb_file, dssp=advanced_settings["dssp_path"])
-
-    # Prepare to count residues
-    ss_counts = defaultdict(int)
-    ss_interface_counts = defaultdict(int)
-    plddts_interface = []
-    plddts_ss = []
-
-    # Get chain and interacting residues once
-    chain = model[chain_id]
-    interacting_residues = set(hotspot_residues(pdb_file, chain_id, atom_distance_cutoff).keys())
-
-    for residue in chain:
-        residue_id = residue.id[1]
-        if (chain_id, residue_id) in dssp:
-            ss = dssp[(chain_id, residue_id)][2]  # Get the secondary structure
-            ss_type = 'loop'
-            if ss in ['H', 'G', 'I']:
-                ss_type = 'helix'
-            elif ss == 'E':
-                ss_type = 'sheet'
-
-            ss_counts[ss_type] += 1
-
-            if ss_type != 'loop':
-                # calculate secondary structure normalised pLDDT
-                avg_plddt_ss = sum(atom.bfactor for atom in residue) / len(residue)
-                plddts_ss.append(avg_plddt_ss)
-
-            if residue_id in interacting_residues:
-                ss_interface_counts[ss_type] += 1
-
-                # calculate interface pLDDT
-                avg_plddt_residue = sum(atom.bfactor for atom in residue) / len(residue)
-                plddts_interface.append(avg_plddt_residue)
-
-    # Calculate percentages
-    total_residues = sum(ss_counts.values())
-    total_interface_residues = sum(ss_interface_counts.values())
-
-    percentages = calculate_percentages(total_residues, ss_counts['helix'], ss_counts['sheet'])
-    interface_percentages = calculate_percentages(total_interface_residues, ss_interface_counts['helix'], ss_interface_counts['sheet'])
-
-    i_plddt = round(sum(plddts_interface) / len(plddts_interface) / 100, 2) if plddts_interface else 0
-    ss_plddt = round(sum(plddts_ss) / len(plddts_ss) / 100, 2) if plddts_ss else 0
-
-    return (*percentages, *interface_percentages, i_plddt, ss_plddt)
+    return load_structure(pdb_file).ss_percentage(advanced_settings, chain_id, atom_distance_cutoff)
 
 def calculate_percentages(total, helix, sheet):
     helix_percentage = round((helix / total) * 100,2) if total > 0 else 0
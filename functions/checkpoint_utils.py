@@ -0,0 +1,175 @@
+####################################
+################ Checkpoint functions
+####################################
+### Import dependencies
+import os
+import json
+import pickle
+import signal
+import numpy as np
+import jax
+from .generic_utils import file_lock
+
+# raised in the main process when the job is terminated, e.g. by a scheduler preempting it or at its time limit
+class RunInterrupted(Exception):
+    pass
+
+# exit code of an interrupted run, as for a process killed by SIGTERM
+interrupted_exit_code = 128 + signal.SIGTERM
+
+# set by SIGTERM, the run is stopped at the next stage boundary so that no results or counts are left half written
+_interrupt_requested = False
+
+def _request_interrupt(signum, frame):
+    global _interrupt_requested
+    _interrupt_requested = True
+
+# install after worker pools are forked so that workers keep their own handler
+def install_sigterm_handler():
+    signal.signal(signal.SIGTERM, _request_interrupt)
+
+# raise RunInterrupted at a stage boundary if the job was asked to terminate
+def check_interrupted():
+    if _interrupt_requested:
+        raise RunInterrupted()
+
+# write a file in one step, an interrupted write leaves the previous checkpoint in place
+def _replace_file(path, data, mode='w'):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+# hallucination model state saved after each design stage of a trajectory, values computed between stages are saved with it
+class TrajectoryCheckpoint:
+    stages = ['logits', 'logits_extra', 'softmax', 'onehot', 'greedy']
+
+    def __init__(self, state_file=None):
+        self.state_file = state_file
+        self.stage = None
+        self.values = {}
+        self.state = None
+
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file, 'rb') as f:
+                self.state = pickle.load(f)
+            self.stage = self.state['stage']
+            self.values = self.state['values']
+
+    # whether the stage was finished before the run was interrupted
+    def completed(self, stage):
+        return self.stage is not None and self.stages.index(stage) <= self.stages.index(self.stage)
+
+    # restore the model to the end of the last finished stage, inputs have to be prepared first
+    def restore(self, af_model):
+        if self.state is None:
+            return
+        af_model._params = self.state['params']
+        if self.state['optimizer_state'] is not None:
+            af_model._state = self.state['optimizer_state']
+        af_model._tmp = self.state['tmp']
+        af_model._k = self.state['k']
+        af_model.aux = self.state['aux']
+        np.random.set_state(self.state['numpy_random'])
+        key_holder = getattr(af_model.key, '__self__', None)
+        if self.state['key'] is not None and key_holder is not None:
+            key_holder.key = self.state['key']
+        print(f"Resuming trajectory after design stage {self.stage}")
+
+    # save the model after a finished stage, with values such as the best pLDDT used to decide on the next stages,
+    # and stop there if the job was asked to terminate
+    def save(self, af_model, stage, **values):
+        self.stage = stage
+        self.values.update(values)
+        if self.state_file is None:
+            check_interrupted()
+            return
+
+        key_holder = getattr(af_model.key, '__self__', None)
+        state = {
+            'stage': stage,
+            'values': self.values,
+            'params': jax.device_get(af_model._params),
+            'optimizer_state': jax.device_get(getattr(af_model, '_state', None)),
+            'tmp': jax.device_get(af_model._tmp),
+            'k': af_model._k,
+            'aux': jax.device_get(af_model.aux),
+            'numpy_random': np.random.get_state(),
+            'key': jax.device_get(key_holder.key) if key_holder is not None else None
+        }
+        _replace_file(self.state_file, pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), 'wb')
+        check_interrupted()
+
+    def remove(self):
+        if self.state_file is not None and os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        self.state = None
+
+# checkpoints of the trajectories a run is working on, one JSON file per trajectory in design_path/Checkpoints with the stage it reached:
+# hallucination, analysis of the hallucinated trajectory or MPNN redesign, the hallucination model state is kept next to it
+class CheckpointStore:
+    def __init__(self, design_path, worker_id):
+        self.folder = os.path.join(design_path, 'Checkpoints')
+        self.worker_id = worker_id
+        self.checkpoints = {}
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _path(self, design_name, extension):
+        return os.path.join(self.folder, design_name + extension)
+
+    def _write(self, design_name):
+        _replace_file(self._path(design_name, '.json'), json.dumps(self.checkpoints[design_name], default=_json_value))
+
+    # update the checkpoint of a trajectory, creating it if needed
+    def save(self, design_name, **fields):
+        checkpoint = self.checkpoints.setdefault(design_name, {'design_name': design_name})
+        checkpoint.update(fields, status='running', worker=self.worker_id)
+        self._write(design_name)
+
+    def get(self, design_name):
+        return self.checkpoints.get(design_name)
+
+    # model state of a trajectory in hallucination
+    def trajectory_checkpoint(self, design_name):
+        return TrajectoryCheckpoint(self._path(design_name, '.pickle'))
+
+    # record an MPNN design whose statistics were written, and whether it was accepted
+    def finish_mpnn_design(self, design_name, mpnn_design_name, accepted):
+        if design_name in self.checkpoints:
+            self.checkpoints[design_name].setdefault('mpnn_done', {})[mpnn_design_name] = accepted
+            self._write(design_name)
+
+    def remove(self, design_name):
+        self.checkpoints.pop(design_name, None)
+        for extension in ['.json', '.pickle']:
+            if os.path.exists(self._path(design_name, extension)):
+                os.remove(self._path(design_name, extension))
+
+    # mark the checkpoints of this run as interrupted so that a later run resumes them
+    def interrupt(self):
+        for design_name, checkpoint in self.checkpoints.items():
+            checkpoint['status'] = 'interrupted'
+            self._write(design_name)
+
+    # claim checkpoints left by earlier runs, only interrupted ones if other workers may still be running their trajectories
+    def claim(self, include_running=True):
+        claimed = []
+        with file_lock(os.path.join(self.folder, 'claim')):
+            for f in sorted(os.listdir(self.folder)):
+                if not f.endswith('.json'):
+                    continue
+                with open(os.path.join(self.folder, f)) as checkpoint_file:
+                    checkpoint = json.load(checkpoint_file)
+                if checkpoint['design_name'] in self.checkpoints or (checkpoint['status'] != 'interrupted' and not include_running):
+                    continue
+                self.checkpoints[checkpoint['design_name']] = checkpoint
+                self.save(checkpoint['design_name'])
+                claimed.append(checkpoint)
+        return claimed
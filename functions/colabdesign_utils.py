@@ -2,7 +2,8 @@
 ############## ColabDesign functions
 ####################################
 ### Import dependencies
-import os, re, shutil, math, pickle
+import os, re, gc, shutil, math, pickle
+from collections import OrderedDict
 import matplotlib.pyplot as plt
 import numpy as np
 import jax
@@ -13,28 +14,157 @@ from colabdesign.mpnn import mk_mpnn_model
 from colabdesign.af.alphafold.common import residue_constants
 from colabdesign.af.loss import get_ptm, mask_loss, get_dgram_bins, _get_con_loss
 from colabdesign.shared.utils import copy_dict
-from .biopython_utils import hotspot_residues, calculate_clash_score, calc_ss_percentage, calculate_percentages
-from .pyrosetta_utils import pr_relax, align_pdbs
+from .biopython_utils import hotspot_residues, calculate_clash_score, calc_ss_percentage, calculate_percentages, StructureAnalysis, load_structure, align_pdbs, batch_align_pdbs
+from .pyrosetta_utils import pr_relax
 from .generic_utils import update_failures
+from .dssp_utils import assign_secondary_structure
+from .checkpoint_utils import TrajectoryCheckpoint
+from .trace_utils import trace_span
+
+# keeps hallucination models alive between trajectories, JAX caches the compiled model for every binder length it has seen
+class HallucinationModelManager:
+    def __init__(self):
+        self.models = {}
+
+    # return the model for the current design settings, loss callbacks are registered only once per model
+    def get_model(self, advanced_settings):
+        key = (advanced_settings["use_multimer_design"], advanced_settings["num_recycles_design"], advanced_settings["use_rg_loss"],
+                advanced_settings["use_i_ptm_loss"], advanced_settings["use_termini_distance_loss"])
+
+        if key not in self.models:
+            with trace_span("af2_model_build", kind="hallucination"):
+                af_model = mk_afdesign_model(protocol="binder", debug=False, data_dir=advanced_settings["af_params_dir"],
+                                            use_multimer=advanced_settings["use_multimer_design"], num_recycles=advanced_settings["num_recycles_design"],
+                                            best_metric='loss')
+                add_design_losses(af_model, advanced_settings, 0)
+            self.models[key] = af_model
+
+        return self.models[key]
+
+hallucination_models = HallucinationModelManager()
+
+# keeps compiled validation models, least recently used models are dropped once the memory budget is exceeded
+class ValidationModelPool:
+    def __init__(self):
+        self.models = OrderedDict()
+        self.sizes = {}
+
+    # return model for key, building it with build_fn if it is not in the pool
+    def get(self, key, build_fn, memory_budget_gb):
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        model = build_fn()
+        self.models[key] = model
+        self.sizes[key] = estimate_model_memory(model)
+
+        # evict least recently used models, the model just built is always kept
+        budget = memory_budget_gb * 1024**3
+        while len(self.models) > 1 and sum(self.sizes.values()) > budget:
+            evicted_key, _ = self.models.popitem(last=False)
+            del self.sizes[evicted_key]
+        gc.collect()
+
+        return model
+
+validation_models = ValidationModelPool()
+
+# rough device memory footprint of a compiled AF2 model, parameters plus pair representation activations
+def estimate_model_memory(af_model):
+    params = getattr(af_model, "_model_params", [])
+    params_bytes = sum(getattr(leaf, "nbytes", 0) for leaf in jax.tree_util.tree_leaves(params))
+    n_res = sum(getattr(af_model, "_lengths", [0]))
+    activation_bytes = n_res ** 2 * 128 * 4 * 8
+    return params_bytes + activation_bytes
+
+# free GPU memory between stages unless compiled models are kept for reuse, clearing would delete their parameters
+def clear_gpu_memory(advanced_settings):
+    if not advanced_settings["reuse_design_model"] and not advanced_settings["validation_model_memory_gb"]:
+        clear_mem()
+
+# complex prediction model for MPNN sequences of a trajectory
+def get_complex_prediction_model(trajectory_pdb, length, multimer_validation, advanced_settings, target_settings):
+    use_trajectory_template = advanced_settings["predict_initial_guess"] or advanced_settings["predict_bigbang"]
+
+    def build_model():
+        with trace_span("af2_model_build", kind="complex"):
+            return mk_afdesign_model(protocol="binder", num_recycles=advanced_settings["num_recycles_validation"], data_dir=advanced_settings["af_params_dir"],
+                                    use_multimer=multimer_validation, use_initial_guess=advanced_settings["predict_initial_guess"], use_initial_atom_pos=advanced_settings["predict_bigbang"])
+
+    def prep_model(complex_prediction_model):
+        with trace_span("af2_model_prep", kind="complex"):
+            if use_trajectory_template:
+                complex_prediction_model.prep_inputs(pdb_filename=trajectory_pdb, chain='A', binder_chain='B', binder_len=length, use_binder_template=True, rm_target_seq=advanced_settings["rm_template_seq_predict"],
+                                                    rm_target_sc=advanced_settings["rm_template_sc_predict"], rm_template_ic=True)
+            else:
+                complex_prediction_model.prep_inputs(pdb_filename=target_settings["starting_pdb"], chain=target_settings["chains"], binder_len=length, rm_target_seq=advanced_settings["rm_template_seq_predict"],
+                                                    rm_target_sc=advanced_settings["rm_template_sc_predict"])
+        return complex_prediction_model
+
+    if not advanced_settings["validation_model_memory_gb"]:
+        return prep_model(build_model())
+
+    key = ("complex", int(length), multimer_validation, advanced_settings["num_recycles_validation"], advanced_settings["predict_initial_guess"],
+            advanced_settings["predict_bigbang"], advanced_settings["rm_template_seq_predict"], advanced_settings["rm_template_sc_predict"])
+    is_new = key not in validation_models.models
+    complex_prediction_model = validation_models.get(key, lambda: prep_model(build_model()), advanced_settings["validation_model_memory_gb"])
+
+    # the binder template comes from the trajectory, so pooled models are prepared again with the same shapes
+    if use_trajectory_template and not is_new:
+        prep_model(complex_prediction_model)
+
+    return complex_prediction_model
+
+# binder monomer prediction model for MPNN sequences of a trajectory
+def get_binder_prediction_model(length, multimer_validation, advanced_settings):
+    def build_model():
+        with trace_span("af2_model_build", kind="binder"):
+            binder_prediction_model = mk_afdesign_model(protocol="hallucination", use_templates=False, initial_guess=False,
+                                                        use_initial_atom_pos=False, num_recycles=advanced_settings["num_recycles_validation"],
+                                                        data_dir=advanced_settings["af_params_dir"], use_multimer=multimer_validation)
+            binder_prediction_model.prep_inputs(length=length)
+        return binder_prediction_model
+
+    if not advanced_settings["validation_model_memory_gb"]:
+        return build_model()
+
+    key = ("binder", int(length), multimer_validation, advanced_settings["num_recycles_validation"])
+    return validation_models.get(key, build_model, advanced_settings["validation_model_memory_gb"])
 
 # hallucinate a binder
-def binder_hallucination(design_name, starting_pdb, chain, target_hotspot_residues, length, seed, helicity_value, design_models, advanced_settings, design_paths, failure_csv):
+def binder_hallucination(design_name, starting_pdb, chain, target_hotspot_residues, length, seed, helicity_value, design_models, advanced_settings, design_paths, failure_csv, checkpoint=None):
     model_pdb_path = os.path.join(design_paths["Trajectory"], design_name+".pdb")
 
-    # clear GPU memory for new trajectory
-    clear_mem()
+    # the 4stage design is checkpointed after every stage, without a checkpoint file the stage values are only kept in memory
+    if checkpoint is None:
+        checkpoint = TrajectoryCheckpoint()
+
+    if advanced_settings["reuse_design_model"]:
+        # reuse model compiled for previous trajectories
+        af_model = hallucination_models.get_model(advanced_settings)
+    else:
+        # clear GPU memory for new trajectory, unless pooled validation models are kept
+        clear_gpu_memory(advanced_settings)
 
-    # initialise binder hallucination model
-    af_model = mk_afdesign_model(protocol="binder", debug=False, data_dir=advanced_settings["af_params_dir"], 
-                                use_multimer=advanced_settings["use_multimer_design"], num_recycles=advanced_settings["num_recycles_design"],
-                                best_metric='loss')
+        # initialise binder hallucination model
+        with trace_span("af2_model_build", kind="hallucination"):
+            af_model = mk_afdesign_model(protocol="binder", debug=False, data_dir=advanced_settings["af_params_dir"], 
+                                        use_multimer=advanced_settings["use_multimer_design"], num_recycles=advanced_settings["num_recycles_design"],
+                                        best_metric='loss')
 
     # sanity check for hotspots
     if target_hotspot_residues == "":
         target_hotspot_residues = None
 
-    af_model.prep_inputs(pdb_filename=starting_pdb, chain=chain, binder_len=length, hotspot=target_hotspot_residues, seed=seed, rm_aa=advanced_settings["omit_AAs"],
-                        rm_target_seq=advanced_settings["rm_template_seq_design"], rm_target_sc=advanced_settings["rm_template_sc_design"])
+    with trace_span("af2_model_prep", kind="hallucination"):
+        af_model.prep_inputs(pdb_filename=starting_pdb, chain=chain, binder_len=length, hotspot=target_hotspot_residues, seed=seed, rm_aa=advanced_settings["omit_AAs"],
+                            rm_target_seq=advanced_settings["rm_template_seq_design"], rm_target_sc=advanced_settings["rm_template_sc_design"])
+
+    # a reused model keeps the recycles of beta sheet optimisation in earlier trajectories, prep_inputs takes the current options as the defaults restored by restart
+    if advanced_settings["reuse_design_model"]:
+        af_model.opt["num_recycles"] = advanced_settings["num_recycles_design"]
+        af_model._opt["num_recycles"] = advanced_settings["num_recycles_design"]
 
     ### Update weights based on specified settings
     af_model.opt["weights"].update({"pae":advanced_settings["weights_pae_intra"],
@@ -47,69 +177,74 @@ def binder_hallucination(design_name, starting_pdb, chain, target_hotspot_residu
     # redefine intramolecular contacts (con) and intermolecular contacts (i_con) definitions
     af_model.opt["con"].update({"num":advanced_settings["intra_contact_number"],"cutoff":advanced_settings["intra_contact_distance"],"binary":False,"seqsep":9})
     af_model.opt["i_con"].update({"num":advanced_settings["inter_contact_number"],"cutoff":advanced_settings["inter_contact_distance"],"binary":False})
-        
 
     ### additional loss functions
-    if advanced_settings["use_rg_loss"]:
-        # radius of gyration loss
-        add_rg_loss(af_model, advanced_settings["weights_rg"])
-
-    if advanced_settings["use_i_ptm_loss"]:
-        # interface pTM loss
-        add_i_ptm_loss(af_model, advanced_settings["weights_iptm"])
-
-    if advanced_settings["use_termini_distance_loss"]:
-        # termini distance loss
-        add_termini_distance_loss(af_model, advanced_settings["weights_termini_loss"])
-
-    # add the helicity loss
-    add_helix_loss(af_model, helicity_value)
+    if advanced_settings["reuse_design_model"]:
+        # losses are already registered, prep_inputs resets their weights
+        set_design_loss_weights(af_model, advanced_settings, helicity_value)
+    else:
+        add_design_losses(af_model, advanced_settings, helicity_value)
 
     # calculate the number of mutations to do based on the length of the protein
     greedy_tries = math.ceil(length * (advanced_settings["greedy_percentage"] / 100))
 
+    # continue from the last stage finished by an interrupted run
+    checkpoint.restore(af_model)
+
     ### start design algorithm based on selection
     if advanced_settings["design_algorithm"] == '2stage':
         # uses gradient descend to get a PSSM profile and then uses PSSM to bias the sampling of random mutations to decrease loss
-        af_model.design_pssm_semigreedy(soft_iters=advanced_settings["soft_iterations"], hard_iters=advanced_settings["greedy_iterations"], tries=greedy_tries, models=design_models, 
-                                        num_models=1, sample_models=advanced_settings["sample_models"], ramp_models=False, save_best=True)
+        with trace_span("hallucination_2stage"):
+            af_model.design_pssm_semigreedy(soft_iters=advanced_settings["soft_iterations"], hard_iters=advanced_settings["greedy_iterations"], tries=greedy_tries, models=design_models, 
+                                            num_models=1, sample_models=advanced_settings["sample_models"], ramp_models=False, save_best=True)
 
     elif advanced_settings["design_algorithm"] == '3stage':
         # 3 stage design using logits, softmax, and one hot encoding
-        af_model.design_3stage(soft_iters=advanced_settings["soft_iterations"], temp_iters=advanced_settings["temporary_iterations"], hard_iters=advanced_settings["hard_iterations"], 
-                                num_models=1, models=design_models, sample_models=advanced_settings["sample_models"], save_best=True)
+        with trace_span("hallucination_3stage"):
+            af_model.design_3stage(soft_iters=advanced_settings["soft_iterations"], temp_iters=advanced_settings["temporary_iterations"], hard_iters=advanced_settings["hard_iterations"], 
+                                    num_models=1, models=design_models, sample_models=advanced_settings["sample_models"], save_best=True)
 
     elif advanced_settings["design_algorithm"] == 'greedy':
         # design by using random mutations that decrease loss
-        af_model.design_semigreedy(advanced_settings["greedy_iterations"], tries=greedy_tries, num_models=1, models=design_models,
-                                sample_models=advanced_settings["sample_models"], save_best=True)
+        with trace_span("hallucination_greedy"):
+            af_model.design_semigreedy(advanced_settings["greedy_iterations"], tries=greedy_tries, num_models=1, models=design_models,
+                                    sample_models=advanced_settings["sample_models"], save_best=True)
 
     elif advanced_settings["design_algorithm"] == 'mcmc':
         # design by using random mutations that decrease loss
         half_life = round(advanced_settings["greedy_iterations"] / 5, 0)
         t_mcmc = 0.01
-        af_model._design_mcmc(advanced_settings["greedy_iterations"], half_life=half_life, T_init=t_mcmc, mutation_rate=greedy_tries, num_models=1, models=design_models,
-                                sample_models=advanced_settings["sample_models"], save_best=True)
+        with trace_span("hallucination_mcmc"):
+            af_model._design_mcmc(advanced_settings["greedy_iterations"], half_life=half_life, T_init=t_mcmc, mutation_rate=greedy_tries, num_models=1, models=design_models,
+                                    sample_models=advanced_settings["sample_models"], save_best=True)
 
     elif advanced_settings["design_algorithm"] == '4stage':
         # initial logits to prescreen trajectory
-        print("Stage 1: Test Logits")
-        af_model.design_logits(iters=50, e_soft=0.9, models=design_models, num_models=1, sample_models=advanced_settings["sample_models"], save_best=True)
-
-        # determine pLDDT of best iteration according to lowest 'loss' value
-        initial_plddt = get_best_plddt(af_model, length)
+        if not checkpoint.completed('logits'):
+            print("Stage 1: Test Logits")
+            with trace_span("hallucination_logits"):
+                af_model.design_logits(iters=50, e_soft=0.9, models=design_models, num_models=1, sample_models=advanced_settings["sample_models"], save_best=True)
+
+            # determine pLDDT of best iteration according to lowest 'loss' value
+            checkpoint.save(af_model, 'logits', initial_plddt=get_best_plddt(af_model, length))
+        initial_plddt = checkpoint.values['initial_plddt']
         
         # if best iteration has high enough confidence then continue
         if initial_plddt > 0.65:
             print("Initial trajectory pLDDT good, continuing: "+str(initial_plddt))
             if advanced_settings["optimise_beta"]:
-                # temporarily dump model to assess secondary structure
-                af_model.save_pdb(model_pdb_path)
-                _, beta, *_ = calc_ss_percentage(model_pdb_path, advanced_settings, 'B')
-                os.remove(model_pdb_path)
+                # assess secondary structure of the best iteration
+                if 'beta' not in checkpoint.values:
+                    if advanced_settings["use_dssp_binary"]:
+                        af_model.save_pdb(model_pdb_path)
+                        _, beta, *_ = calc_ss_percentage(model_pdb_path, advanced_settings, 'B')
+                        os.remove(model_pdb_path)
+                    else:
+                        _, beta, _ = get_best_ss_percentages(af_model)
+                    checkpoint.values['beta'] = beta
 
                 # if beta sheeted trajectory is detected then choose to optimise
-                if float(beta) > 15:
+                if float(checkpoint.values['beta']) > 15:
                     advanced_settings["soft_iterations"] = advanced_settings["soft_iterations"] + advanced_settings["optimise_beta_extra_soft"]
                     advanced_settings["temporary_iterations"] = advanced_settings["temporary_iterations"] + advanced_settings["optimise_beta_extra_temp"]
                     af_model.set_opt(num_recycles=advanced_settings["optimise_beta_recycles_design"])
@@ -118,23 +253,29 @@ def binder_hallucination(design_name, starting_pdb, chain, target_hotspot_residu
             # how many logit iterations left
             logits_iter = advanced_settings["soft_iterations"] - 50
             if logits_iter > 0:
-                print("Stage 1: Additional Logits Optimisation")
-                af_model.clear_best()
-                af_model.design_logits(iters=logits_iter, e_soft=1, models=design_models, num_models=1, sample_models=advanced_settings["sample_models"],
-                                    ramp_recycles=False, save_best=True)
-                af_model._tmp["seq_logits"] = af_model.aux["seq"]["logits"]
-                logit_plddt = get_best_plddt(af_model, length)
+                if not checkpoint.completed('logits_extra'):
+                    print("Stage 1: Additional Logits Optimisation")
+                    af_model.clear_best()
+                    with trace_span("hallucination_logits_extra"):
+                        af_model.design_logits(iters=logits_iter, e_soft=1, models=design_models, num_models=1, sample_models=advanced_settings["sample_models"],
+                                            ramp_recycles=False, save_best=True)
+                    af_model._tmp["seq_logits"] = af_model.aux["seq"]["logits"]
+                    checkpoint.save(af_model, 'logits_extra', logit_plddt=get_best_plddt(af_model, length))
+                logit_plddt = checkpoint.values['logit_plddt']
                 print("Optimised logit trajectory pLDDT: "+str(logit_plddt))
             else:
                 logit_plddt = initial_plddt
 
             # perform softmax trajectory design
             if advanced_settings["temporary_iterations"] > 0:
-                print("Stage 2: Softmax Optimisation")
-                af_model.clear_best()
-                af_model.design_soft(advanced_settings["temporary_iterations"], e_temp=1e-2, models=design_models, num_models=1,
-                                    sample_models=advanced_settings["sample_models"], ramp_recycles=False, save_best=True)
-                softmax_plddt = get_best_plddt(af_model, length)
+                if not checkpoint.completed('softmax'):
+                    print("Stage 2: Softmax Optimisation")
+                    af_model.clear_best()
+                    with trace_span("hallucination_softmax"):
+                        af_model.design_soft(advanced_settings["temporary_iterations"], e_temp=1e-2, models=design_models, num_models=1,
+                                            sample_models=advanced_settings["sample_models"], ramp_recycles=False, save_best=True)
+                    checkpoint.save(af_model, 'softmax', softmax_plddt=get_best_plddt(af_model, length))
+                softmax_plddt = checkpoint.values['softmax_plddt']
             else:
                 softmax_plddt = logit_plddt
 
@@ -142,19 +283,24 @@ def binder_hallucination(design_name, starting_pdb, chain, target_hotspot_residu
             if softmax_plddt > 0.65:
                 print("Softmax trajectory pLDDT good, continuing: "+str(softmax_plddt))
                 if advanced_settings["hard_iterations"] > 0:
-                    af_model.clear_best()
-                    print("Stage 3: One-hot Optimisation")
-                    af_model.design_hard(advanced_settings["hard_iterations"], temp=1e-2, models=design_models, num_models=1,
-                                    sample_models=advanced_settings["sample_models"], dropout=False, ramp_recycles=False, save_best=True)
-                    onehot_plddt = get_best_plddt(af_model, length)
+                    if not checkpoint.completed('onehot'):
+                        af_model.clear_best()
+                        print("Stage 3: One-hot Optimisation")
+                        with trace_span("hallucination_onehot"):
+                            af_model.design_hard(advanced_settings["hard_iterations"], temp=1e-2, models=design_models, num_models=1,
+                                            sample_models=advanced_settings["sample_models"], dropout=False, ramp_recycles=False, save_best=True)
+                        checkpoint.save(af_model, 'onehot', onehot_plddt=get_best_plddt(af_model, length))
+                    onehot_plddt = checkpoint.values['onehot_plddt']
 
                 if onehot_plddt > 0.65:
                     # perform greedy mutation optimisation
                     print("One-hot trajectory pLDDT good, continuing: "+str(onehot_plddt))
-                    if advanced_settings["greedy_iterations"] > 0:
+                    if advanced_settings["greedy_iterations"] > 0 and not checkpoint.completed('greedy'):
                         print("Stage 4: PSSM Semigreedy Optimisation")
-                        af_model.design_pssm_semigreedy(soft_iters=0, hard_iters=advanced_settings["greedy_iterations"], tries=greedy_tries, models=design_models, 
-                                                        num_models=1, sample_models=advanced_settings["sample_models"], ramp_models=False, save_best=True)
+                        with trace_span("hallucination_greedy"):
+                            af_model.design_pssm_semigreedy(soft_iters=0, hard_iters=advanced_settings["greedy_iterations"], tries=greedy_tries, models=design_models, 
+                                                            num_models=1, sample_models=advanced_settings["sample_models"], ramp_models=False, save_best=True)
+                        checkpoint.save(af_model, 'greedy')
 
                 else:
                     update_failures(failure_csv, 'Trajectory_one-hot_pLDDT')
@@ -180,8 +326,9 @@ def binder_hallucination(design_name, starting_pdb, chain, target_hotspot_residu
 
     # let's check whether the trajectory is worth optimising by checking confidence, clashes, and contacts
     # check clashes
-    #clash_interface = calculate_clash_score(model_pdb_path, 2.4)
-    ca_clashes = calculate_clash_score(model_pdb_path, 2.5, only_ca=True)
+    model_structure = StructureAnalysis(model_pdb_path)
+    #clash_interface = model_structure.clash_score(2.4)
+    ca_clashes = model_structure.clash_score(2.5, only_ca=True)
 
     #if clash_interface > 25 or ca_clashes > 0:
     if ca_clashes > 0:
@@ -198,7 +345,7 @@ def binder_hallucination(design_name, starting_pdb, chain, target_hotspot_residu
             print("")
         else:
             # does it have enough contacts to consider?
-            binder_contacts = hotspot_residues(model_pdb_path)
+            binder_contacts = model_structure.hotspot_residues()
             binder_contacts_n = len(binder_contacts.items())
 
             # if less than 3 contacts then protein is floating above and is not binder
@@ -235,7 +382,7 @@ def binder_hallucination(design_name, starting_pdb, chain, target_hotspot_residu
     return af_model
 
 # run prediction for binder with masked template target
-def predict_binder_complex(prediction_model, binder_sequence, mpnn_design_name, target_pdb, chain, length, trajectory_pdb, prediction_models, advanced_settings, filters, design_paths, failure_csv, seed=None):
+def predict_binder_complex(prediction_model, binder_sequence, mpnn_design_name, target_pdb, chain, length, trajectory_pdb, prediction_models, advanced_settings, filters, design_paths, failure_csv, seed=None, relax_models=True):
     prediction_stats = {}
 
     # clean sequence
@@ -251,7 +398,8 @@ def predict_binder_complex(prediction_model, binder_sequence, mpnn_design_name,
         complex_pdb = os.path.join(design_paths["MPNN"], f"{mpnn_design_name}_model{model_num+1}.pdb")
         if not os.path.exists(complex_pdb):
             # predict model
-            prediction_model.predict(seq=binder_sequence, models=[model_num], num_recycles=advanced_settings["num_recycles_validation"], verbose=False)
+            with trace_span("af2_predict_complex", design=mpnn_design_name, model=model_num+1):
+                prediction_model.predict(seq=binder_sequence, models=[model_num], num_recycles=advanced_settings["num_recycles_validation"], verbose=False)
             prediction_model.save_pdb(complex_pdb)
             prediction_metrics = copy_dict(prediction_model.aux["log"]) # contains plddt, ptm, i_ptm, pae, i_pae
 
@@ -265,25 +413,8 @@ def predict_binder_complex(prediction_model, binder_sequence, mpnn_design_name,
             }
             prediction_stats[model_num+1] = stats
 
-            # List of filter conditions and corresponding keys
-            filter_conditions = [
-                (f"{model_num+1}_pLDDT", 'plddt', '>='),
-                (f"{model_num+1}_pTM", 'ptm', '>='),
-                (f"{model_num+1}_i_pTM", 'i_ptm', '>='),
-                (f"{model_num+1}_pAE", 'pae', '<='),
-                (f"{model_num+1}_i_pAE", 'i_pae', '<='),
-            ]
-
             # perform initial AF2 values filtering to determine whether to skip relaxation and interface scoring
-            for filter_name, metric_key, comparison in filter_conditions:
-                threshold = filters.get(filter_name, {}).get("threshold")
-                if threshold is not None:
-                    if comparison == '>=' and prediction_metrics[metric_key] < threshold:
-                        pass_af2_filters = False
-                        filter_failures[filter_name] = filter_failures.get(filter_name, 0) + 1
-                    elif comparison == '<=' and prediction_metrics[metric_key] > threshold:
-                        pass_af2_filters = False
-                        filter_failures[filter_name] = filter_failures.get(filter_name, 0) + 1
+            pass_af2_filters = check_af2_filters(prediction_metrics, model_num, filters, filter_failures)
 
             if not pass_af2_filters:
                 break
@@ -292,18 +423,49 @@ def predict_binder_complex(prediction_model, binder_sequence, mpnn_design_name,
     if filter_failures:
         update_failures(failure_csv, filter_failures)
 
-    # AF2 filters passed, contuing with relaxation
+    # AF2 filters passed, contuing with relaxation unless it is deferred to the CPU stage
+    relax_or_remove_complexes(mpnn_design_name, pass_af2_filters, prediction_models, design_paths, relax_models)
+
+    return prediction_stats, pass_af2_filters
+
+# check AF2 confidence metrics of one model against the filter thresholds, counting failures
+def check_af2_filters(prediction_metrics, model_num, filters, filter_failures):
+    pass_af2_filters = True
+
+    # List of filter conditions and corresponding keys
+    filter_conditions = [
+        (f"{model_num+1}_pLDDT", 'plddt', '>='),
+        (f"{model_num+1}_pTM", 'ptm', '>='),
+        (f"{model_num+1}_i_pTM", 'i_ptm', '>='),
+        (f"{model_num+1}_pAE", 'pae', '<='),
+        (f"{model_num+1}_i_pAE", 'i_pae', '<='),
+    ]
+
+    for filter_name, metric_key, comparison in filter_conditions:
+        threshold = filters.get(filter_name, {}).get("threshold")
+        if threshold is not None:
+            if comparison == '>=' and prediction_metrics[metric_key] < threshold:
+                pass_af2_filters = False
+                filter_failures[filter_name] = filter_failures.get(filter_name, 0) + 1
+            elif comparison == '<=' and prediction_metrics[metric_key] > threshold:
+                pass_af2_filters = False
+                filter_failures[filter_name] = filter_failures.get(filter_name, 0) + 1
+
+    return pass_af2_filters
+
+# relax predicted complexes that passed the AF2 filters and remove the ones that did not
+def relax_or_remove_complexes(mpnn_design_name, pass_af2_filters, prediction_models, design_paths, relax_models=True):
     for model_num in prediction_models:
         complex_pdb = os.path.join(design_paths["MPNN"], f"{mpnn_design_name}_model{model_num+1}.pdb")
         if pass_af2_filters:
+            if not relax_models:
+                continue
             mpnn_relaxed = os.path.join(design_paths["MPNN/Relaxed"], f"{mpnn_design_name}_model{model_num+1}.pdb")
             pr_relax(complex_pdb, mpnn_relaxed)
         else:
             if os.path.exists(complex_pdb):
                 os.remove(complex_pdb)
 
-    return prediction_stats, pass_af2_filters
-
 # run prediction for binder alone
 def predict_binder_alone(prediction_model, binder_sequence, mpnn_design_name, length, trajectory_pdb, binder_chain, prediction_models, advanced_settings, design_paths, seed=None):
     binder_stats = {}
@@ -311,6 +473,7 @@ def predict_binder_alone(prediction_model, binder_sequence, mpnn_design_name, le
     # prepare sequence for prediction
     binder_sequence = re.sub("[^A-Z]", "", binder_sequence.upper())
     prediction_model.set_seq(binder_sequence)
+    trajectory_structure = load_structure(trajectory_pdb)
 
     # predict each model separately
     for model_num in prediction_models:
@@ -318,12 +481,13 @@ def predict_binder_alone(prediction_model, binder_sequence, mpnn_design_name, le
         binder_alone_pdb = os.path.join(design_paths["MPNN/Binder"], f"{mpnn_design_name}_model{model_num+1}.pdb")
         if not os.path.exists(binder_alone_pdb):
             # predict model
-            prediction_model.predict(models=[model_num], num_recycles=advanced_settings["num_recycles_validation"], verbose=False)
+            with trace_span("af2_predict_binder", design=mpnn_design_name, model=model_num+1):
+                prediction_model.predict(models=[model_num], num_recycles=advanced_settings["num_recycles_validation"], verbose=False)
             prediction_model.save_pdb(binder_alone_pdb)
             prediction_metrics = copy_dict(prediction_model.aux["log"]) # contains plddt, ptm, pae
 
             # align binder model to trajectory binder
-            align_pdbs(trajectory_pdb, binder_alone_pdb, binder_chain, "A")
+            align_pdbs(trajectory_structure, binder_alone_pdb, binder_chain, "A")
 
             # extract the statistics for the model
             stats = {
@@ -335,13 +499,205 @@ def predict_binder_alone(prediction_model, binder_sequence, mpnn_design_name, le
 
     return binder_stats
 
+# run the same-length sequences of a batch through all selected AF2 parameter sets in one vectorised forward pass
+def predict_batch(prediction_model, binder_sequences, models, num_recycles):
+    # keep settings to restore them afterwards, the same way as predict() does
+    saved_settings = [copy_dict(x) for x in [prediction_model.opt, prediction_model._args, prediction_model._params, prediction_model._inputs]]
+    prediction_model.set_opt(hard=True, soft=False, temp=1, dropout=False, pssm_hard=True)
+    prediction_model.set_args(shuffle_first=False)
+
+    # stack sequence parameters along the batch axis and model parameters along the model axis
+    seq_params = []
+    for binder_sequence in binder_sequences:
+        prediction_model.set_seq(seq=binder_sequence)
+        seq_params.append(copy_dict(prediction_model._params))
+    params = jax.tree_util.tree_map(lambda *x: np.stack(x), *seq_params)
+    model_params = get_stacked_model_params(prediction_model, models)
+
+    inputs = prediction_model._inputs
+    inputs["opt"] = prediction_model.opt
+    n_models, n_seqs = len(models), len(binder_sequences)
+
+    # recycles run outside of the compiled model unless they were compiled into it, initialised as in the model's _recycle
+    a = prediction_model._args
+    if a["recycle_mode"] in ["backprop", "add_prev"]:
+        cycles = 1
+        inputs.pop("prev", None)
+    else:
+        cycles = num_recycles + 1
+        L = inputs["residue_index"].shape[0]
+        prev = {'prev_msa_first_row': np.zeros([L,256]),
+                'prev_pair': np.zeros([L,L,128])}
+        if a["use_initial_guess"] and "batch" in inputs:
+            prev["prev_pos"] = inputs["batch"]["all_atom_positions"]
+        else:
+            prev["prev_pos"] = np.zeros([L,37,3])
+        if a["use_dgram"]:
+            prev["prev_dgram"] = np.zeros([L,L,64])
+        if a["use_initial_atom_pos"]:
+            if "batch" in inputs:
+                inputs["initial_atom_pos"] = np.broadcast_to(inputs["batch"]["all_atom_positions"], (n_models, n_seqs, L, 37, 3))
+            else:
+                inputs["initial_atom_pos"] = np.zeros([n_models, n_seqs, L, 37, 3])
+        inputs["prev"] = jax.tree_util.tree_map(lambda x: np.broadcast_to(x, (n_models, n_seqs) + x.shape), prev)
+
+    batched_fn = get_batched_model_fn(prediction_model, inputs)
+    key = prediction_model.key()
+    for _ in range(cycles):
+        loss, aux = batched_fn(params, model_params, inputs, key)
+        if "prev" in inputs:
+            inputs["prev"] = aux["prev"]
+    aux.pop("prev", None)
+
+    [prediction_model.opt, prediction_model._args, prediction_model._params, prediction_model._inputs] = saved_settings
+
+    return loss, aux
+
+# model function vectorised over sequences (inner axis) and AF2 parameter sets (outer axis), compiled once per model
+def get_batched_model_fn(prediction_model, inputs):
+    batched_fns = prediction_model.__dict__.setdefault("_batched_fns", {})
+    fn_key = tuple(sorted(inputs.keys()))
+
+    if fn_key not in batched_fns:
+        inputs_axes = {k: (0 if k in ["prev", "initial_atom_pos"] else None) for k in inputs}
+        over_seqs = jax.vmap(prediction_model._model["fn"], in_axes=(0, None, inputs_axes, None))
+        over_models = jax.vmap(over_seqs, in_axes=(None, 0, inputs_axes, None))
+        batched_fns[fn_key] = jax.jit(over_models)
+
+    return batched_fns[fn_key]
+
+# AF2 parameter sets stacked along a leading axis, kept on the model for later batches
+def get_stacked_model_params(prediction_model, models):
+    stacked_params = prediction_model.__dict__.setdefault("_stacked_model_params", {})
+    models_key = tuple(models)
+
+    if models_key not in stacked_params:
+        stacked_params[models_key] = jax.tree_util.tree_map(lambda *x: jnp.stack(x), *[prediction_model._model_params[n] for n in models])
+
+    return stacked_params[models_key]
+
+# outputs of one AF2 parameter set and sequence from a batched prediction, in the layout run() produces
+def unbatch_aux(loss, aux, model_index, seq_index):
+    single_aux = jax.tree_util.tree_map(lambda x: np.asarray(x[model_index, seq_index]), aux)
+    single_aux["loss"] = np.asarray(loss[model_index, seq_index])
+
+    log = {**single_aux["losses"]}
+    log["plddt"] = 1 - log["plddt"]
+    for k in ["loss", "i_ptm", "ptm"]:
+        log[k] = single_aux[k]
+    single_aux["log"] = {k: float(v) for k, v in log.items()}
+
+    # save_pdb expects outputs stacked over models
+    single_aux["all"] = {k: single_aux[k][None] for k in ["aatype", "residue_index", "atom_positions", "atom_mask", "plddt"]}
+
+    return single_aux
+
+# pad a batch by repeating its last sequence, so that every batch has the same shape and is compiled only once
+def pad_batch(binder_sequences, batch_size):
+    return binder_sequences + [binder_sequences[-1]] * (batch_size - len(binder_sequences))
+
+# batched version of predict_binder_complex, returns a (prediction_stats, pass_af2_filters) tuple per sequence
+def predict_binder_complex_batch(prediction_model, binder_sequences, mpnn_design_names, target_pdb, chain, length, trajectory_pdb, prediction_models, advanced_settings, filters, design_paths, failure_csv, relax_models=True):
+    results = [None] * len(binder_sequences)
+
+    # single sequences and designs with existing predictions (resumed runs) use the unbatched path
+    for i, (binder_sequence, mpnn_design_name) in enumerate(zip(binder_sequences, mpnn_design_names)):
+        existing = any(os.path.exists(os.path.join(design_paths["MPNN"], f"{mpnn_design_name}_model{model_num+1}.pdb")) for model_num in prediction_models)
+        if existing or len(binder_sequences) == 1:
+            results[i] = predict_binder_complex(prediction_model, binder_sequence, mpnn_design_name, target_pdb, chain, length, trajectory_pdb,
+                                                prediction_models, advanced_settings, filters, design_paths, failure_csv, relax_models=relax_models)
+
+    batch_indices = [i for i, result in enumerate(results) if result is None]
+    if not batch_indices:
+        return results
+
+    sequences = [re.sub("[^A-Z]", "", binder_sequences[i].upper()) for i in batch_indices]
+    with trace_span("af2_predict_complex", design=[mpnn_design_names[i] for i in batch_indices], model=[model_num+1 for model_num in prediction_models]):
+        loss, aux = predict_batch(prediction_model, pad_batch(sequences, advanced_settings["validation_batch_size"]), prediction_models, advanced_settings["num_recycles_validation"])
+
+    filter_failures = {}
+    for seq_index, i in enumerate(batch_indices):
+        prediction_stats = {}
+        pass_af2_filters = True
+
+        # apply the per-model filters in model order, later models are discarded after the first failure as in the unbatched path
+        for model_index, model_num in enumerate(prediction_models):
+            model_aux = unbatch_aux(loss, aux, model_index, seq_index)
+            prediction_metrics = model_aux["log"]
+            complex_pdb = os.path.join(design_paths["MPNN"], f"{mpnn_design_names[i]}_model{model_num+1}.pdb")
+            prediction_model.save_pdb(complex_pdb, aux=model_aux)
+
+            prediction_stats[model_num+1] = {
+                'pLDDT': round(prediction_metrics['plddt'], 2),
+                'pTM': round(prediction_metrics['ptm'], 2),
+                'i_pTM': round(prediction_metrics['i_ptm'], 2),
+                'pAE': round(prediction_metrics['pae'], 2),
+                'i_pAE': round(prediction_metrics['i_pae'], 2)
+            }
+
+            pass_af2_filters = check_af2_filters(prediction_metrics, model_num, filters, filter_failures)
+            if not pass_af2_filters:
+                break
+
+        relax_or_remove_complexes(mpnn_design_names[i], pass_af2_filters, prediction_models, design_paths, relax_models)
+        results[i] = (prediction_stats, pass_af2_filters)
+
+    # Update the CSV file with the failure counts
+    if filter_failures:
+        update_failures(failure_csv, filter_failures)
+
+    return results
+
+# batched version of predict_binder_alone, returns binder statistics per sequence
+def predict_binder_alone_batch(prediction_model, binder_sequences, mpnn_design_names, length, trajectory_pdb, binder_chain, prediction_models, advanced_settings, design_paths):
+    results = [None] * len(binder_sequences)
+
+    # single sequences and designs with existing predictions (resumed runs) use the unbatched path
+    for i, (binder_sequence, mpnn_design_name) in enumerate(zip(binder_sequences, mpnn_design_names)):
+        existing = any(os.path.exists(os.path.join(design_paths["MPNN/Binder"], f"{mpnn_design_name}_model{model_num+1}.pdb")) for model_num in prediction_models)
+        if existing or len(binder_sequences) == 1:
+            results[i] = predict_binder_alone(prediction_model, binder_sequence, mpnn_design_name, length, trajectory_pdb, binder_chain,
+                                            prediction_models, advanced_settings, design_paths)
+
+    batch_indices = [i for i, result in enumerate(results) if result is None]
+    if not batch_indices:
+        return results
+
+    sequences = [re.sub("[^A-Z]", "", binder_sequences[i].upper()) for i in batch_indices]
+    with trace_span("af2_predict_binder", design=[mpnn_design_names[i] for i in batch_indices], model=[model_num+1 for model_num in prediction_models]):
+        loss, aux = predict_batch(prediction_model, pad_batch(sequences, advanced_settings["validation_batch_size"]), prediction_models, advanced_settings["num_recycles_validation"])
+
+    trajectory_structure = load_structure(trajectory_pdb)
+    for seq_index, i in enumerate(batch_indices):
+        binder_stats = {}
+        binder_alone_pdbs = []
+        for model_index, model_num in enumerate(prediction_models):
+            model_aux = unbatch_aux(loss, aux, model_index, seq_index)
+            prediction_metrics = model_aux["log"]
+            binder_alone_pdb = os.path.join(design_paths["MPNN/Binder"], f"{mpnn_design_names[i]}_model{model_num+1}.pdb")
+            prediction_model.save_pdb(binder_alone_pdb, aux=model_aux)
+            binder_alone_pdbs.append(binder_alone_pdb)
+
+            binder_stats[model_num+1] = {
+                'pLDDT': round(prediction_metrics['plddt'], 2),
+                'pTM': round(prediction_metrics['ptm'], 2),
+                'pAE': round(prediction_metrics['pae'], 2)
+            }
+
+        # align all binder models to trajectory binder
+        batch_align_pdbs(trajectory_structure, binder_alone_pdbs, binder_chain, "A")
+        results[i] = binder_stats
+
+    return results
+
 # run MPNN to generate sequences for binders
 def mpnn_gen_sequence(trajectory_pdb, binder_chain, trajectory_interface_residues, advanced_settings):
     # clear GPU memory
-    clear_mem()
+    clear_gpu_memory(advanced_settings)
 
     # initialise MPNN model
-    mpnn_model = mk_mpnn_model(backbone_noise=advanced_settings["backbone_noise"], model_name=advanced_settings["model_path"], weights=advanced_settings["mpnn_weights"])
+    with trace_span("mpnn_model_build"):
+        mpnn_model = mk_mpnn_model(backbone_noise=advanced_settings["backbone_noise"], model_name=advanced_settings["model_path"], weights=advanced_settings["mpnn_weights"])
 
     # check whether keep the interface generated by the trajectory or whether to redesign with MPNN
     design_chains = 'A,' + binder_chain
@@ -357,14 +713,70 @@ def mpnn_gen_sequence(trajectory_pdb, binder_chain, trajectory_interface_residue
     mpnn_model.prep_inputs(pdb_filename=trajectory_pdb, chain=design_chains, fix_pos=fixed_positions, rm_aa=advanced_settings["omit_AAs"])
 
     # sample MPNN sequences in parallel
-    mpnn_sequences = mpnn_model.sample(temperature=advanced_settings["sampling_temp"], num=1, batch=advanced_settings["num_seqs"])
+    with trace_span("mpnn_sampling"):
+        mpnn_sequences = mpnn_model.sample(temperature=advanced_settings["sampling_temp"], num=1, batch=advanced_settings["num_seqs"])
 
     return mpnn_sequences
 
+# add the additional loss functions selected in the advanced settings
+def add_design_losses(af_model, advanced_settings, helicity_value):
+    if advanced_settings["use_rg_loss"]:
+        # radius of gyration loss
+        add_rg_loss(af_model, advanced_settings["weights_rg"])
+
+    if advanced_settings["use_i_ptm_loss"]:
+        # interface pTM loss
+        add_i_ptm_loss(af_model, advanced_settings["weights_iptm"])
+
+    if advanced_settings["use_termini_distance_loss"]:
+        # termini distance loss
+        add_termini_distance_loss(af_model, advanced_settings["weights_termini_loss"])
+
+    # add the helicity loss
+    add_helix_loss(af_model, helicity_value)
+
+# set weights of additional losses already registered on a reused model
+def set_design_loss_weights(af_model, advanced_settings, helicity_value):
+    if advanced_settings["use_rg_loss"]:
+        af_model.opt["weights"]["rg"] = advanced_settings["weights_rg"]
+
+    if advanced_settings["use_i_ptm_loss"]:
+        af_model.opt["weights"]["i_ptm"] = advanced_settings["weights_iptm"]
+
+    if advanced_settings["use_termini_distance_loss"]:
+        af_model.opt["weights"]["NC"] = advanced_settings["weights_termini_loss"]
+
+    af_model.opt["weights"]["helix"] = helicity_value
+
 # Get pLDDT of best model
 def get_best_plddt(af_model, length):
     return round(np.mean(af_model._tmp["best"]["aux"]["plddt"][-length:]),2)
 
+# Get helix, sheet and loop percentages of the binder in the best model, assigned from the predicted backbone without writing a PDB
+def get_best_ss_percentages(af_model):
+    aux = af_model._tmp["best"]["aux"] if "aux" in af_model._tmp["best"] else af_model.aux
+    aux = aux["all"]
+
+    # first prediction model, coordinates rounded as in the saved PDB
+    atom_positions = np.round(np.asarray(aux["atom_positions"][0], dtype=float), 3)
+    atom_mask = np.asarray(aux["atom_mask"][0])
+    aatype = np.asarray(aux["aatype"][0])
+    if aatype.ndim > 1:
+        aatype = aatype.argmax(-1)
+    chain_index = np.repeat(np.arange(len(af_model._lengths)), af_model._lengths)
+
+    # like DSSP, only residues with a complete backbone are assigned
+    backbone = [residue_constants.atom_order[name] for name in ["N", "CA", "C", "O"]]
+    complete = atom_mask[:, backbone].min(-1) > 0
+    ss = assign_secondary_structure(*[atom_positions[complete, atom] for atom in backbone], chain_index[complete],
+                                    aatype[complete] == residue_constants.restype_order["P"])
+
+    # the binder is the last chain
+    binder_ss = ss[chain_index[complete] == len(af_model._lengths) - 1]
+    helix = int(np.isin(binder_ss, ["H", "G", "I"]).sum())
+    sheet = int((binder_ss == "E").sum())
+    return calculate_percentages(len(binder_ss), helix, sheet)
+
 # Define radius of gyration loss for colabdesign
 def add_rg_loss(self, weight=0.1):
     '''add radius of gyration loss'''
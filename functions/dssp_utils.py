@@ -0,0 +1,153 @@
+####################################
+##### Secondary structure functions
+####################################
+### Import dependencies
+import numpy as np
+from scipy.spatial import cKDTree
+
+# constants of the DSSP hydrogen bond model (Kabsch & Sander, 1983)
+dssp_coupling_constant = -27.888
+dssp_min_hbond_energy = -9.9
+dssp_max_hbond_energy = -0.5
+dssp_min_distance = 0.5
+dssp_max_ca_distance = 9.0
+dssp_max_peptide_bond = 2.5
+
+# residues i and j of the same chain without a chain break between them
+def _no_break(breaks, chain_start, i, j):
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return (chain_start[i] == chain_start[j]) & (breaks[j] - breaks[i] == 0)
+
+# DSSP style secondary structure from backbone coordinates of shape [L, 3] of consecutive residues,
+# returns one letter per residue: H (alpha helix), B (isolated bridge), E (strand), G (3-10 helix), I (pi helix) or - (other)
+def assign_secondary_structure(n_coords, ca_coords, c_coords, o_coords, chain_index, is_proline=None):
+    n_res = len(ca_coords)
+    ss = np.full(n_res, '-', dtype='U1')
+    if n_res == 0:
+        return ss
+    n_coords, ca_coords, c_coords, o_coords = [np.asarray(x, dtype=float) for x in (n_coords, ca_coords, c_coords, o_coords)]
+    chain_index = np.asarray(chain_index)
+    is_proline = np.zeros(n_res, dtype=bool) if is_proline is None else np.asarray(is_proline, dtype=bool)
+
+    # chain breaks: a new chain or a missing peptide bond between consecutive residues
+    new_chain = np.concatenate([[True], chain_index[1:] != chain_index[:-1]])
+    peptide_bond = np.concatenate([[np.inf], np.linalg.norm(n_coords[1:] - c_coords[:-1], axis=-1)])
+    chain_start = np.maximum.accumulate(np.where(new_chain, np.arange(n_res), 0))
+    breaks = np.cumsum(~new_chain & (peptide_bond > dssp_max_peptide_bond))
+
+    # amide hydrogens placed 1 A from N opposite to the carbonyl of the previous residue
+    h_coords = n_coords.copy()
+    has_previous = ~new_chain
+    co = c_coords[:-1] - o_coords[:-1]
+    co /= np.linalg.norm(co, axis=-1, keepdims=True)
+    h_coords[1:][has_previous[1:]] += co[has_previous[1:]]
+
+    # electrostatic energy of donor NH i to acceptor CO j for residue pairs with C alpha atoms within 9 A
+    pairs = cKDTree(ca_coords).query_pairs(dssp_max_ca_distance, output_type='ndarray')
+    donor = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    acceptor = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    # the NH of a residue is not tested against the CO of the residue preceding it
+    valid = ~(donor == acceptor + 1) & ~is_proline[donor]
+    donor, acceptor = donor[valid], acceptor[valid]
+
+    d_ho = np.linalg.norm(h_coords[donor] - o_coords[acceptor], axis=-1)
+    d_hc = np.linalg.norm(h_coords[donor] - c_coords[acceptor], axis=-1)
+    d_nc = np.linalg.norm(n_coords[donor] - c_coords[acceptor], axis=-1)
+    d_no = np.linalg.norm(n_coords[donor] - o_coords[acceptor], axis=-1)
+    too_close = (d_ho < dssp_min_distance) | (d_hc < dssp_min_distance) | (d_nc < dssp_min_distance) | (d_no < dssp_min_distance)
+    with np.errstate(divide='ignore'):
+        energy = dssp_coupling_constant * (1 / d_ho - 1 / d_hc + 1 / d_nc - 1 / d_no)
+    energy = np.where(too_close, dssp_min_hbond_energy, np.maximum(np.round(energy, 3), dssp_min_hbond_energy))
+
+    # as in DSSP, only the two strongest acceptors of every donor count as hydrogen bonds
+    order = np.lexsort((energy, donor))
+    donor, acceptor, energy = donor[order], acceptor[order], energy[order]
+    rank = np.arange(len(donor)) - np.searchsorted(donor, donor)
+    bonded = (rank < 2) & (energy < dssp_max_hbond_energy)
+    hbond = np.zeros((n_res, n_res), dtype=bool)
+    hbond[donor[bonded], acceptor[bonded]] = True
+
+    # hbond(donor, acceptor) for index arrays, False outside of the structure
+    def test_bond(d, a):
+        inside = (d >= 0) & (d < n_res) & (a >= 0) & (a < n_res)
+        result = np.zeros(np.broadcast(d, a).shape, dtype=bool)
+        result[inside] = hbond[np.broadcast_to(d, result.shape)[inside], np.broadcast_to(a, result.shape)[inside]]
+        return result
+
+    index = np.arange(n_res)
+
+    # n-turns starting at residue i: CO of i bonded to NH of i+n without chain break
+    def turn_starts(n):
+        starts = np.zeros(n_res, dtype=bool)
+        i = index[:max(n_res - n, 0)]
+        starts[i] = test_bond(i + n, i) & _no_break(breaks, chain_start, i, i + n)
+        return starts
+
+    # beta bridges between residues i and j >= i+3 whose neighbours exist without chain breaks
+    i, j = np.triu_indices(n_res, 3)
+    inner = (i >= 1) & (j + 1 < n_res) & (i + 4 < n_res)
+    i, j = i[inner], j[inner]
+    bridge_ok = _no_break(breaks, chain_start, i - 1, i + 1) & _no_break(breaks, chain_start, j - 1, j + 1)
+    i, j = i[bridge_ok], j[bridge_ok]
+    parallel = (test_bond(i + 1, j) & test_bond(j, i - 1)) | (test_bond(j + 1, i) & test_bond(i, j - 1))
+    antiparallel = ~parallel & ((test_bond(i + 1, j - 1) & test_bond(j + 1, i - 1)) | (test_bond(j, i) & test_bond(i, j)))
+    bridges = sorted([(a, b, 'p') for a, b in zip(i[parallel], j[parallel])] + [(a, b, 'a') for a, b in zip(i[antiparallel], j[antiparallel])])
+
+    # ladders: consecutive bridges of the same type
+    ladders = []
+    for a, b, kind in bridges:
+        for ladder in ladders:
+            if ladder['type'] != kind or a != ladder['i'][-1] + 1:
+                continue
+            if kind == 'p' and ladder['j'][-1] + 1 == b:
+                ladder['i'].append(a)
+                ladder['j'].append(b)
+                break
+            if kind == 'a' and ladder['j'][0] - 1 == b:
+                ladder['i'].append(a)
+                ladder['j'].insert(0, b)
+                break
+        else:
+            ladders.append({'type': kind, 'i': [a], 'j': [b], 'links': []})
+
+    # ladders of the same type connected by a beta bulge
+    for n, first in enumerate(ladders):
+        for second in ladders[n + 1:]:
+            ibi, iei, jbi, jei = first['i'][0], first['i'][-1], first['j'][0], first['j'][-1]
+            ibj, iej, jbj, jej = second['i'][0], second['i'][-1], second['j'][0], second['j'][-1]
+            if (first['type'] != second['type'] or not _no_break(breaks, chain_start, min(ibi, ibj), max(iei, iej))
+                    or not _no_break(breaks, chain_start, min(jbi, jbj), max(jei, jej)) or not 0 <= ibj - iei < 6 or (iei >= ibj and ibi <= iej)):
+                continue
+            if first['type'] == 'p':
+                bulge = (0 <= jbj - jei < 6 and ibj - iei < 3) or 0 <= jbj - jei < 3
+            else:
+                bulge = (0 <= jbi - jej < 6 and ibj - iei < 3) or 0 <= jbi - jej < 3
+            if bulge:
+                first['links'].append(second)
+                second['links'].append(first)
+
+    # strands for ladders longer than one bridge or connected by bulges, isolated bridges otherwise,
+    # residues between ladders connected by a bulge are part of the strand
+    for ladder in ladders:
+        strand = len(ladder['i']) > 1 or len(ladder['links']) > 0
+        ranges = [(ladder['i'][0], ladder['i'][-1]), (ladder['j'][0], ladder['j'][-1])]
+        for link in ladder['links']:
+            ranges += [(min(ladder['i'][0], link['i'][0]), max(ladder['i'][-1], link['i'][-1])),
+                    (min(ladder['j'][0], link['j'][0]), max(ladder['j'][-1], link['j'][-1]))]
+        for start, end in ranges:
+            for r in range(start, end + 1):
+                if ss[r] != 'E':
+                    ss[r] = 'E' if strand else 'B'
+
+    # alpha helices overwrite strands, 3-10 and pi helices only fill residues without other structure
+    for n, letter in [(4, 'H'), (3, 'G'), (5, 'I')]:
+        starts = turn_starts(n)
+        for r in np.flatnonzero(starts[1:] & starts[:-1]) + 1:
+            if r + n >= n_res:
+                continue
+            if letter == 'H':
+                ss[r:r + n] = 'H'
+            elif np.isin(ss[r:r + n], ['-', letter]).all():
+                ss[r:r + n] = letter
+
+    return ss
@@ -0,0 +1,132 @@
+####################################
+#################### Filter functions
+####################################
+### Import dependencies
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from .generic_utils import calculate_averages, check_filter_values
+
+# metrics of the MPNN design statistics grouped by the stage that produces them, in order of increasing cost:
+# AF2 complex prediction, geometry of the unrelaxed models, binder alone prediction and Rosetta relaxation and scoring
+filter_stages = {
+    'af2': ['pLDDT', 'pTM', 'i_pTM', 'pAE', 'i_pAE'],
+    'geometry': ['i_pLDDT', 'ss_pLDDT', 'Unrelaxed_Clashes', 'Hotspot_RMSD', 'Target_RMSD', 'Interface_Helix%', 'Interface_BetaSheet%',
+                'Interface_Loop%', 'Binder_Helix%', 'Binder_BetaSheet%', 'Binder_Loop%'],
+    'binder': ['Binder_pLDDT', 'Binder_pTM', 'Binder_pAE', 'Binder_RMSD'],
+    'interface': ['Relaxed_Clashes', 'Binder_Energy_Score', 'Surface_Hydrophobicity', 'ShapeComplementarity', 'PackStat', 'dG', 'dSASA',
+                'dG/dSASA', 'Interface_SASA_%', 'Interface_Hydrophobicity', 'n_InterfaceResidues', 'n_InterfaceHbonds', 'InterfaceHbondsPercentage',
+                'n_InterfaceUnsatHbonds', 'InterfaceUnsatHbondsPercentage', 'InterfaceAAs']
+}
+
+# labels of the binder alone statistics in the design statistics
+binder_filter_labels = {'pLDDT': 'Binder_pLDDT', 'pTM': 'Binder_pTM', 'pAE': 'Binder_pAE', 'Binder_RMSD': 'Binder_RMSD'}
+
+# metric of a filter label, e.g. Average_dG or 3_dG are dG
+def filter_metric(label):
+    return label.split('_', 1)[-1]
+
+# whether a filter has a threshold, the interface amino acid filters have one per amino acid
+def has_threshold(label, conditions):
+    if filter_metric(label) == 'InterfaceAAs':
+        return any(aa_conditions["threshold"] is not None for aa_conditions in conditions.values())
+    return conditions["threshold"] is not None
+
+# active filters of the given stage, filters without threshold are skipped
+def stage_filters(filters, stage):
+    stage_metrics = set(filter_stages[stage])
+    return {label: conditions for label, conditions in filters.items()
+            if filter_metric(label) in stage_metrics and has_threshold(label, conditions)}
+
+# design statistics as filter labels, averages and per model values of the complex and binder alone statistics computed so far
+def design_filter_values(mpnn_complex_statistics, binder_statistics):
+    values = {}
+    for prefix, statistics in [('Average_', calculate_averages(mpnn_complex_statistics, handle_aa=True) if mpnn_complex_statistics else {})] + \
+                                [(f'{model}_', mpnn_complex_statistics[model]) for model in mpnn_complex_statistics]:
+        values.update({prefix + label: value for label, value in statistics.items()})
+
+    binder_averages = calculate_averages(binder_statistics) if binder_statistics else {}
+    for prefix, statistics in [('Average_', binder_averages)] + [(f'{model}_', binder_statistics[model]) for model in binder_statistics]:
+        values.update({prefix + binder_filter_labels[label]: value for label, value in statistics.items() if label in binder_filter_labels})
+
+    return values
+
+# unmet filters of the given stages, checked only once all their metrics are available
+def unmet_stage_filters(values, filters, stages):
+    checked = {}
+    for stage in stages:
+        checked.update(stage_filters(filters, stage))
+    result = check_filter_values(values, checked)
+    return [] if result is True else result
+
+# numeric values of a statistics column, interface amino acid counts are stored as dictionary text and parsed for the given amino acid
+def _filter_column(design_df, label, aa=None):
+    if label not in design_df:
+        return pd.Series(np.nan, index=design_df.index)
+    if aa is None:
+        return pd.to_numeric(design_df[label], errors='coerce')
+    counts = design_df[label].astype(str).str.extract(rf"'{aa}':\s*([-+0-9.eE]+)", expand=False)
+    return pd.to_numeric(counts, errors='coerce')
+
+# compile the filter thresholds into column predicates, returns {filter name: function(design dataframe) -> mask of failing rows},
+# missing values pass as in check_filters
+def compile_filters(filters):
+    def predicate(label, aa, threshold, higher):
+        if higher:
+            return lambda design_df: (_filter_column(design_df, label, aa) < threshold).to_numpy()
+        return lambda design_df: (_filter_column(design_df, label, aa) > threshold).to_numpy()
+
+    predicates = {}
+    for label, conditions in filters.items():
+        if filter_metric(label) == 'InterfaceAAs':
+            for aa, aa_conditions in conditions.items():
+                if aa_conditions["threshold"] is not None:
+                    predicates[f"{label}_{aa}"] = predicate(label, aa, aa_conditions["threshold"], aa_conditions["higher"])
+        elif conditions["threshold"] is not None:
+            predicates[label] = predicate(label, None, conditions["threshold"], conditions["higher"])
+    return predicates
+
+# failing filters of all designs at once, as a boolean dataframe with one column per filter
+def filter_failures(design_df, filters):
+    failures = {name: predicate(design_df) for name, predicate in compile_filters(filters).items()}
+    return pd.DataFrame(failures, index=design_df.index, columns=list(failures), dtype=bool)
+
+# best model of each design by pLDDT, 0 where no model has a pLDDT
+def best_models(design_df):
+    plddts = pd.DataFrame({model: _filter_column(design_df, f'{model}_pLDDT') for model in range(1, 6)})
+    return plddts.fillna(-np.inf).idxmax(axis=1).where(plddts.notna().any(axis=1), 0).astype(int)
+
+# re-filter the MPNN design statistics of a design path with new filters, and rebuild the accepted and ranked designs from the relaxed models
+def refilter_designs(design_df, filters, design_paths, design_labels, final_labels, final_csv):
+    failures = filter_failures(design_df, filters)
+    passed = ~failures.any(axis=1).to_numpy()
+
+    # accepted designs need the relaxed model with the best pLDDT
+    design_df = design_df.assign(_best_model=best_models(design_df))
+    accepted_df = design_df[passed & (design_df['_best_model'] > 0).to_numpy()]
+    relaxed_pdbs = [os.path.join(design_paths["MPNN/Relaxed"], f"{design}_model{model}.pdb") for design, model in zip(accepted_df['Design'], accepted_df['_best_model'])]
+    has_relaxed = np.array([os.path.exists(relaxed_pdb) for relaxed_pdb in relaxed_pdbs], dtype=bool)
+    accepted_df = accepted_df[has_relaxed]
+    relaxed_pdbs = [relaxed_pdb for relaxed_pdb, exists in zip(relaxed_pdbs, has_relaxed) if exists]
+
+    # rank by Average_i_pTM, ties keep the order in which designs were generated
+    order = np.argsort(-_filter_column(accepted_df, 'Average_i_pTM').fillna(-np.inf).to_numpy(), kind='stable')
+    accepted_df = accepted_df.iloc[order]
+    relaxed_pdbs = [relaxed_pdbs[i] for i in order]
+
+    # replace the accepted and ranked designs
+    for folder in ["Accepted", "Accepted/Ranked"]:
+        for f in os.listdir(design_paths[folder]):
+            if f.endswith('.pdb'):
+                os.remove(os.path.join(design_paths[folder], f))
+
+    for rank, (design, model, relaxed_pdb) in enumerate(zip(accepted_df['Design'], accepted_df['_best_model'], relaxed_pdbs), start=1):
+        shutil.copy(relaxed_pdb, design_paths["Accepted"])
+        shutil.copyfile(relaxed_pdb, os.path.join(design_paths["Accepted/Ranked"], f"{rank}_{design}_model{model}.pdb"))
+
+    final_df = accepted_df.reindex(columns=design_labels)
+    final_df.insert(0, 'Rank', np.arange(1, len(final_df) + 1))
+    final_df[final_labels].to_csv(final_csv, index=False)
+
+    return failures, accepted_df.drop(columns='_best_model'), int(passed.sum() - len(accepted_df))
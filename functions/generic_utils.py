@@ -4,13 +4,51 @@
 ### Import dependencies
 import os
 import json
+import time
 import jax
+import fcntl
 import shutil
 import zipfile
 import random
 import math
 import pandas as pd
 import numpy as np
+from contextlib import contextmanager
+from .trace_utils import trace_span
+
+# Defaults for advanced settings that older settings files may not define
+advanced_settings_defaults = {
+    "pipeline_cpu_workers": 0,
+    "pipeline_max_pending": 4,
+    "shared_run_state": False,
+    "reuse_design_model": False,
+    "design_length_bucket": 1,
+    "validation_model_memory_gb": 0,
+    "validation_batch_size": 1,
+    "results_store": "csv",
+    "failure_flush_interval": 0,
+    "mpnn_max_identity": 1.0,
+    "use_dssp_binary": False,
+    "relax_workers": 0,
+    "lazy_filters": False,
+    "checkpoints": False,
+    "adaptive_sampling": False,
+    "adaptive_exploration": 0.1,
+    "adaptive_helicity_bins": 4,
+    "trace": False,
+    "metrics_port": 0,
+    "metrics_address": "127.0.0.1",
+}
+
+# exclusive lock on a file shared between workers writing to the same design_path
+@contextmanager
+def file_lock(path):
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 # Define labels for dataframes
 def generate_dataframe_labels():
@@ -52,120 +90,155 @@ def generate_directories(design_path):
 
     return design_paths
 
+# prefixes of per-model and averaged filters, failures are counted for the filter without them
+failure_prefixes = ('Average_', '1_', '2_', '3_', '4_', '5_')
+
+# name of the failure column counting a filter
+def failure_column_name(filter_name):
+    for prefix in failure_prefixes:
+        if filter_name.startswith(prefix):
+            # Strip the prefix and use the remaining part
+            return filter_name.split('_', 1)[1]
+    return filter_name
+
 # generate CSV file for tracking designs not passing filters
 def generate_filter_pass_csv(failure_csv, filter_json):
-    if not os.path.exists(failure_csv):
-        with open(filter_json, 'r') as file:
-            data = json.load(file)
+    with file_lock(failure_csv):
+        if not os.path.exists(failure_csv):
+            with open(filter_json, 'r') as file:
+                data = json.load(file)
         
-        # Create a list of modified keys
-        names = ['Trajectory_logits_pLDDT', 'Trajectory_softmax_pLDDT', 'Trajectory_one-hot_pLDDT', 'Trajectory_final_pLDDT', 'Trajectory_Contacts', 'Trajectory_Clashes', 'Trajectory_WrongHotspot']
-        special_prefixes = ('Average_', '1_', '2_', '3_', '4_', '5_')
-        tracked_filters = set()
-
-        for key in data.keys():
-            processed_name = key  # Use the full key by default
-
-            # Check if the key starts with any special prefixes
-            for prefix in special_prefixes:
-                if key.startswith(prefix):
-                    # Strip the prefix and use the remaining part
-                    processed_name = key.split('_', 1)[1]
-                    break
-
-            # Handle 'InterfaceAAs' with appending amino acids
-            if 'InterfaceAAs' in processed_name:
-                # Generate 20 variations of 'InterfaceAAs' with amino acids appended
-                amino_acids = 'ACDEFGHIKLMNPQRSTVWY'
-                for aa in amino_acids:
-                    variant_name = f"InterfaceAAs_{aa}"
-                    if variant_name not in tracked_filters:
-                        names.append(variant_name)
-                        tracked_filters.add(variant_name)
-            elif processed_name not in tracked_filters:
-                # Add processed name if it hasn't been added before
-                names.append(processed_name)
-                tracked_filters.add(processed_name)
-
-        # make dataframe with 0s
-        df = pd.DataFrame(columns=names)
-        df.loc[0] = [0] * len(names)
-
-        df.to_csv(failure_csv, index=False)
+            # Create a list of modified keys
+            names = ['Trajectory_logits_pLDDT', 'Trajectory_softmax_pLDDT', 'Trajectory_one-hot_pLDDT', 'Trajectory_final_pLDDT', 'Trajectory_Contacts', 'Trajectory_Clashes', 'Trajectory_WrongHotspot']
+            tracked_filters = set()
+
+            for key in data.keys():
+                processed_name = failure_column_name(key)
+
+                # Handle 'InterfaceAAs' with appending amino acids
+                if 'InterfaceAAs' in processed_name:
+                    # Generate 20 variations of 'InterfaceAAs' with amino acids appended
+                    amino_acids = 'ACDEFGHIKLMNPQRSTVWY'
+                    for aa in amino_acids:
+                        variant_name = f"InterfaceAAs_{aa}"
+                        if variant_name not in tracked_filters:
+                            names.append(variant_name)
+                            tracked_filters.add(variant_name)
+                elif processed_name not in tracked_filters:
+                    # Add processed name if it hasn't been added before
+                    names.append(processed_name)
+                    tracked_filters.add(processed_name)
+
+            # make dataframe with 0s
+            df = pd.DataFrame(columns=names)
+            df.loc[0] = [0] * len(names)
+
+            df.to_csv(failure_csv, index=False)
+
+# Failure counts kept in memory and added to the failure CSV in batches
+class FailureCounter:
+    def __init__(self, failure_csv, flush_interval=0):
+        self.failure_csv = failure_csv
+        self.flush_interval = flush_interval
+        self.counts = {}
+        self.last_flush = time.time()
+
+    # count failures of a single filter column or a dictionary of failure counts
+    def add(self, failure_column_or_dict):
+        if isinstance(failure_column_or_dict, dict):
+            for filter_name, count in failure_column_or_dict.items():
+                column = failure_column_name(filter_name)
+                self.counts[column] = self.counts.get(column, 0) + count
+        else:
+            column = failure_column_name(failure_column_or_dict)
+            self.counts[column] = self.counts.get(column, 0) + 1
+
+        self.maybe_flush()
+
+    # count the unmet filter conditions of a design, each filter once whether it failed for the average or single models
+    def add_filter_failures(self, unmet_conditions):
+        self.add({column: 1 for column in set(failure_column_name(condition) for condition in unmet_conditions)})
+
+    def maybe_flush(self):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    # add counts to the CSV, other workers writing the same file are merged under the lock
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.counts:
+            return
+
+        with file_lock(self.failure_csv):
+            failure_df = pd.read_csv(self.failure_csv)
+            for column, count in self.counts.items():
+                if column in failure_df.columns:
+                    failure_df[column] += count
+                else:
+                    failure_df[column] = count
+
+            # replace the file in one step so that an interrupted write does not lose earlier counts
+            tmp_csv = self.failure_csv + '.tmp'
+            failure_df.to_csv(tmp_csv, index=False)
+            os.replace(tmp_csv, self.failure_csv)
+
+        self.counts = {}
+
+# failure counters of this process by failure CSV, used by update_failures
+failure_counters = {}
+
+def get_failure_counter(failure_csv, flush_interval=0):
+    if failure_csv not in failure_counters:
+        failure_counters[failure_csv] = FailureCounter(failure_csv, flush_interval)
+    return failure_counters[failure_csv]
 
 # update failure rates from trajectories and early predictions
 def update_failures(failure_csv, failure_column_or_dict):
-    failure_df = pd.read_csv(failure_csv)
-    
-    def strip_model_prefix(name):
-        # Strips the model-specific prefix if it exists
-        parts = name.split('_')
-        if parts[0].isdigit():
-            return '_'.join(parts[1:])
-        return name
-    
-    # update dictionary coming from complex prediction
-    if isinstance(failure_column_or_dict, dict):
-        # Update using a dictionary of failures
-        for filter_name, count in failure_column_or_dict.items():
-            stripped_name = strip_model_prefix(filter_name)
-            if stripped_name in failure_df.columns:
-                failure_df[stripped_name] += count
-            else:
-                failure_df[stripped_name] = count
-    else:
-        # Update a single column from trajectory generation
-        failure_column = strip_model_prefix(failure_column_or_dict)
-        if failure_column in failure_df.columns:
-            failure_df[failure_column] += 1
-        else:
-            failure_df[failure_column] = 1
-    
-    failure_df.to_csv(failure_csv, index=False)
+    get_failure_counter(failure_csv).add(failure_column_or_dict)
 
 # Check if number of trajectories generated
-def check_n_trajectories(design_paths, advanced_settings):
-    n_trajectories = [f for f in os.listdir(design_paths["Trajectory/Relaxed"]) if f.endswith('.pdb') and not f.startswith('.')]
+def check_n_trajectories(design_paths, advanced_settings, run_state=None, design_index=None):
+    if run_state is not None:
+        # relaxed trajectories of all workers sharing the design path, running and terminated trajectories are not counted
+        n_trajectories = run_state.n_trajectories('finished')
+    elif design_index is not None:
+        n_trajectories = design_index.n_trajectories()
+    else:
+        n_trajectories = len([f for f in os.listdir(design_paths["Trajectory/Relaxed"]) if f.endswith('.pdb') and not f.startswith('.')])
 
-    if advanced_settings["max_trajectories"] is not False and len(n_trajectories) >= advanced_settings["max_trajectories"]:
-        print(f"Target number of {str(len(n_trajectories))} trajectories reached, stopping execution...")
+    if advanced_settings["max_trajectories"] is not False and n_trajectories >= advanced_settings["max_trajectories"]:
+        print(f"Target number of {str(n_trajectories)} trajectories reached, stopping execution...")
         return True
     else:
         return False
 
 # Check if we have required number of accepted targets, rank them, and analyse sequence and structure properties
-def check_accepted_designs(design_paths, mpnn_csv, final_labels, final_csv, advanced_settings, target_settings, design_labels):
-    accepted_binders = [f for f in os.listdir(design_paths["Accepted"]) if f.endswith('.pdb') and not f.startswith('.')]
+def check_accepted_designs(design_paths, mpnn_csv, final_labels, final_csv, advanced_settings, target_settings, design_labels, run_state=None, results_store=None, design_index=None):
+    # designs accepted by all workers sharing the design path
+    if run_state is not None:
+        n_accepted = run_state.n_accepted()
+    elif design_index is not None:
+        n_accepted = design_index.n_accepted()
+    else:
+        accepted_binders = [f for f in os.listdir(design_paths["Accepted"]) if f.endswith('.pdb') and not f.startswith('.')]
+        n_accepted = len(accepted_binders)
+
+    if n_accepted < target_settings["number_of_final_designs"]:
+        return False
 
-    if len(accepted_binders) >= target_settings["number_of_final_designs"]:
-        print(f"Target number {str(len(accepted_binders))} of designs reached! Reranking...")
+    # ranking is repeated by every worker that stops, so the last one includes all accepted designs
+    with file_lock(final_csv), trace_span("ranking"):
+        print(f"Target number {str(n_accepted)} of designs reached! Reranking...")
 
         # clear the Ranked folder in case we added new designs in the meantime so we rerank them all
         for f in os.listdir(design_paths["Accepted/Ranked"]):
             os.remove(os.path.join(design_paths["Accepted/Ranked"], f))
 
-        # load dataframe of designed binders
-        design_df = pd.read_csv(mpnn_csv)
-        design_df = design_df.sort_values('Average_i_pTM', ascending=False)
-        
-        # create final csv dataframe to copy matched rows, initialize with the column labels
-        final_df = pd.DataFrame(columns=final_labels)
-
-        # check the ranking of the designs and copy them with new ranked IDs to the folder
-        rank = 1
-        for _, row in design_df.iterrows():
-            for binder in accepted_binders:
-                target_settings["binder_name"], model = binder.rsplit('_model', 1)
-                if target_settings["binder_name"] == row['Design']:
-                    # rank and copy into ranked folder
-                    row_data = {'Rank': rank, **{label: row[label] for label in design_labels}}
-                    final_df = pd.concat([final_df, pd.DataFrame([row_data])], ignore_index=True)
-                    old_path = os.path.join(design_paths["Accepted"], binder)
-                    new_path = os.path.join(design_paths["Accepted/Ranked"], f"{rank}_{target_settings['binder_name']}_model{model.rsplit('.', 1)[0]}.pdb")
-                    shutil.copyfile(old_path, new_path)
-
-                    rank += 1
-                    break
+        if design_index is not None:
+            final_df = rank_indexed_designs(design_index, design_paths, mpnn_csv, final_labels, design_labels, results_store)
+        else:
+            accepted_binders = [f for f in os.listdir(design_paths["Accepted"]) if f.endswith('.pdb') and not f.startswith('.')]
+            final_df = rank_listed_designs(accepted_binders, design_paths, mpnn_csv, final_labels, design_labels, results_store)
 
         # save the final_df to final_csv
         final_df.to_csv(final_csv, index=False)
@@ -177,10 +250,65 @@ def check_accepted_designs(design_paths, mpnn_csv, final_labels, final_csv, adva
         if advanced_settings["zip_plots"]:
             zip_and_empty_folder(design_paths["Trajectory/Plots"], '.png')
 
-        return True
+    return True
 
+# rank accepted designs from the design index and copy them with new ranked IDs to the Ranked folder
+def rank_indexed_designs(design_index, design_paths, mpnn_csv, final_labels, design_labels, results_store=None):
+    # statistics of designs accepted by earlier runs or other workers
+    def load_rows(designs):
+        if results_store is not None:
+            design_df = results_store.read(mpnn_csv, designs=designs)
+        else:
+            design_df = pd.read_csv(mpnn_csv)
+            design_df = design_df[design_df['Design'].isin(designs)]
+        return {row['Design']: row for row in design_df.to_dict('records')}
+
+    final_rows = []
+    for rank, (design, binder, row) in enumerate(design_index.ranked(load_rows), start=1):
+        final_rows.append({'Rank': rank, **{label: row.get(label) for label in design_labels}})
+        model = binder.rsplit('_model', 1)[1]
+        old_path = os.path.join(design_paths["Accepted"], binder)
+        new_path = os.path.join(design_paths["Accepted/Ranked"], f"{rank}_{design}_model{model.rsplit('.', 1)[0]}.pdb")
+        shutil.copyfile(old_path, new_path)
+
+    return pd.DataFrame(final_rows, columns=final_labels)
+
+# rank accepted designs found in the Accepted folder against the MPNN statistics
+def rank_listed_designs(accepted_binders, design_paths, mpnn_csv, final_labels, design_labels, results_store=None):
+    # load dataframe of designed binders, only the accepted ones when they can be looked up in the results store
+    if results_store is not None:
+        design_df = results_store.read(mpnn_csv, designs={binder.rsplit('_model', 1)[0] for binder in accepted_binders})
     else:
-        return False
+        design_df = pd.read_csv(mpnn_csv)
+    design_df = design_df.sort_values('Average_i_pTM', ascending=False)
+    
+    # create final csv dataframe to copy matched rows, initialize with the column labels
+    final_df = pd.DataFrame(columns=final_labels)
+
+    # check the ranking of the designs and copy them with new ranked IDs to the folder
+    rank = 1
+    for _, row in design_df.iterrows():
+        for binder in accepted_binders:
+            design_name, model = binder.rsplit('_model', 1)
+            if design_name == row['Design']:
+                # rank and copy into ranked folder
+                row_data = {'Rank': rank, **{label: row[label] for label in design_labels}}
+                final_df = pd.concat([final_df, pd.DataFrame([row_data])], ignore_index=True)
+                old_path = os.path.join(design_paths["Accepted"], binder)
+                new_path = os.path.join(design_paths["Accepted/Ranked"], f"{rank}_{design_name}_model{model.rsplit('.', 1)[0]}.pdb")
+                shutil.copyfile(old_path, new_path)
+
+                rank += 1
+                break
+
+    return final_df
+
+# Sample binder length, snapped to multiples of the length bucket so that reused models compile few distinct lengths
+def sample_binder_length(target_settings, advanced_settings):
+    min_length, max_length = min(target_settings["lengths"]), max(target_settings["lengths"])
+    bucket = max(1, int(advanced_settings["design_length_bucket"]))
+    samples = np.arange(min_length, max_length + 1, bucket)
+    return np.random.choice(samples)
 
 # Load required helicity value
 def load_helicity(advanced_settings):
@@ -245,6 +373,10 @@ def perform_advanced_settings_check(advanced_settings, bindcraft_folder):
         if not advanced_settings["dalphaball_path"]:
             advanced_settings["dalphaball_path"] = os.path.join(bindcraft_folder, 'functions', 'DAlphaBall.gcc')
 
+    # fill in settings missing from advanced settings files written for older versions
+    for key, value in advanced_settings_defaults.items():
+        advanced_settings.setdefault(key, value)
+
     # check formatting of omit_AAs setting
         omit_aas = advanced_settings["omit_AAs"]
     if advanced_settings["omit_AAs"] in [None, False, '']:
@@ -282,15 +414,34 @@ def load_af2_models(af_multimer_setting):
     return design_models, prediction_models, multimer_validation
 
 # create csv for insertion of data
-def create_dataframe(csv_file, columns):
-    if not os.path.exists(csv_file):
-        df = pd.DataFrame(columns=columns)
-        df.to_csv(csv_file, index=False)
-
-# insert row of statistics into csv
-def insert_data(csv_file, data_array):
-    df = pd.DataFrame([data_array])
-    df.to_csv(csv_file, mode='a', header=False, index=False)
+def create_dataframe(csv_file, columns, results_store=None):
+    with file_lock(csv_file):
+        if not os.path.exists(csv_file):
+            df = pd.DataFrame(columns=columns)
+            df.to_csv(csv_file, index=False)
+
+        if results_store is not None:
+            results_store.create_table(csv_file, columns)
+
+# insert row of statistics into csv, or into the results store if one is used
+def insert_data(csv_file, data_array, results_store=None):
+    with trace_span("csv_write", csv=os.path.basename(csv_file)):
+        if results_store is not None:
+            results_store.insert(csv_file, data_array)
+            return
+
+        df = pd.DataFrame([data_array])
+        with file_lock(csv_file):
+            df.to_csv(csv_file, mode='a', header=False, index=False)
+
+# write statistics kept in the results store to their CSV files
+def export_results(csv_files, results_store=None):
+    if results_store is None:
+        return
+
+    for csv_file in csv_files:
+        with file_lock(csv_file):
+            results_store.export_csv(csv_file)
 
 # save generated sequence
 def save_fasta(design_name, sequence, design_paths):
@@ -302,12 +453,12 @@ def save_fasta(design_name, sequence, design_paths):
 # clean unnecessary rosetta information from PDB
 def clean_pdb(pdb_file):
     # Read the pdb file and filter relevant lines
-    with open(pdb_file, 'r') as f_in:
-        relevant_lines = [line for line in f_in if line.startswith(('ATOM', 'HETATM', 'MODEL', 'TER', 'END', 'LINK'))]
+    with open(pdb_file, 'rb') as f_in:
+        relevant_lines = [line for line in f_in.read().splitlines(keepends=True) if line.startswith((b'ATOM', b'HETATM', b'MODEL', b'TER', b'END', b'LINK'))]
 
-    # Write the cleaned lines back to the original pdb file
-    with open(pdb_file, 'w') as f_out:
-        f_out.writelines(relevant_lines)
+    # Write the cleaned lines back to the original pdb file in one write
+    with open(pdb_file, 'wb') as f_out:
+        f_out.write(b''.join(relevant_lines))
 
 def zip_and_empty_folder(folder_path, extension):
     folder_basename = os.path.basename(folder_path)
@@ -371,7 +522,10 @@ def calculate_averages(statistics, handle_aa=False):
 def check_filters(mpnn_data, design_labels, filters):
     # check mpnn_data against labels
     mpnn_dict = {label: value for label, value in zip(design_labels, mpnn_data)}
+    return check_filter_values(mpnn_dict, filters)
 
+# check design statistics given as a dictionary of filter labels against the filter thresholds
+def check_filter_values(mpnn_dict, filters):
     unmet_conditions = []
 
     # check filters against thresholds
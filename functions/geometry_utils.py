@@ -0,0 +1,111 @@
+####################################
+################# Geometry functions
+####################################
+### Import dependencies
+import numpy as np
+from scipy.spatial import cKDTree
+
+# all pairs of points closer than the cutoff, as an (n, 2) array with i < j
+def close_pairs(coords, cutoff):
+    if len(coords) < 2:
+        return np.zeros((0, 2), dtype=int)
+    return cKDTree(coords).query_pairs(cutoff, output_type='ndarray')
+
+# mask of atom pairs counted as clashes, pairs within a residue and between sequential residues of a chain are not,
+# and with inter_chain_only neither are any other pairs within a chain
+def clash_mask(pairs, chain_index, res_index, inter_chain_only=True):
+    i, j = pairs[:, 0], pairs[:, 1]
+    same_chain = chain_index[i] == chain_index[j]
+    valid = ~(same_chain & (np.abs(res_index[i] - res_index[j]) <= 1))
+    if inter_chain_only:
+        valid &= ~same_chain
+    return valid
+
+# number of clashing atom pairs closer than the threshold
+def count_clashes(coords, chain_index, res_index, threshold, inter_chain_only=True):
+    pairs = close_pairs(coords, threshold)
+    return int(clash_mask(pairs, chain_index, res_index, inter_chain_only).sum())
+
+# residues of a with any atom closer than the cutoff to an atom of b, in the order they first appear in a
+def contact_residues(coords_a, res_index_a, coords_b, cutoff):
+    if len(coords_a) == 0 or len(coords_b) == 0:
+        return res_index_a[:0]
+    close_counts = cKDTree(coords_b).query_ball_point(coords_a, cutoff, return_length=True)
+    in_contact = np.flatnonzero(close_counts > 0)
+    residues, first = np.unique(res_index_a[in_contact], return_index=True)
+    return residues[np.argsort(first)]
+
+# place structures next to each other along x, far enough apart that no pairs are found between them
+def _offset_batch(coords_batch, cutoff):
+    coords_batch = np.asarray(coords_batch, dtype=float)
+    extent = np.ptp(coords_batch[..., 0]) + 2 * cutoff + 1
+    offsets = np.zeros((len(coords_batch), 1, 3))
+    offsets[:, 0, 0] = np.arange(len(coords_batch)) * extent
+    return (coords_batch + offsets).reshape(-1, 3)
+
+# clash counts of a batch of structures with the same atoms, e.g. the models of one design, from a single pair query
+def batch_count_clashes(coords_batch, chain_index, res_index, threshold, inter_chain_only=True):
+    n_structures, n_atoms = len(coords_batch), len(chain_index)
+    if n_structures == 0 or n_atoms == 0:
+        return np.zeros(n_structures, dtype=int)
+
+    pairs = close_pairs(_offset_batch(coords_batch, threshold), threshold)
+    structure = pairs[:, 0] // n_atoms
+    valid = clash_mask(pairs % n_atoms, chain_index, res_index, inter_chain_only)
+    return np.bincount(structure[valid], minlength=n_structures)
+
+# contact residues of a batch of structures with the same atoms, a is given by atom indices into each structure
+def batch_contact_residues(coords_batch, atoms_a, res_index_a, atoms_b, cutoff):
+    n_structures = len(coords_batch)
+    coords_batch = np.asarray(coords_batch, dtype=float)
+    if n_structures == 0:
+        return []
+
+    # stack all structures into one query, residues are kept apart by the structure index
+    shifted = _offset_batch(coords_batch, cutoff).reshape(n_structures, -1, 3)
+    coords_a = shifted[:, atoms_a].reshape(-1, 3)
+    coords_b = shifted[:, atoms_b].reshape(-1, 3)
+    structure_a = np.repeat(np.arange(n_structures), len(atoms_a))
+    residues_a = np.tile(res_index_a, n_structures)
+
+    close_counts = cKDTree(coords_b).query_ball_point(coords_a, cutoff, return_length=True) if len(coords_b) else np.zeros(len(coords_a), dtype=int)
+    in_contact = np.flatnonzero(close_counts > 0)
+    keys, first = np.unique(np.stack([structure_a[in_contact], residues_a[in_contact]], axis=-1), axis=0, return_index=True)
+
+    results = []
+    for n in range(n_structures):
+        selected = keys[:, 0] == n
+        results.append(keys[selected, 1][np.argsort(first[selected])])
+    return results
+
+# least squares superposition (Kabsch) of each structure of a batch [B, N, 3] onto the reference [N, 3],
+# computed as Biopython's SVDSuperimposer, returns rotations and translations applied as coords @ rot + tran
+def kabsch_superimpose(reference, coords_batch):
+    reference = np.asarray(reference, dtype=float)
+    coords_batch = np.asarray(coords_batch, dtype=float)
+    n = reference.shape[0]
+
+    # center on centroids
+    coords_centre = coords_batch.sum(axis=1) / n
+    reference_centre = reference.sum(axis=0) / n
+    correlation = np.swapaxes(coords_batch - coords_centre[:, None], 1, 2) @ (reference - reference_centre)
+    u, _, vt = np.linalg.svd(correlation)
+    rot = u @ vt
+
+    # correct reflections
+    reflection = np.linalg.det(rot) < 0
+    vt[reflection, 2] = -vt[reflection, 2]
+    rot[reflection] = u[reflection] @ vt[reflection]
+
+    tran = reference_centre - np.einsum('bi,bij->bj', coords_centre, rot)
+    return rot, tran
+
+# RMSD of each structure of a batch [B, N, 3] to the reference [N, 3] without superposition
+def batch_rmsd(reference, coords_batch):
+    diff = np.asarray(coords_batch, dtype=float) - np.asarray(reference, dtype=float)
+    return np.sqrt((diff * diff).sum(axis=(1, 2)) / diff.shape[1])
+
+# RMSD of each structure of a batch [B, N, 3] to the reference [N, 3] after least squares superposition
+def batch_superimposed_rmsd(reference, coords_batch):
+    rot, tran = kabsch_superimpose(reference, coords_batch)
+    return batch_rmsd(reference, np.asarray(coords_batch, dtype=float) @ rot + tran[:, None])
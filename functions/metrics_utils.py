@@ -0,0 +1,177 @@
+####################################
+################### Metrics functions
+####################################
+### Import dependencies
+import os
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import jax
+
+# upper bounds in seconds of the stage duration histogram buckets
+stage_duration_buckets = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+
+# counters of the design loop and their help text, reported as bindcraft_<name>_total
+run_counters = {
+    'trajectories_started': 'Hallucination trajectories started',
+    'trajectories_terminated': 'Hallucination trajectories terminated early, by reason',
+    'mpnn_sequences_validated': 'MPNN sequences predicted in complex with the target',
+    'af2_filter_failures': 'MPNN designs that failed the AF2 confidence filters',
+    'designs_rejected': 'MPNN designs that failed the design filters',
+    'designs_accepted': 'MPNN designs that passed all filters'
+}
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for k, v in labels.items()}
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped.items()) + '}'
+
+# resident memory of this process and memory available on the host in bytes, from /proc on Linux
+def host_memory():
+    memory = {}
+    for proc_file, field, name in [('/proc/self/status', 'VmRSS:', 'rss'), ('/proc/meminfo', 'MemAvailable:', 'available')]:
+        if os.path.exists(proc_file):
+            with open(proc_file) as f:
+                for line in f:
+                    if line.startswith(field):
+                        memory[name] = int(line.split()[1]) * 1024
+    return memory
+
+# memory in use and memory limit in bytes of each local JAX device that reports them
+def gpu_memory():
+    memory = {}
+    for device in jax.local_devices():
+        stats = device.memory_stats() if hasattr(device, 'memory_stats') else None
+        if stats:
+            memory[str(device.id)] = (stats.get('bytes_in_use', 0), stats.get('bytes_limit'))
+    return memory
+
+# counters, stage duration histograms and gauges of a run, served in the Prometheus text format by a background thread
+# so that cluster monitoring can detect stalled or unproductive runs
+class RunMetrics:
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.start_time = time.time()
+        self.last_progress = self.start_time
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    # count an event of the design loop, e.g. inc('trajectories_terminated', reason='Clashing')
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.last_progress = time.time()
+
+    # add the duration of a stage to its histogram, used as a tracer listener
+    def observe_span(self, name, duration, attributes=None):
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {'buckets': [0] * len(stage_duration_buckets), 'sum': 0.0, 'count': 0})
+            for n, bound in enumerate(stage_duration_buckets):
+                if duration <= bound:
+                    histogram['buckets'][n] += 1
+            histogram['sum'] += duration
+            histogram['count'] += 1
+
+    # gauge read when the metrics are scraped, fn() returns its current value
+    def add_gauge(self, name, help_text, fn):
+        self.gauges[name] = (help_text, fn)
+
+    def _metric(self, lines, name, metric_type, help_text, samples):
+        lines.append(f"# HELP bindcraft_{name} {help_text}")
+        lines.append(f"# TYPE bindcraft_{name} {metric_type}")
+        for suffix, labels, value in samples:
+            lines.append(f"bindcraft_{name}{suffix}{_format_labels({**self.labels, **labels})} {value}")
+
+    # all metrics in the Prometheus text exposition format
+    def render(self):
+        now = time.time()
+        hours = max(now - self.start_time, 1.0) / 3600
+
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: {**histogram, 'buckets': list(histogram['buckets'])} for name, histogram in self.histograms.items()}
+            last_progress = self.last_progress
+
+        lines = []
+        self._metric(lines, 'info', 'gauge', 'Run labels', [('', {}, 1)])
+
+        # counters are reported from zero, so that rates can be computed from the start of the run
+        for name, help_text in run_counters.items():
+            samples = [('', dict(labels), value) for (counter, labels), value in sorted(counters.items()) if counter == name]
+            self._metric(lines, name + '_total', 'counter', help_text, samples or [('', {}, 0)])
+
+        samples = []
+        for stage, histogram in sorted(histograms.items()):
+            for bound, count in zip(stage_duration_buckets, histogram['buckets']):
+                samples.append(('_bucket', {'stage': stage, 'le': bound}, count))
+            samples.append(('_bucket', {'stage': stage, 'le': '+Inf'}, histogram['count']))
+            samples.append(('_sum', {'stage': stage}, round(histogram['sum'], 6)))
+            samples.append(('_count', {'stage': stage}, histogram['count']))
+        self._metric(lines, 'stage_duration_seconds', 'histogram', 'Duration of the design stages', samples)
+
+        # throughput and progress, a stalled run stops updating the last progress time
+        accepted = sum(value for (counter, _), value in counters.items() if counter == 'designs_accepted')
+        trajectories = sum(value for (counter, _), value in counters.items() if counter == 'trajectories_started')
+        self._metric(lines, 'uptime_seconds', 'gauge', 'Seconds since the run started', [('', {}, round(now - self.start_time, 3))])
+        self._metric(lines, 'designs_per_hour', 'gauge', 'Accepted designs per hour since the run started', [('', {}, round(accepted / hours, 4))])
+        self._metric(lines, 'trajectories_per_hour', 'gauge', 'Trajectories started per hour since the run started', [('', {}, round(trajectories / hours, 4))])
+        self._metric(lines, 'last_progress_timestamp_seconds', 'gauge', 'Unix time of the last counted event', [('', {}, round(last_progress, 3))])
+
+        memory = host_memory()
+        if 'rss' in memory:
+            self._metric(lines, 'host_memory_rss_bytes', 'gauge', 'Resident memory of the main process', [('', {}, memory['rss'])])
+        if 'available' in memory:
+            self._metric(lines, 'host_memory_available_bytes', 'gauge', 'Memory available on the host', [('', {}, memory['available'])])
+
+        devices = gpu_memory()
+        if devices:
+            self._metric(lines, 'gpu_memory_used_bytes', 'gauge', 'Device memory in use', [('', {'device': device}, used) for device, (used, _) in devices.items()])
+            self._metric(lines, 'gpu_memory_limit_bytes', 'gauge', 'Device memory available to JAX',
+                        [('', {'device': device}, limit) for device, (_, limit) in devices.items() if limit is not None])
+
+        for name, (help_text, fn) in self.gauges.items():
+            self._metric(lines, name, 'gauge', help_text, [('', {}, fn())])
+
+        return '\n'.join(lines) + '\n'
+
+    # serve the metrics at http://address:port/metrics from a daemon thread, the run continues without them if the port is taken
+    def start_server(self, address, port):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # scrapes are not logged to stdout
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((address, port), MetricsHandler)
+        except OSError as e:
+            print(f"Could not serve metrics on {address}:{port}, continuing without them: {e}")
+            return False
+
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+        print(f"Serving run metrics at http://{address}:{self.server.server_address[1]}/metrics")
+        return True
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,105 @@
+####################################
+###################### PDB functions
+####################################
+### Import dependencies
+import numpy as np
+
+# atom records of a PDB file, one entry per ATOM or HETATM line
+pdb_atom_dtype = np.dtype([
+    ('model', 'i4'), ('record', 'U6'), ('serial', 'i4'), ('name', 'U4'), ('altloc', 'U1'), ('resname', 'U3'),
+    ('chain', 'U1'), ('resseq', 'i4'), ('icode', 'U1'), ('coord', 'f4', 3), ('occupancy', 'f8'), ('bfactor', 'f8'), ('element', 'U2')
+])
+
+# fixed PDB columns of the atom record fields
+pdb_atom_columns = {
+    'record': (0, 6), 'serial': (6, 11), 'name': (12, 16), 'altloc': (16, 17), 'resname': (17, 20), 'chain': (21, 22),
+    'resseq': (22, 26), 'icode': (26, 27), 'x': (30, 38), 'y': (38, 46), 'z': (46, 54), 'occupancy': (54, 60),
+    'bfactor': (60, 66), 'element': (76, 78)
+}
+
+# gather the first width characters of the given lines into a byte matrix, padding short lines with spaces
+def _line_matrix(data, starts, lengths, width):
+    columns = np.arange(width)
+    index = np.minimum(starts[:, None] + columns, len(data) - 1)
+    matrix = np.asarray(data)[index]
+    matrix[columns >= lengths[:, None]] = ord(' ')
+    return matrix
+
+def _column(matrix, field):
+    start, end = pdb_atom_columns[field]
+    return np.ascontiguousarray(matrix[:, start:end]).view(f'S{end - start}')[:, 0]
+
+def _text_column(matrix, field):
+    return np.char.strip(_column(matrix, field).astype('U'))
+
+def _number_column(matrix, field, dtype, default=0):
+    values = np.char.strip(_column(matrix, field))
+    return np.where(values == b'', str(default).encode(), values).astype(dtype)
+
+# read ATOM and HETATM records into a structured array, the file can be memory mapped instead of being read at once
+def read_pdb_atoms(pdb_file, mmap=False):
+    data = np.memmap(pdb_file, dtype=np.uint8, mode='r') if mmap else np.fromfile(pdb_file, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=pdb_atom_dtype)
+
+    # line boundaries, the last line may not end with a newline
+    ends = np.flatnonzero(data == ord('\n'))
+    if len(ends) == 0 or ends[-1] != len(data) - 1:
+        ends = np.append(ends, len(data))
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    lengths = ends - starts
+    carriage_return = (lengths > 0) & (np.asarray(data)[np.maximum(ends - 1, 0)] == ord('\r'))
+    lengths = lengths - carriage_return
+
+    # record types from the first six characters, models are numbered from 0 in the order they appear
+    records = _line_matrix(data, starts, lengths, 6).view('S6')[:, 0]
+    is_atom = (records == b'ATOM  ') | (records == b'HETATM')
+    model = np.maximum(np.cumsum(records == b'MODEL ') - 1, 0)
+
+    matrix = _line_matrix(data, starts[is_atom], lengths[is_atom], 80)
+    atoms = np.zeros(len(matrix), dtype=pdb_atom_dtype)
+    atoms['model'] = model[is_atom]
+    for field in ['record', 'name', 'altloc', 'resname', 'chain', 'icode', 'element']:
+        atoms[field] = _text_column(matrix, field)
+    atoms['serial'] = _number_column(matrix, 'serial', int)
+    atoms['resseq'] = _number_column(matrix, 'resseq', int)
+    atoms['coord'] = np.stack([_number_column(matrix, axis, float) for axis in 'xyz'], axis=-1)
+    atoms['occupancy'] = _number_column(matrix, 'occupancy', float)
+    atoms['bfactor'] = _number_column(matrix, 'bfactor', float)
+
+    # guess missing elements from the atom name, e.g. 1HB is hydrogen
+    missing = atoms['element'] == ''
+    if missing.any():
+        atoms['element'][missing] = [next((c for c in name if c.isalpha()), '') for name in atoms['name'][missing]]
+
+    # keep only the first alternate location of atoms with several
+    first_altloc = atoms['altloc'][atoms['altloc'] != '']
+    if len(first_altloc):
+        atoms = atoms[(atoms['altloc'] == '') | (atoms['altloc'] == first_altloc[0])]
+
+    return atoms
+
+# atom name in PDB columns 13-16, names shorter than four characters of single letter elements start in column 14
+def _format_atom_name(name, element):
+    if len(name) < 4 and len(element) == 1:
+        return f" {name:<3}"
+    return f"{name:<4}"
+
+# write atom records as a PDB file, with TER records between chains
+def write_pdb_atoms(atoms, pdb_file):
+    lines = []
+    previous = None
+    for atom in atoms:
+        if previous is not None and (atom['model'], atom['chain']) != previous:
+            lines.append("TER\n")
+        previous = (atom['model'], atom['chain'])
+        x, y, z = atom['coord']
+        lines.append(f"{atom['record']:<6}{atom['serial'] % 100000:>5} {_format_atom_name(atom['name'], atom['element'])}{atom['altloc']:1}{atom['resname']:>3} "
+                    f"{atom['chain']:1}{atom['resseq']:>4}{atom['icode']:1}   {x:8.3f}{y:8.3f}{z:8.3f}{atom['occupancy']:6.2f}{atom['bfactor']:6.2f}"
+                    f"          {atom['element']:>2}  \n")
+    if len(atoms):
+        lines.append("TER\n")
+    lines.append("END\n")
+
+    with open(pdb_file, 'w') as f:
+        f.writelines(lines)
@@ -0,0 +1,263 @@
+####################################
+################# Pipeline functions
+####################################
+### Import dependencies
+import os
+import time
+import signal
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future, FIRST_COMPLETED, wait
+from .pyrosetta_utils import init_pyrosetta, relax_and_score
+from .trace_utils import tracer, trace_span, trace_context, traced_call
+from .biopython_utils import StructureAnalysis, batch_clash_scores, batch_hotspot_residues, batch_target_rmsd, target_pdb_rmsd, batch_unaligned_rmsd, load_structure, validate_design_sequence
+
+# initialise a forked worker, workers ignore SIGTERM and finish their jobs until the main process stops at a stage boundary and shuts the pool down
+def init_worker(dalphaball_path):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    init_pyrosetta(dalphaball_path)
+
+# CPU stage of the design loop, runs jobs inline or in a pool of PyRosetta workers
+class CPUStage:
+    def __init__(self, n_workers, max_pending, dalphaball_path):
+        self.n_workers = n_workers
+        self.max_pending = max(1, max_pending)
+        self.jobs = deque()
+        self.executor = None
+
+        if n_workers > 0:
+            # workers are forked so they do not re-run the main script, and before JAX claims the GPU
+            self.executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork'),
+                                                initializer=init_worker, initargs=(dalphaball_path,))
+            self.executor.submit(time.sleep, 0).result()
+            print(f"Started {n_workers} CPU workers for pipelined relaxation and scoring")
+
+    # submit job, blocking while the number of unfinished jobs is at the queue limit,
+    # spans recorded by the job carry the name and length of the design in its context
+    def submit(self, kind, context, fn, *args):
+        trace_attributes = {'design': context.get('mpnn_design_name', context['design_name']), 'length': context['length']}
+        if self.executor is None:
+            future = Future()
+            future.set_result(traced_call(tracer.trace_file, trace_attributes, fn, *args))
+        else:
+            running = [job[2] for job in self.jobs if not job[2].done()]
+            while len(running) >= self.max_pending:
+                wait(running, return_when=FIRST_COMPLETED)
+                running = [future for future in running if not future.done()]
+            future = self.executor.submit(traced_call, tracer.trace_file, trace_attributes, fn, *args)
+
+        self.jobs.append((kind, context, future))
+
+    # return finished jobs as (kind, context, result), optionally waiting for at least one
+    def collect(self, block=False):
+        if block and self.jobs and not any(job[2].done() for job in self.jobs):
+            wait([job[2] for job in self.jobs], return_when=FIRST_COMPLETED)
+
+        finished = [job for job in self.jobs if job[2].done()]
+        for job in finished:
+            self.jobs.remove(job)
+
+        return [(kind, context, future.result()) for kind, context, future in finished]
+
+    # wait for all submitted jobs to finish
+    def drain(self):
+        results = []
+        while self.jobs:
+            results += self.collect(block=True)
+        return results
+
+    def pending(self):
+        return len(self.jobs)
+
+    # wait for running jobs, jobs that have not started yet are dropped with cancel_pending, e.g. when the run is interrupted
+    def shutdown(self, cancel_pending=False):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=cancel_pending)
+            self.executor = None
+
+# pool of PyRosetta workers that relax and score all models of a design at the same time
+class RelaxPool:
+    def __init__(self, n_workers, dalphaball_path):
+        self.n_workers = n_workers
+        self.owner_pid = os.getpid()
+        self.executor = None
+
+        if n_workers > 0:
+            # like the CPU stage, workers are forked before JAX claims the GPU
+            self.executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork'),
+                                                initializer=init_worker, initargs=(dalphaball_path,))
+            self.executor.submit(time.sleep, 0).result()
+            print(f"Started {n_workers} PyRosetta workers for relaxing and scoring models in parallel")
+
+    # relax and score the models, returns the score_interface results and relaxed structures in order
+    def relax_and_score(self, pdb_files, relaxed_pdb_paths, binder_chain="B"):
+        # processes forked from the owner, e.g. CPU stage workers, cannot use the pool and run the models one by one
+        if self.executor is None or os.getpid() != self.owner_pid:
+            return [relax_and_score(pdb_file, relaxed_pdb_path, binder_chain) for pdb_file, relaxed_pdb_path in zip(pdb_files, relaxed_pdb_paths)]
+        n = len(pdb_files)
+        return list(self.executor.map(traced_call, [tracer.trace_file] * n, [tracer.context] * n, [relax_and_score] * n, pdb_files, relaxed_pdb_paths, [binder_chain] * n))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+# relax pool of this process, models are relaxed in the calling process until a pool is started
+relax_pool = RelaxPool(0, None)
+
+def start_relax_pool(n_workers, dalphaball_path):
+    global relax_pool
+    relax_pool = RelaxPool(n_workers, dalphaball_path)
+    return relax_pool
+
+# relax and analyse a hallucinated trajectory
+def analyse_trajectory(design_name, trajectory_pdb, trajectory_sequence, advanced_settings, target_settings, design_paths, binder_chain="B"):
+    # Relax binder and analyze interface scores of the relaxed af2 trajectory
+    trajectory_relaxed = os.path.join(design_paths["Trajectory/Relaxed"], design_name + ".pdb")
+    (interface_scores, interface_AA, interface_residues), relaxed_structure = relax_and_score(trajectory_pdb, trajectory_relaxed, binder_chain)
+
+    # parse the trajectory once for all analyses
+    trajectory_structure = StructureAnalysis(trajectory_pdb)
+
+    # Calculate clashes before and after relaxation
+    num_clashes_trajectory = trajectory_structure.clash_score()
+    num_clashes_relaxed = relaxed_structure.clash_score()
+
+    # secondary structure content of starting trajectory binder and interface
+    ss_percentages = trajectory_structure.ss_percentage(advanced_settings, binder_chain)
+
+    # analyze sequence
+    seq_notes = validate_design_sequence(trajectory_sequence, num_clashes_relaxed, advanced_settings)
+
+    # target structure RMSD compared to input PDB
+    target_rmsd = target_pdb_rmsd(trajectory_structure, target_settings["starting_pdb"], target_settings["chains"])
+
+    return {
+        'Unrelaxed_Clashes': num_clashes_trajectory,
+        'Relaxed_Clashes': num_clashes_relaxed,
+        'ss_percentages': ss_percentages,
+        'interface_scores': interface_scores,
+        'InterfaceAAs': interface_AA,
+        'InterfaceResidues': interface_residues,
+        'Notes': seq_notes,
+        'Target_RMSD': target_rmsd
+    }
+
+# paths of the predicted complex models of an MPNN design that exist in the given folder
+def mpnn_model_pdbs(mpnn_design_name, prediction_models, folder):
+    model_pdbs = [(model_num, os.path.join(folder, f"{mpnn_design_name}_model{model_num+1}.pdb")) for model_num in prediction_models]
+    return [(model_num, model_pdb) for model_num, model_pdb in model_pdbs if os.path.exists(model_pdb)]
+
+# analyse the geometry of the unrelaxed predicted models of an MPNN design, without relaxation
+def analyse_mpnn_geometry(mpnn_design_name, trajectory_pdb, mpnn_complex_statistics, prediction_models, advanced_settings, target_settings, design_paths, binder_chain="B"):
+    mpnn_models = mpnn_model_pdbs(mpnn_design_name, prediction_models, design_paths["MPNN"])
+
+    # parse structures once for all analyses
+    mpnn_structures = [StructureAnalysis(mpnn_design_pdb) for _, mpnn_design_pdb in mpnn_models]
+
+    # Calculate clashes before relaxation, and interface residues used by the secondary structure analysis
+    with trace_span("clashes"):
+        mpnn_clashes = batch_clash_scores(mpnn_structures)
+        batch_hotspot_residues(mpnn_structures, binder_chain)
+
+    # calculate RMSD of target compared to input PDB
+    target_rmsds = batch_target_rmsd(mpnn_structures, target_settings["starting_pdb"], target_settings["chains"])
+
+    # unaligned RMSD calculate to determine if binder is in the designed binding site
+    trajectory_structure = load_structure(trajectory_pdb)
+    site_rmsds = batch_unaligned_rmsd(trajectory_structure, mpnn_structures, binder_chain, binder_chain)
+
+    # calculate statistics for each model individually
+    for n, (model_num, _) in enumerate(mpnn_models):
+        # secondary structure content of starting trajectory binder
+        with trace_context(model=model_num+1):
+            mpnn_alpha, mpnn_beta, mpnn_loops, mpnn_alpha_interface, mpnn_beta_interface, mpnn_loops_interface, mpnn_i_plddt, mpnn_ss_plddt = mpnn_structures[n].ss_percentage(advanced_settings, binder_chain)
+
+        # add the additional statistics to the mpnn_complex_statistics dictionary
+        mpnn_complex_statistics.setdefault(model_num+1, {}).update({
+            'i_pLDDT': mpnn_i_plddt,
+            'ss_pLDDT': mpnn_ss_plddt,
+            'Unrelaxed_Clashes': mpnn_clashes[n],
+            'Interface_Helix%': mpnn_alpha_interface,
+            'Interface_BetaSheet%': mpnn_beta_interface,
+            'Interface_Loop%': mpnn_loops_interface,
+            'Binder_Helix%': mpnn_alpha,
+            'Binder_BetaSheet%': mpnn_beta,
+            'Binder_Loop%': mpnn_loops,
+            'Hotspot_RMSD': site_rmsds[n],
+            'Target_RMSD': target_rmsds[n]
+        })
+
+    return mpnn_complex_statistics
+
+# relax and score the predicted models of an MPNN design, returns the interface residues of the last model
+def analyse_mpnn_interface(mpnn_design_name, mpnn_complex_statistics, prediction_models, advanced_settings, design_paths, binder_chain="B"):
+    mpnn_interface_residues = ''
+
+    # relax and score all models, in parallel if a relax pool is running
+    mpnn_models = mpnn_model_pdbs(mpnn_design_name, prediction_models, design_paths["MPNN"])
+    mpnn_design_relaxed_pdbs = [os.path.join(design_paths["MPNN/Relaxed"], os.path.basename(mpnn_design_pdb)) for _, mpnn_design_pdb in mpnn_models]
+    mpnn_results = relax_pool.relax_and_score([mpnn_design_pdb for _, mpnn_design_pdb in mpnn_models], mpnn_design_relaxed_pdbs, binder_chain)
+
+    # Calculate clashes after relaxation
+    mpnn_relaxed_clashes = batch_clash_scores([relaxed_structure for _, relaxed_structure in mpnn_results])
+
+    for n, (model_num, mpnn_design_pdb) in enumerate(mpnn_models):
+        # interface scores of the relaxed af2 model
+        mpnn_interface_scores, mpnn_interface_AA, mpnn_interface_residues = mpnn_results[n][0]
+
+        mpnn_complex_statistics.setdefault(model_num+1, {}).update({
+            'Relaxed_Clashes': mpnn_relaxed_clashes[n],
+            'Binder_Energy_Score': mpnn_interface_scores['binder_score'],
+            'Surface_Hydrophobicity': mpnn_interface_scores['surface_hydrophobicity'],
+            'ShapeComplementarity': mpnn_interface_scores['interface_sc'],
+            'PackStat': mpnn_interface_scores['interface_packstat'],
+            'dG': mpnn_interface_scores['interface_dG'],
+            'dSASA': mpnn_interface_scores['interface_dSASA'],
+            'dG/dSASA': mpnn_interface_scores['interface_dG_SASA_ratio'],
+            'Interface_SASA_%': mpnn_interface_scores['interface_fraction'],
+            'Interface_Hydrophobicity': mpnn_interface_scores['interface_hydrophobicity'],
+            'n_InterfaceResidues': mpnn_interface_scores['interface_nres'],
+            'n_InterfaceHbonds': mpnn_interface_scores['interface_interface_hbonds'],
+            'InterfaceHbondsPercentage': mpnn_interface_scores['interface_hbond_percentage'],
+            'n_InterfaceUnsatHbonds': mpnn_interface_scores['interface_delta_unsat_hbonds'],
+            'InterfaceUnsatHbondsPercentage': mpnn_interface_scores['interface_delta_unsat_hbonds_percentage'],
+            'InterfaceAAs': mpnn_interface_AA
+        })
+
+        # save space by removing unrelaxed predicted mpnn complex pdb?
+        if advanced_settings["remove_unrelaxed_complex"]:
+            os.remove(mpnn_design_pdb)
+
+    return mpnn_complex_statistics, mpnn_interface_residues
+
+# extract RMSDs of the binder alone predictions to the original trajectory
+def analyse_binder_alone(mpnn_design_name, trajectory_pdb, binder_statistics, prediction_models, advanced_settings, design_paths, binder_chain="B"):
+    binder_models = mpnn_model_pdbs(mpnn_design_name, prediction_models, design_paths["MPNN/Binder"])
+    binder_rmsds = batch_unaligned_rmsd(load_structure(trajectory_pdb), [mpnn_binder_pdb for _, mpnn_binder_pdb in binder_models], binder_chain, "A")
+
+    for (model_num, mpnn_binder_pdb), rmsd_binder in zip(binder_models, binder_rmsds):
+        # append to statistics
+        binder_statistics.setdefault(model_num+1, {}).update({
+                'Binder_RMSD': rmsd_binder
+            })
+
+        # save space by removing binder monomer models?
+        if advanced_settings["remove_binder_monomer"]:
+            os.remove(mpnn_binder_pdb)
+
+    return binder_statistics
+
+# relax and analyse the predicted models of an MPNN design that passed the AF2 filters
+# stages that were already run, e.g. by the lazy filters, can be left out
+def analyse_mpnn_design(mpnn_design_name, trajectory_pdb, mpnn_complex_statistics, binder_statistics, prediction_models, advanced_settings, target_settings, design_paths, binder_chain="B",
+                        stages=("geometry", "interface", "binder")):
+    mpnn_interface_residues = ''
+    if "geometry" in stages:
+        analyse_mpnn_geometry(mpnn_design_name, trajectory_pdb, mpnn_complex_statistics, prediction_models, advanced_settings, target_settings, design_paths, binder_chain)
+    if "interface" in stages:
+        _, mpnn_interface_residues = analyse_mpnn_interface(mpnn_design_name, mpnn_complex_statistics, prediction_models, advanced_settings, design_paths, binder_chain)
+    if "binder" in stages:
+        analyse_binder_alone(mpnn_design_name, trajectory_pdb, binder_statistics, prediction_models, advanced_settings, design_paths, binder_chain)
+
+    return mpnn_complex_statistics, binder_statistics, mpnn_interface_residues
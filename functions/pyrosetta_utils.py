@@ -3,42 +3,100 @@
 ####################################
 ### Import dependencies
 import os
+import numpy as np
 import pyrosetta as pr
 from pyrosetta.rosetta.core.kinematics import MoveMap
 from pyrosetta.rosetta.core.select.residue_selector import ChainSelector
 from pyrosetta.rosetta.protocols.simple_moves import AlignChainMover
 from pyrosetta.rosetta.protocols.analysis import InterfaceAnalyzerMover
 from pyrosetta.rosetta.protocols.relax import FastRelax
-from pyrosetta.rosetta.core.simple_metrics.metrics import RMSDMetric
-from pyrosetta.rosetta.core.select import get_residues_from_subset
-from pyrosetta.rosetta.core.io import pose_from_pose
 from pyrosetta.rosetta.protocols.rosetta_scripts import XmlObjects
 from .generic_utils import clean_pdb
-from .biopython_utils import hotspot_residues
+from .biopython_utils import hotspot_residues, StructureAnalysis
+from .pdb_utils import pdb_atom_dtype
+from .trace_utils import trace_span
 
-# Rosetta interface scores
-def score_interface(pdb_file, binder_chain="B"):
+# initialise PyRosetta with the flags used throughout the pipeline
+def init_pyrosetta(dalphaball_path):
+    pr.init(f'-ignore_unrecognized_res -ignore_zero_occupancy -mute all -holes:dalphaball {dalphaball_path} -corrections::beta_nov16 true -relax:default_repeats 1')
+    get_scoring_session()
+
+# score functions, movers, selectors and filters used for relaxing and scoring, built once per process and reused for every structure
+class ScoringSession:
+    def __init__(self):
+        self.scorefxn = pr.get_fa_scorefxn()
+
+        ### Generate movemaps
+        mmf = MoveMap()
+        mmf.set_chi(True) # enable sidechain movement
+        mmf.set_bb(True) # enable backbone movement, can be disabled to increase speed by 30% but makes metrics look worse on average
+        mmf.set_jump(False) # disable whole chain movement
+
+        # FastRelax
+        self.fastrelax = FastRelax()
+        self.fastrelax.set_scorefxn(pr.get_fa_scorefxn())
+        self.fastrelax.set_movemap(mmf) # set MoveMap
+        self.fastrelax.max_iter(200) # default iterations is 2500
+        self.fastrelax.min_type("lbfgs_armijo_nonmonotone")
+        self.fastrelax.constrain_relax_to_start_coords(True)
+
+        # interface analysis
+        self.iam = InterfaceAnalyzerMover()
+        self.iam.set_interface("A_B")
+        self.iam.set_scorefunction(self.scorefxn)
+        self.iam.set_compute_packstat(True)
+        self.iam.set_compute_interface_energy(True)
+        self.iam.set_calc_dSASA(True)
+        self.iam.set_calc_hbond_sasaE(True)
+        self.iam.set_compute_interface_sc(True)
+        self.iam.set_pack_separated(True)
+
+        self.buns_filter = XmlObjects.static_get_filter('<BuriedUnsatHbonds report_all_heavy_atom_unsats="true" scorefxn="scorefxn" ignore_surface_res="false" use_ddG_style="true" dalphaball_sasa="1" probe_radius="1.1" burial_cutoff_apo="0.2" confidence="0" />')
+
+        # surface residues
+        self.layer_sel = pr.rosetta.core.select.residue_selector.LayerSelector()
+        self.layer_sel.set_layers(pick_core = False, pick_boundary = False, pick_surface = True)
+
+        self._binder_metrics = {}
+
+    # total energy and SASA metrics of the binder chain
+    def binder_metrics(self, binder_chain="B"):
+        if binder_chain not in self._binder_metrics:
+            chain_design = ChainSelector(binder_chain)
+            tem = pr.rosetta.core.simple_metrics.metrics.TotalEnergyMetric()
+            tem.set_scorefunction(self.scorefxn)
+            tem.set_residue_selector(chain_design)
+            bsasa = pr.rosetta.core.simple_metrics.metrics.SasaMetric()
+            bsasa.set_residue_selector(chain_design)
+            self._binder_metrics[binder_chain] = (tem, bsasa)
+
+        return self._binder_metrics[binder_chain]
+
+# scoring session of the current process, forked workers build their own
+scoring_sessions = {}
+
+def get_scoring_session():
+    pid = os.getpid()
+    if pid not in scoring_sessions:
+        scoring_sessions[pid] = ScoringSession()
+    return scoring_sessions[pid]
+
+# Rosetta interface scores, interface residues are taken from the parsed structure and the pose is loaded from pdb_file unless they are passed
+def score_interface(pdb_file, binder_chain="B", structure=None, pose=None):
     # load pose
-    pose = pr.pose_from_pdb(pdb_file)
+    if pose is None:
+        pose = pr.pose_from_pdb(pdb_file)
 
     # analyze interface statistics
-    iam = InterfaceAnalyzerMover()
-    iam.set_interface("A_B")
-    scorefxn = pr.get_fa_scorefxn()
-    iam.set_scorefunction(scorefxn)
-    iam.set_compute_packstat(True)
-    iam.set_compute_interface_energy(True)
-    iam.set_calc_dSASA(True)
-    iam.set_calc_hbond_sasaE(True)
-    iam.set_compute_interface_sc(True)
-    iam.set_pack_separated(True)
+    session = get_scoring_session()
+    iam = session.iam
     iam.apply(pose)
 
     # Initialize dictionary with all amino acids
     interface_AA = {aa: 0 for aa in 'ACDEFGHIKLMNPQRSTVWY'}
 
     # Initialize list to store PDB residue IDs at the interface
-    interface_residues_set = hotspot_residues(pdb_file, binder_chain)
+    interface_residues_set = hotspot_residues(structure if structure is not None else pdb_file, binder_chain)
     interface_residues_pdb_ids = []
     
     # Iterate over the interface residues
@@ -71,8 +129,7 @@ def score_interface(pdb_file, binder_chain="B"):
     interface_dSASA = iam.get_interface_delta_sasa() # interface dSASA (interface surface area)
     interface_packstat = iam.get_interface_packstat() # interface pack stat score
     interface_dG_SASA_ratio = interfacescore.dG_dSASA_ratio * 100 # ratio of dG/dSASA (normalised energy for interface area size)
-    buns_filter = XmlObjects.static_get_filter('<BuriedUnsatHbonds report_all_heavy_atom_unsats="true" scorefxn="scorefxn" ignore_surface_res="false" use_ddG_style="true" dalphaball_sasa="1" probe_radius="1.1" burial_cutoff_apo="0.2" confidence="0" />')
-    interface_delta_unsat_hbonds = buns_filter.report_sm(pose)
+    interface_delta_unsat_hbonds = session.buns_filter.report_sm(pose)
 
     if interface_nres != 0:
         interface_hbond_percentage = (interface_interface_hbonds / interface_nres) * 100 # Hbonds per interface size percentage
@@ -82,15 +139,10 @@ def score_interface(pdb_file, binder_chain="B"):
         interface_bunsch_percentage = None
 
     # calculate binder energy score
-    chain_design = ChainSelector(binder_chain)
-    tem = pr.rosetta.core.simple_metrics.metrics.TotalEnergyMetric()
-    tem.set_scorefunction(scorefxn)
-    tem.set_residue_selector(chain_design)
+    tem, bsasa = session.binder_metrics(binder_chain)
     binder_score = tem.calculate(pose)
 
     # calculate binder SASA fraction
-    bsasa = pr.rosetta.core.simple_metrics.metrics.SasaMetric()
-    bsasa.set_residue_selector(chain_design)
     binder_sasa = bsasa.calculate(pose)
 
     if binder_sasa > 0:
@@ -101,9 +153,7 @@ def score_interface(pdb_file, binder_chain="B"):
     # calculate surface hydrophobicity
     binder_pose = {pose.pdb_info().chain(pose.conformation().chain_begin(i)): p for i, p in zip(range(1, pose.num_chains()+1), pose.split_by_chain())}[binder_chain]
 
-    layer_sel = pr.rosetta.core.select.residue_selector.LayerSelector()
-    layer_sel.set_layers(pick_core = False, pick_boundary = False, pick_surface = True)
-    surface_res = layer_sel.apply(binder_pose)
+    surface_res = session.layer_sel.apply(binder_pose)
 
     exp_apol_count = 0
     total_count = 0 
@@ -143,101 +193,82 @@ def score_interface(pdb_file, binder_chain="B"):
 
     return interface_scores, interface_AA, interface_residues_pdb_ids_str
 
-# align pdbs to have same orientation
-def align_pdbs(reference_pdb, align_pdb, reference_chain_id, align_chain_id):
-    # initiate poses
-    reference_pose = pr.pose_from_pdb(reference_pdb)
-    align_pose = pr.pose_from_pdb(align_pdb)
-
-    align = AlignChainMover()
-    align.pose(reference_pose)
-
-    # If the chain IDs contain commas, split them and only take the first value
-    reference_chain_id = reference_chain_id.split(',')[0]
-    align_chain_id = align_chain_id.split(',')[0]
-
-    # Get the chain number corresponding to the chain ID in the poses
-    reference_chain = pr.rosetta.core.pose.get_chain_id_from_chain(reference_chain_id, reference_pose)
-    align_chain = pr.rosetta.core.pose.get_chain_id_from_chain(align_chain_id, align_pose)
-
-    align.source_chain(align_chain)
-    align.target_chain(reference_chain)
-    align.apply(align_pose)
-
-    # Overwrite aligned pdb
-    align_pose.dump_pdb(align_pdb)
-    clean_pdb(align_pdb)
-
-# calculate the rmsd without alignment
-def unaligned_rmsd(reference_pdb, align_pdb, reference_chain_id, align_chain_id):
-    reference_pose = pr.pose_from_pdb(reference_pdb)
-    align_pose = pr.pose_from_pdb(align_pdb)
-
-    # Define chain selectors for the reference and align chains
-    reference_chain_selector = ChainSelector(reference_chain_id)
-    align_chain_selector = ChainSelector(align_chain_id)
-
-    # Apply selectors to get residue subsets
-    reference_chain_subset = reference_chain_selector.apply(reference_pose)
-    align_chain_subset = align_chain_selector.apply(align_pose)
-
-    # Convert subsets to residue index vectors
-    reference_residue_indices = get_residues_from_subset(reference_chain_subset)
-    align_residue_indices = get_residues_from_subset(align_chain_subset)
-
-    # Create empty subposes
-    reference_chain_pose = pr.Pose()
-    align_chain_pose = pr.Pose()
-
-    # Fill subposes
-    pose_from_pose(reference_chain_pose, reference_pose, reference_residue_indices)
-    pose_from_pose(align_chain_pose, align_pose, align_residue_indices)
-
-    # Calculate RMSD using the RMSDMetric
-    rmsd_metric = RMSDMetric()
-    rmsd_metric.set_comparison_pose(reference_chain_pose)
-    rmsd = rmsd_metric.calculate(align_chain_pose)
-
-    return round(rmsd, 2)
-
 # Relax designed structure
 def pr_relax(pdb_file, relaxed_pdb_path):
     if not os.path.exists(relaxed_pdb_path):
-        # Generate pose
-        pose = pr.pose_from_pdb(pdb_file)
-        start_pose = pose.clone()
+        with trace_span("relax", pdb=os.path.basename(pdb_file)):
+            pose = relax_pose(pdb_file)
 
-        ### Generate movemaps
-        mmf = MoveMap()
-        mmf.set_chi(True) # enable sidechain movement
-        mmf.set_bb(True) # enable backbone movement, can be disabled to increase speed by 30% but makes metrics look worse on average
-        mmf.set_jump(False) # disable whole chain movement
+        # output relaxed and aligned PDB
+        save_relaxed_pdb(pose, relaxed_pdb_path)
 
-        # Run FastRelax
-        fastrelax = FastRelax()
-        scorefxn = pr.get_fa_scorefxn()
-        fastrelax.set_scorefxn(scorefxn)
-        fastrelax.set_movemap(mmf) # set MoveMap
-        fastrelax.max_iter(200) # default iterations is 2500
-        fastrelax.min_type("lbfgs_armijo_nonmonotone")
-        fastrelax.constrain_relax_to_start_coords(True)
-        fastrelax.apply(pose)
-
-        # Align relaxed structure to original trajectory
-        align = AlignChainMover()
-        align.source_chain(0)
-        align.target_chain(0)
-        align.pose(start_pose)
-        align.apply(pose)
-
-        # Copy B factors from start_pose to pose
-        for resid in range(1, pose.total_residue() + 1):
-            if pose.residue(resid).is_protein():
-                # Get the B factor of the first heavy atom in the residue
-                bfactor = start_pose.pdb_info().bfactor(resid, 1)
-                for atom_id in range(1, pose.residue(resid).natoms() + 1):
-                    pose.pdb_info().bfactor(resid, atom_id, bfactor)
+# FastRelax a structure and align it to the starting structure, the relaxed pose is returned without writing it
+def relax_pose(pdb_file):
+    # Generate pose
+    pose = pr.pose_from_pdb(pdb_file)
+    start_pose = pose.clone()
 
-        # output relaxed and aligned PDB
-        pose.dump_pdb(relaxed_pdb_path)
-        clean_pdb(relaxed_pdb_path)
\ No newline at end of file
+    # Run FastRelax
+    get_scoring_session().fastrelax.apply(pose)
+
+    # Align relaxed structure to original trajectory
+    align = AlignChainMover()
+    align.source_chain(0)
+    align.target_chain(0)
+    align.pose(start_pose)
+    align.apply(pose)
+
+    # Copy B factors from start_pose to pose
+    for resid in range(1, pose.total_residue() + 1):
+        if pose.residue(resid).is_protein():
+            # Get the B factor of the first heavy atom in the residue
+            bfactor = start_pose.pdb_info().bfactor(resid, 1)
+            for atom_id in range(1, pose.residue(resid).natoms() + 1):
+                pose.pdb_info().bfactor(resid, atom_id, bfactor)
+
+    return pose
+
+# write a relaxed pose as a cleaned PDB
+def save_relaxed_pdb(pose, relaxed_pdb_path):
+    pose.dump_pdb(relaxed_pdb_path)
+    clean_pdb(relaxed_pdb_path)
+
+# atom records of a pose as they are written to its PDB, coordinates rounded to the PDB precision
+def pose_atoms(pose):
+    pdb_info = pose.pdb_info()
+    records = []
+    serial = 0
+    for resid in range(1, pose.total_residue() + 1):
+        residue = pose.residue(resid)
+        record = 'ATOM' if residue.is_polymer() else 'HETATM'
+        for atom_id in range(1, residue.natoms() + 1):
+            if residue.is_virtual(atom_id):
+                continue
+            serial += 1
+            xyz = residue.xyz(atom_id)
+            records.append((0, record, serial, residue.atom_name(atom_id).strip(), '', residue.name3().strip(), pdb_info.chain(resid),
+                            pdb_info.number(resid), pdb_info.icode(resid).strip(), (xyz.x, xyz.y, xyz.z),
+                            pdb_info.occupancy(resid, atom_id), pdb_info.bfactor(resid, atom_id), residue.atom_type(atom_id).element()))
+
+    atoms = np.array(records, dtype=pdb_atom_dtype)
+    atoms['coord'] = np.round(np.array([record[9] for record in records]).reshape(-1, 3), 3)
+    atoms['bfactor'] = np.round(atoms['bfactor'], 2)
+    atoms['occupancy'] = np.round(atoms['occupancy'], 2)
+    return atoms
+
+# relax a predicted model and score the interface of the relaxed pose in memory, the relaxed PDB is only written as output,
+# returns the score_interface results and the relaxed structure for the geometry analyses
+def relax_and_score(pdb_file, relaxed_pdb_path, binder_chain="B"):
+    # relaxed models of resumed runs are scored from their PDB
+    if os.path.exists(relaxed_pdb_path):
+        relaxed_structure = StructureAnalysis(relaxed_pdb_path)
+        with trace_span("interface_scoring", pdb=os.path.basename(relaxed_pdb_path)):
+            return score_interface(relaxed_pdb_path, binder_chain, relaxed_structure), relaxed_structure
+
+    with trace_span("relax", pdb=os.path.basename(pdb_file)):
+        pose = relax_pose(pdb_file)
+    relaxed_structure = StructureAnalysis(relaxed_pdb_path, pose_atoms(pose))
+    with trace_span("interface_scoring", pdb=os.path.basename(relaxed_pdb_path)):
+        scores = score_interface(relaxed_pdb_path, binder_chain, relaxed_structure, pose)
+    save_relaxed_pdb(pose, relaxed_pdb_path)
+    return scores, relaxed_structure
@@ -0,0 +1,126 @@
+####################################
+################## Results functions
+####################################
+### Import dependencies
+import os
+import csv
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# SQLite store for the trajectory and MPNN design statistics, one table per statistics CSV
+class ResultsStore:
+    def __init__(self, design_path):
+        self.db_path = os.path.join(design_path, 'results.sqlite')
+        self.conn = sqlite3.connect(self.db_path, timeout=120, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS csv_sync (name TEXT PRIMARY KEY, rows INTEGER)')
+        self.columns = {}
+
+    # tables are named after the CSV file they replace, e.g. mpnn_design_stats
+    @staticmethod
+    def table_name(csv_file):
+        return os.path.splitext(os.path.basename(csv_file))[0]
+
+    # create table with the CSV columns and import the rows appended to the CSV since it was last in sync with the table,
+    # i.e. rows of runs without the store, so that the export at the end of the run does not drop them
+    def create_table(self, csv_file, columns):
+        table = self.table_name(csv_file)
+        self.columns[table] = list(columns)
+        column_sql = ', '.join(f'"{c}"' for c in columns)
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            exists = self.conn.execute('SELECT COUNT(*) FROM sqlite_master WHERE type = ? AND name = ?', ('table', table)).fetchone()[0]
+            if not exists:
+                self.conn.execute(f'CREATE TABLE "{table}" (rowid INTEGER PRIMARY KEY, {column_sql})')
+                for key in ['Design', 'Sequence']:
+                    if key in columns:
+                        self.conn.execute(f'CREATE INDEX "{table}_{key}" ON "{table}" ("{key}")')
+
+            # number of CSV rows the table already holds, as of the last import or export, a new table holds none
+            synced = self.conn.execute('SELECT rows FROM csv_sync WHERE name = ?', (table,)).fetchone()
+            if synced is not None:
+                synced = synced[0]
+            else:
+                synced = self.conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+
+            if os.path.exists(csv_file):
+                n_rows = 0
+                for chunk in pd.read_csv(csv_file, chunksize=10000):
+                    new_rows = chunk.iloc[max(synced - n_rows, 0):]
+                    n_rows += len(chunk)
+                    new_rows = new_rows.astype(object).where(new_rows.notna(), None)
+                    self._insert_rows(table, new_rows[self.columns[table]].values.tolist())
+
+                # rows were removed from the CSV, they cannot be told apart from rows only the table holds
+                if n_rows < synced:
+                    raise ValueError(f"{csv_file} has {n_rows} rows but {synced} were exported from {self.db_path}, "
+                                    f"restore the CSV or remove the {table} table to import it again")
+                self._set_synced(table, n_rows)
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def _set_synced(self, table, n_rows):
+        self.conn.execute('INSERT OR REPLACE INTO csv_sync VALUES (?, ?)', (table, n_rows))
+
+    # convert values the way they are written to CSV, dictionaries such as InterfaceAAs are stored as text
+    @staticmethod
+    def _convert(value):
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, (dict, list, tuple)):
+            return str(value)
+        return value
+
+    def _insert_rows(self, table, rows):
+        placeholders = ', '.join('?' * len(self.columns[table]))
+        column_sql = ', '.join(f'"{c}"' for c in self.columns[table])
+        self.conn.executemany(f'INSERT INTO "{table}" ({column_sql}) VALUES ({placeholders})',
+                            [[self._convert(v) for v in row] for row in rows])
+
+    # append one row of statistics
+    def insert(self, csv_file, data_array):
+        self._insert_rows(self.table_name(csv_file), [data_array])
+
+    # load statistics as a dataframe, optionally only for the given design names
+    def read(self, csv_file, designs=None):
+        table = self.table_name(csv_file)
+        column_sql = ', '.join(f'"{c}"' for c in self.columns[table])
+        if designs is None:
+            return pd.read_sql_query(f'SELECT {column_sql} FROM "{table}" ORDER BY rowid', self.conn)
+
+        designs = list(designs)
+        frames = [pd.DataFrame(columns=self.columns[table])]
+        for i in range(0, len(designs), 500):
+            chunk = designs[i:i+500]
+            frames.append(pd.read_sql_query(f'SELECT {column_sql} FROM "{table}" WHERE "Design" IN ({", ".join("?" * len(chunk))}) ORDER BY rowid', self.conn, params=chunk))
+        return pd.concat(frames, ignore_index=True)
+
+    # write the table back in the CSV layout, in one transaction so that the rows written are recorded as in sync
+    def export_csv(self, csv_file):
+        table = self.table_name(csv_file)
+        column_sql = ', '.join(f'"{c}"' for c in self.columns[table])
+        tmp_file = f"{csv_file}.{os.getpid()}.tmp"
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            n_rows = 0
+            with open(tmp_file, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(self.columns[table])
+                for row in self.conn.execute(f'SELECT {column_sql} FROM "{table}" ORDER BY rowid'):
+                    writer.writerow(['' if v is None else v for v in row])
+                    n_rows += 1
+            os.replace(tmp_file, csv_file)
+            self._set_synced(table, n_rows)
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,261 @@
+####################################
+################ Run state functions
+####################################
+### Import dependencies
+import os
+import json
+import time
+import math
+import heapq
+import socket
+import sqlite3
+import numpy as np
+import pandas as pd
+from .generic_utils import file_lock
+
+# Shared state of a design campaign, lets several bindcraft.py processes work on the same design_path
+class RunState:
+    def __init__(self, design_path, worker_id=None):
+        self.db_path = os.path.join(design_path, 'run_state.sqlite')
+        self.worker_id = worker_id or f"{socket.gethostname()}_{os.getpid()}"
+
+        # autocommit mode, transactions are opened explicitly where several statements need to be atomic
+        self.conn = sqlite3.connect(self.db_path, timeout=120, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS trajectories (design_name TEXT PRIMARY KEY, length INTEGER, seed INTEGER, worker TEXT, status TEXT, claimed REAL, finished REAL);
+            CREATE TABLE IF NOT EXISTS accepted (design_name TEXT PRIMARY KEY, trajectory TEXT, worker TEXT, accepted REAL);
+            CREATE TABLE IF NOT EXISTS flags (key TEXT PRIMARY KEY, value TEXT);
+        ''')
+
+    # run statements in a write transaction that blocks other workers until it commits
+    def _transaction(self, fn):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(self.conn)
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return result
+
+    # import trajectories and accepted designs that were written to design_path before the run state existed
+    def register_existing(self, design_paths):
+        def register(conn):
+            if conn.execute('SELECT COUNT(*) FROM trajectories').fetchone()[0] > 0:
+                return
+            now = time.time()
+            for folder, status in [("Trajectory/Relaxed", "finished"), ("Trajectory/Clashing", "Clashing"), ("Trajectory/LowConfidence", "LowConfidence")]:
+                for f in os.listdir(design_paths[folder]):
+                    if f.endswith('.pdb') and not f.startswith('.'):
+                        conn.execute('INSERT OR IGNORE INTO trajectories VALUES (?, NULL, NULL, NULL, ?, ?, ?)', (f[:-4], status, now, now))
+            for f in os.listdir(design_paths["Accepted"]):
+                if f.endswith('.pdb') and not f.startswith('.'):
+                    conn.execute('INSERT OR IGNORE INTO accepted VALUES (?, NULL, NULL, ?)', (f.rsplit('_model', 1)[0], now))
+
+        self._transaction(register)
+
+    # atomically claim a trajectory, returns False if another worker already ran it or the trajectory limit is reached,
+    # the limit counts finished trajectories as max_trajectories does for a single worker
+    def claim_trajectory(self, design_name, length, seed, max_trajectories=False):
+        def claim(conn):
+            if max_trajectories is not False and conn.execute('SELECT COUNT(*) FROM trajectories WHERE status = ?', ('finished',)).fetchone()[0] >= max_trajectories:
+                return False
+            cursor = conn.execute('INSERT OR IGNORE INTO trajectories VALUES (?, ?, ?, ?, ?, ?, NULL)',
+                                (design_name, int(length), int(seed), self.worker_id, 'running', time.time()))
+            return cursor.rowcount == 1
+
+        return self._transaction(claim)
+
+    # record final status of a trajectory, e.g. finished, Clashing or LowConfidence
+    def finish_trajectory(self, design_name, status="finished"):
+        self.conn.execute('UPDATE trajectories SET status = ?, finished = ? WHERE design_name = ?', (status, time.time(), design_name))
+
+    # record an accepted design and return the number of accepted designs across all workers
+    def record_accepted(self, design_name, trajectory_name):
+        def record(conn):
+            conn.execute('INSERT OR IGNORE INTO accepted VALUES (?, ?, ?, ?)', (design_name, trajectory_name, self.worker_id, time.time()))
+            return conn.execute('SELECT COUNT(*) FROM accepted').fetchone()[0]
+
+        return self._transaction(record)
+
+    def n_accepted(self):
+        return self.conn.execute('SELECT COUNT(*) FROM accepted').fetchone()[0]
+
+    # number of claimed trajectories, or of those with a given status such as finished
+    def n_trajectories(self, status=None):
+        if status is None:
+            return self.conn.execute('SELECT COUNT(*) FROM trajectories').fetchone()[0]
+        return self.conn.execute('SELECT COUNT(*) FROM trajectories WHERE status = ?', (status,)).fetchone()[0]
+
+    # ask all workers to stop, for example when the acceptance rate is too low
+    def request_stop(self, reason):
+        self.conn.execute('INSERT OR REPLACE INTO flags VALUES (?, ?)', ('stop', f"{self.worker_id}: {reason}"))
+
+    def stop_requested(self):
+        row = self.conn.execute('SELECT value FROM flags WHERE key = ?', ('stop',)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        self.conn.close()
+
+# Index of relaxed trajectories and accepted designs with their ranking score, kept in memory and appended to design_index.jsonl
+class DesignIndex:
+    def __init__(self, design_path, design_paths):
+        self.index_file = os.path.join(design_path, 'design_index.jsonl')
+        self.trajectories = set()
+        self.accepted = {}
+        self.rows = {}
+        self.offset = 0
+
+        # build the index from the design folders once, later runs and other workers only read new entries
+        with file_lock(self.index_file):
+            if not os.path.exists(self.index_file):
+                events = [{'event': 'trajectory', 'design': f[:-4]} for f in os.listdir(design_paths["Trajectory/Relaxed"]) if f.endswith('.pdb') and not f.startswith('.')]
+                events += [{'event': 'accepted', 'design': f.rsplit('_model', 1)[0], 'pdb': f, 'score': None} for f in os.listdir(design_paths["Accepted"]) if f.endswith('.pdb') and not f.startswith('.')]
+                self._append(events)
+
+        self.refresh()
+
+    def _append(self, events):
+        with open(self.index_file, 'a') as f:
+            f.write(''.join(json.dumps(event) + '\n' for event in events))
+
+    def _apply(self, event):
+        if event['event'] == 'trajectory':
+            self.trajectories.add(event['design'])
+        elif event['event'] == 'accepted':
+            if event['design'] not in self.accepted:
+                self.accepted[event['design']] = {'pdb': event['pdb'], 'score': event['score'], 'order': len(self.accepted)}
+            elif event['score'] is not None:
+                self.accepted[event['design']]['score'] = event['score']
+
+    # read entries appended since the last refresh, including those of other workers sharing the design path
+    def refresh(self):
+        with open(self.index_file, 'r') as f:
+            f.seek(self.offset)
+            data = f.read()
+
+        # skip a line that is still being written
+        complete = data[:data.rfind('\n') + 1]
+        self.offset += len(complete.encode())
+        for line in complete.splitlines():
+            if line:
+                self._apply(json.loads(line))
+
+    def add_trajectory(self, design_name):
+        with file_lock(self.index_file):
+            self._append([{'event': 'trajectory', 'design': design_name}])
+        self.refresh()
+
+    # record an accepted design with its ranking score and statistics row
+    def add_accepted(self, design_name, pdb_file, score, row=None):
+        if row is not None:
+            self.rows[design_name] = row
+        score = None if score is None else float(score)
+        with file_lock(self.index_file):
+            self._append([{'event': 'accepted', 'design': design_name, 'pdb': pdb_file, 'score': score}])
+        self.refresh()
+
+    def n_trajectories(self):
+        self.refresh()
+        return len(self.trajectories)
+
+    def n_accepted(self):
+        self.refresh()
+        return len(self.accepted)
+
+    # accepted designs as (design name, pdb file, statistics row) in order of decreasing Average_i_pTM,
+    # rows not seen by this process are fetched with load_rows(design_names) -> {design name: row}
+    def ranked(self, load_rows):
+        self.refresh()
+        missing = [design for design in self.accepted if design not in self.rows]
+        if missing:
+            self.rows.update(load_rows(missing))
+
+        heap = []
+        for design, entry in self.accepted.items():
+            if design not in self.rows:
+                continue
+            score = entry['score'] if entry['score'] is not None else self.rows[design].get('Average_i_pTM')
+            if score is None or math.isnan(float(score)):
+                score = -math.inf
+            heap.append((-float(score), entry['order'], design))
+        heapq.heapify(heap)
+
+        while heap:
+            _, _, design = heapq.heappop(heap)
+            yield design, self.accepted[design]['pdb'], self.rows[design]
+
+# Index of MPNN sequences with statistics in mpnn_design_stats.csv, kept in memory and appended to sequence_index.txt
+class SequenceIndex:
+    def __init__(self, design_path, mpnn_csv, results_store=None):
+        self.index_file = os.path.join(design_path, 'sequence_index.txt')
+        self.sequences = set()
+        self.by_length = {}
+        self.offset = 0
+
+        # build the index from the MPNN statistics once, later runs and other workers only read new entries
+        with file_lock(self.index_file):
+            if not os.path.exists(self.index_file):
+                if results_store is not None:
+                    sequences = results_store.read(mpnn_csv)['Sequence']
+                else:
+                    sequences = pd.read_csv(mpnn_csv, usecols=['Sequence'])['Sequence']
+                with open(self.index_file, 'w') as f:
+                    f.write(''.join(f"{seq}\n" for seq in sequences.dropna().unique()))
+
+        self.refresh()
+
+    def _add(self, sequence):
+        if sequence not in self.sequences:
+            self.sequences.add(sequence)
+            self.by_length.setdefault(len(sequence), [[], None])[0].append(np.frombuffer(sequence.encode(), dtype=np.uint8))
+
+    # read sequences appended since the last refresh, including those of other workers sharing the design path
+    def refresh(self):
+        with open(self.index_file, 'r') as f:
+            f.seek(self.offset)
+            data = f.read()
+
+        # skip a line that is still being written
+        complete = data[:data.rfind('\n') + 1]
+        self.offset += len(complete.encode())
+        for line in complete.splitlines():
+            if line:
+                self._add(line)
+
+    def add(self, sequence):
+        with file_lock(self.index_file):
+            with open(self.index_file, 'a') as f:
+                f.write(f"{sequence}\n")
+        self.refresh()
+
+    # highest sequence identity to an indexed sequence of the same length
+    def max_identity(self, sequence):
+        entry = self.by_length.get(len(sequence))
+        if not entry or not entry[0]:
+            return 0.0
+        # stack new sequences into the array of this length only when it is used
+        if entry[1] is None or len(entry[1]) != len(entry[0]):
+            entry[1] = np.stack(entry[0])
+        query = np.frombuffer(sequence.encode(), dtype=np.uint8)
+        return float((entry[1] == query).mean(axis=1).max())
+
+    # mask of sequences to keep, dropping exact duplicates and, below an identity threshold of 1,
+    # sequences at least that identical to an indexed sequence or to a sequence kept earlier in the list
+    def novel(self, sequences, max_identity=1.0):
+        self.refresh()
+        keep = []
+        kept = {}
+        for sequence in sequences:
+            query = np.frombuffer(sequence.encode(), dtype=np.uint8)
+            is_novel = sequence not in self.sequences
+            if is_novel and max_identity < 1:
+                identity = max([self.max_identity(sequence)] + [float((query == other).mean()) for other in kept.get(len(sequence), [])])
+                is_novel = identity < max_identity
+            if is_novel:
+                kept.setdefault(len(sequence), []).append(query)
+            keep.append(is_novel)
+        return keep
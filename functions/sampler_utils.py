@@ -0,0 +1,95 @@
+####################################
+################### Sampler functions
+####################################
+### Import dependencies
+import os
+import json
+import numpy as np
+from .generic_utils import file_lock, load_helicity
+
+# Thompson sampling of binder lengths and helicity biases by accepted designs per GPU second, with one bandit for length bins and one
+# for helicity bins. GPU time and accepted designs are appended to sampler_state.jsonl, shared by workers and kept between runs
+class AdaptiveSampler:
+    def __init__(self, design_path, target_settings, advanced_settings):
+        self.state_file = os.path.join(design_path, 'sampler_state.jsonl')
+        self.exploration = advanced_settings["adaptive_exploration"]
+
+        # length bins as sampled by sample_binder_length
+        min_length, max_length = min(target_settings["lengths"]), max(target_settings["lengths"])
+        bucket = max(1, int(advanced_settings["design_length_bucket"]))
+        self.lengths = np.arange(min_length, max_length + 1, bucket)
+
+        # helicity bins over the range sampled by load_helicity, a preset helicity is a single arm
+        self.helicity_edges = None
+        self.fixed_helicity = None
+        if advanced_settings["random_helicity"] is True:
+            self.helicity_edges = np.linspace(-3, 1, max(1, int(advanced_settings["adaptive_helicity_bins"])) + 1)
+        else:
+            self.fixed_helicity = load_helicity(advanced_settings)
+
+        # GPU seconds and accepted designs of each arm
+        self.length_stats = np.zeros((len(self.lengths), 2))
+        self.helicity_stats = np.zeros((1 if self.helicity_edges is None else len(self.helicity_edges) - 1, 2))
+        self.offset = 0
+
+        with file_lock(self.state_file):
+            if not os.path.exists(self.state_file):
+                open(self.state_file, 'w').close()
+        self.refresh()
+
+    def _length_bin(self, length):
+        return int(np.clip(np.searchsorted(self.lengths, length, side='right') - 1, 0, len(self.lengths) - 1))
+
+    def _helicity_bin(self, helicity_value):
+        if self.helicity_edges is None:
+            return 0
+        return int(np.clip(np.searchsorted(self.helicity_edges, helicity_value, side='right') - 1, 0, len(self.helicity_stats) - 1))
+
+    # read records appended since the last refresh, including those of other workers sharing the design path,
+    # records of lengths and helicities outside of the current settings are counted in the closest bin
+    def refresh(self):
+        with open(self.state_file, 'r') as f:
+            f.seek(self.offset)
+            data = f.read()
+
+        # skip a line that is still being written
+        complete = data[:data.rfind('\n') + 1]
+        self.offset += len(complete.encode())
+        for line in complete.splitlines():
+            if line:
+                record = json.loads(line)
+                update = [record['seconds'], record['accepted']]
+                self.length_stats[self._length_bin(record['length'])] += update
+                self.helicity_stats[self._helicity_bin(record['helicity'])] += update
+
+    # record GPU time spent on, or designs accepted from, a trajectory of the given length and helicity
+    def record(self, length, helicity_value, seconds=0.0, accepted=0):
+        with file_lock(self.state_file):
+            with open(self.state_file, 'a') as f:
+                f.write(json.dumps({'length': int(length), 'helicity': float(helicity_value), 'seconds': float(seconds), 'accepted': int(accepted)}) + '\n')
+        self.refresh()
+
+    # draw an arm from the Gamma posterior of its rate of accepted designs per GPU second, or a random arm at the exploration rate.
+    # The prior of one accepted design in the average GPU time per arm keeps arms without accepted designs in play
+    def _choose(self, stats):
+        if len(stats) == 1:
+            return 0
+        if np.random.random() < self.exploration:
+            return int(np.random.randint(len(stats)))
+
+        prior_seconds = max(stats[:, 0].sum() / len(stats), 1.0)
+        rates = np.random.gamma(1 + stats[:, 1], 1 / (prior_seconds + stats[:, 0]))
+        return int(np.argmax(rates))
+
+    # sample binder length and helicity value of the next trajectory
+    def sample(self):
+        self.refresh()
+        length = int(self.lengths[self._choose(self.length_stats)])
+
+        if self.helicity_edges is None:
+            helicity_value = self.fixed_helicity
+        else:
+            n = self._choose(self.helicity_stats)
+            helicity_value = round(np.random.uniform(self.helicity_edges[n], self.helicity_edges[n + 1]), 2)
+
+        return length, helicity_value
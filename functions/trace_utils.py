@@ -0,0 +1,115 @@
+####################################
+#################### Trace functions
+####################################
+### Import dependencies
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+import pandas as pd
+
+# spans of the design stages appended as JSON lines, each with the design, length and model attributes of the enclosing trace contexts.
+# Forked workers append to the same file through their own handle, listeners such as the run metrics get the spans of this process.
+# The tracer does nothing until it is started or has a listener
+class Tracer:
+    def __init__(self):
+        self.trace_file = None
+        self.context = {}
+        self.listeners = []
+        self.pid = None
+        self.handle = None
+
+    def start(self, trace_file):
+        self.trace_file = trace_file
+        self.pid = None
+
+    def active(self):
+        return self.trace_file is not None or bool(self.listeners)
+
+    # listener(name, duration, attributes) is called for every span recorded by this process
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # one line per span, written in a single call so that lines of different processes do not interleave
+    def record(self, name, start, duration, attributes):
+        attributes = {**self.context, **attributes}
+        for listener in self.listeners:
+            listener(name, duration, attributes)
+        if self.trace_file is None:
+            return
+
+        if self.handle is None or self.pid != os.getpid():
+            self.handle = open(self.trace_file, 'a', buffering=1)
+            self.pid = os.getpid()
+
+        span = {'name': name, 'start': start, 'duration': duration, 'pid': self.pid, 'tid': threading.get_native_id(), **attributes}
+        self.handle.write(json.dumps(span, default=str) + '\n')
+
+    def close(self):
+        if self.handle is not None and self.pid == os.getpid():
+            self.handle.close()
+        self.handle = None
+
+# tracer of this process, started by start_tracer
+tracer = Tracer()
+
+def start_tracer(trace_file):
+    tracer.start(trace_file)
+
+# time the enclosed block as a span, attributes are added to those of the trace context
+@contextmanager
+def trace_span(name, **attributes):
+    if not tracer.active():
+        yield
+        return
+
+    start = time.time()
+    start_counter = time.perf_counter()
+    try:
+        yield
+    finally:
+        tracer.record(name, start, time.perf_counter() - start_counter, attributes)
+
+# add attributes such as the design name, length or model number to all spans recorded in the enclosed block
+@contextmanager
+def trace_context(**attributes):
+    previous = tracer.context
+    tracer.context = {**previous, **attributes}
+    try:
+        yield
+    finally:
+        tracer.context = previous
+
+# run a function in a worker with the trace file and attributes of the submitting process, workers are forked before the tracer is started
+def traced_call(trace_file, attributes, fn, *args):
+    if tracer.trace_file != trace_file:
+        tracer.start(trace_file)
+    with trace_context(**attributes):
+        return fn(*args)
+
+# read the spans of a trace file, skipping a line that is still being written
+def read_trace(trace_file):
+    spans = []
+    with open(trace_file, 'r') as f:
+        for line in f:
+            if line.endswith('\n'):
+                spans.append(json.loads(line))
+    return spans
+
+# convert a trace file to the Chrome trace event format, viewable in chrome://tracing or Perfetto
+def export_chrome_trace(trace_file, chrome_file):
+    events = []
+    for span in read_trace(trace_file):
+        args = {k: v for k, v in span.items() if k not in ('name', 'start', 'duration', 'pid', 'tid')}
+        events.append({'name': span['name'], 'cat': span['name'].split('_')[0], 'ph': 'X', 'ts': round(span['start'] * 1e6), 'dur': round(span['duration'] * 1e6),
+                        'pid': span['pid'], 'tid': span['tid'], 'args': args})
+
+    with open(chrome_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+# number, total and mean duration in seconds of the spans in a trace file by name, to compare where runs spend their time
+def summarise_trace(trace_file):
+    trace_df = pd.DataFrame(read_trace(trace_file), columns=['name', 'duration'])
+    summary = trace_df.groupby('name')['duration'].agg(['count', 'sum', 'mean']).rename(columns={'sum': 'total'})
+    return summary.sort_values('total', ascending=False).round(3)
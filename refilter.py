@@ -0,0 +1,68 @@
+####################################
+################# BindCraft Refilter
+####################################
+### Import dependencies
+from functions import *
+
+######################################
+### parse input paths
+parser = argparse.ArgumentParser(description='Re-filter and re-rank the MPNN designs of an existing BindCraft run with new filters, without predicting any structures.')
+
+parser.add_argument('--settings', '-s', type=str, required=True,
+                    help='Path to the basic settings.json file of the run. Required.')
+parser.add_argument('--filters', '-f', type=str, default='./settings_filters/default_filters.json',
+                    help='Path to the filters.json file to apply. If not provided, default will be used.')
+parser.add_argument('--dry-run', action='store_true',
+                    help='Only report how many designs pass the filters, without changing the Accepted designs.')
+
+args = parser.parse_args()
+
+### load settings from JSON
+with open(args.settings, 'r') as file:
+    target_settings = json.load(file)
+
+with open(args.filters, 'r') as file:
+    filters = json.load(file)
+
+design_path = target_settings["design_path"]
+design_paths = generate_directories(design_path)
+trajectory_labels, design_labels, final_labels = generate_dataframe_labels()
+mpnn_csv = os.path.join(design_path, 'mpnn_design_stats.csv')
+final_csv = os.path.join(design_path, 'final_design_stats.csv')
+
+### load MPNN design statistics, from the results store if the run used one
+start_time = time.time()
+if os.path.exists(os.path.join(design_path, 'results.sqlite')):
+    results_store = ResultsStore(design_path)
+    results_store.create_table(mpnn_csv, design_labels)
+    design_df = results_store.read(mpnn_csv)
+    results_store.close()
+else:
+    design_df = pd.read_csv(mpnn_csv)
+print(f"Loaded statistics of {len(design_df)} MPNN designs in {time.time() - start_time:.1f} seconds")
+
+### apply filters to all designs at once
+start_time = time.time()
+if args.dry_run:
+    failures = filter_failures(design_df, filters)
+    n_passed = int((~failures.any(axis=1)).sum())
+else:
+    failures, accepted_df, n_missing = refilter_designs(design_df, filters, design_paths, design_labels, final_labels, final_csv)
+    n_passed = len(accepted_df) + n_missing
+
+    # rebuild the design index from the Accepted folder on the next run
+    design_index_file = os.path.join(design_path, 'design_index.jsonl')
+    if os.path.exists(design_index_file):
+        os.remove(design_index_file)
+print(f"Filtered designs in {time.time() - start_time:.1f} seconds")
+
+### report filter failures, most common first
+failure_counts = failures.sum(axis=0).sort_values(ascending=False)
+for filter_name, count in failure_counts[failure_counts > 0].items():
+    print(f"{filter_name}: {count} designs failed")
+
+print(f"{n_passed} of {len(design_df)} designs passed {os.path.basename(args.filters)}")
+if not args.dry_run:
+    if n_missing:
+        print(f"{n_missing} passing designs have no relaxed model and were not accepted")
+    print(f"Accepted and ranked {len(accepted_df)} designs, statistics written to {final_csv}")